@@ -0,0 +1,300 @@
+# Finite state machine class for AppDaemon (Home Assistant), running on the asyncio loop of AppDaemon.
+#
+# Usage, in an app using the async API (adapi.ADAPI, with async def initialize):
+#
+#   async def initialize(self):
+#     self.fsm = await AsyncFsm.create(self, id='Fsm_alarm', entity='input_text.fsm_alarm_status', states=[...])
+#
+# The machine is built from the same State, Transition and Condition objects, and runs on the
+# loop without a thread hop per callback. Programs may be coroutines (async def program(self)).
+
+import asyncio
+import functools
+import time
+from datetime import timedelta
+
+import fsm_fsm
+import fsm_shared
+
+debug = False
+
+
+# Function to get the scheduler of AppDaemon from an app, or None if there is none
+def get_scheduler(hass):
+  scheduler = getattr(getattr(hass, 'AD', None), 'sched', None)
+  if hasattr(scheduler, 'get_now_sync') and hasattr(scheduler, 'make_naive'):
+    return scheduler
+  return None
+
+
+# Function to get the started adapter of an AppDaemon app using the async API
+async def get_async_hass(hass):
+  adapter = fsm_shared.get_shared(hass, AsyncHass)
+  await adapter.start()
+  return adapter
+
+
+class AsyncHass:
+  # The part of hassapi used by ha-fsm, implemented on the asyncio loop for an app using the async API.
+  # All states are read once with get_state(), and kept current by one async listener of state_changed
+  # events. listen_state, get_state and the timers are then served in memory and by loop timers,
+  # so the machines run as plain functions on the loop. set_state is sent as a task.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'AsyncHass : '
+
+  def __init__(self, hass):
+    # - hass is the AppDaemon app (adapi.ADAPI)
+    self.hass = hass
+    self.loop = None
+    self.started = None
+    # The scheduler of AppDaemon, giving its time (including time travel) without awaiting
+    self.scheduler = get_scheduler(hass)
+    # Otherwise the time of AppDaemon read at start, and the loop time it was read at
+    self.clock = None
+    self.clock_time = None
+    self.event_handle = None
+    self.states = {}
+    self.listeners = {}
+    self.entity_listeners = {}
+    self.handle_count = 0
+    # set_state tasks not yet done
+    self.tasks = set()
+
+
+  # Read all states and start listening to state changes. Only done once
+  async def start(self):
+    if self.started is None:
+      self.loop = asyncio.get_running_loop()
+      self.started = self.loop.create_future()
+      try:
+        if self.scheduler is None:
+          self.clock = await self.hass.datetime(aware=True)
+          self.clock_time = self.loop.time()
+        states = await self.hass.get_state()
+        self.states = dict(states or {})
+        self.event_handle = await self.hass.listen_event(self.event_callback, 'state_changed')
+        self.started.set_result(True)
+      except Exception as e:
+        self.started.set_exception(e)
+        self.started = None
+        raise
+    else:
+      await self.started
+
+
+  async def stop(self):
+    if self.event_handle is not None:
+      await self.hass.cancel_listen_event(self.event_handle)
+      self.event_handle = None
+    if self.tasks:
+      await asyncio.wait(tuple(self.tasks))
+
+
+  def new_handle(self):
+    self.handle_count += 1
+    return self.handle_count
+
+
+  def log(self, msg, level='INFO'):
+    self.hass.log(msg, level=level)
+
+
+  # The time of AppDaemon, as hass.datetime() gives it, but without awaiting, since the timers read it in callbacks
+  def datetime(self, aware=False):
+    if self.scheduler is not None:
+      now = self.scheduler.get_now_sync()
+      return now.astimezone(self.hass.AD.tz) if aware else self.scheduler.make_naive(now)
+    now = self.clock + timedelta(seconds=self.loop.time() - self.clock_time)
+    return now if aware else now.replace(tzinfo=None)
+
+
+  def get_state(self, entity_id=None, attribute=None, default=None, **kwargs):
+    if entity_id is None:
+      return dict(self.states)
+    state = self.states.get(entity_id)
+    if state is None:
+      return default
+    if attribute == 'all':
+      return state
+    # AppDaemon reads attribute 'state' as the state itself
+    if attribute is not None and attribute != 'state':
+      return (state.get('attributes') or {}).get(attribute, default)
+    return state.get('state')
+
+
+  def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+    if attributes:
+      kwargs['attributes'] = attributes
+    task = self.loop.create_task(self.hass.set_state(entity_id, state=state, **kwargs))
+    self.tasks.add(task)
+    task.add_done_callback(self.task_done)
+    return task
+
+
+  def task_done(self, task):
+    self.tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+      self.log('{}set_state failed e={}'.format(self.prefix(), task.exception()), level='ERROR')
+
+
+  def listen_state(self, callback, entity=None, attribute=None, **kwargs):
+    handle = self.new_handle()
+    self.listeners[handle] = (callback, attribute, kwargs)
+    self.entity_listeners.setdefault(entity, []).append(handle)
+    return handle
+
+
+  def cancel_listen_state(self, handle):
+    if self.listeners.pop(handle, None) is not None:
+      for handles in self.entity_listeners.values():
+        if handle in handles:
+          handles.remove(handle)
+          break
+
+
+  # The only callback registered in AppDaemon. Updates the states and calls the listeners whose state or attribute changed
+  async def event_callback(self, event_name, data, kwargs):
+    entity_id = data.get('entity_id')
+    old = data.get('old_state') or self.states.get(entity_id) or {}
+    new = data.get('new_state')
+    if new is None:
+      self.states.pop(entity_id, None)
+      new = {}
+    else:
+      self.states[entity_id] = new
+    for handle in tuple(self.entity_listeners.get(entity_id, ())):
+      listener = self.listeners.get(handle)
+      if listener is None:
+        continue
+      callback, attribute, listener_kwargs = listener
+      if attribute is None or attribute == 'state':
+        old_value, new_value = old.get('state'), new.get('state')
+      else:
+        old_value, new_value = (old.get('attributes') or {}).get(attribute), (new.get('attributes') or {}).get(attribute)
+      if old_value != new_value:
+        try:
+          callback(entity_id, attribute, old_value, new_value, listener_kwargs)
+        except Exception as e:
+          self.log('{}listener of {} failed e={}'.format(self.prefix(), entity_id, e), level='ERROR')
+
+
+  def run_in(self, callback, delay, **kwargs):
+    timer = [None]
+    timer[0] = self.loop.call_later(max(0, float(delay)), self.timer_callback, timer, None, callback, kwargs)
+    return timer
+
+
+  def run_every(self, callback, start, interval, **kwargs):
+    delay = 0 if start == 'now' else max(0, (start - self.datetime()).total_seconds())
+    timer = [None]
+    timer[0] = self.loop.call_later(delay, self.timer_callback, timer, float(interval), callback, kwargs)
+    return timer
+
+
+  # Cancel a timer returned by run_in or run_every
+  def cancel_timer(self, timer):
+    if timer[0] is not None:
+      timer[0].cancel()
+      timer[0] = None
+
+
+  def timer_callback(self, timer, interval, callback, kwargs):
+    if interval:
+      timer[0] = self.loop.call_later(interval, self.timer_callback, timer, interval, callback, kwargs)
+    else:
+      timer[0] = None
+    try:
+      callback(kwargs)
+    except Exception as e:
+      self.log('{}timer callback {} failed e={}'.format(self.prefix(), callback, e), level='ERROR')
+
+
+class AsyncExecutor:
+  # Runs programs as tasks on the loop. A program returning a coroutine is awaited, with an optional
+  # timeout. Programs of one machine run one at a time, in the order of the transitions; programs
+  # of different machines overlap while they await.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'AsyncExecutor : '
+
+  def __init__(self, hass, timeout=None, callback=None):
+    # - hass is the AsyncHass adapter
+    # - timeout is the optional number of seconds a coroutine program may run before it is cancelled
+    # - callback is an optional function called as callback(kwargs) when a program has finished, failed or timed out.
+    #   kwargs has fsm, owner (the State or Transition), program, error (None or the exception), elapsed (seconds) and timed_out
+    self.hass = hass
+    self.timeout = timeout
+    self.callback = callback
+    # Per machine; the task running its last program
+    self.tails = {}
+    self.submitted = 0
+    self.completed = 0
+    self.failed = 0
+    self.timed_out = 0
+
+
+  # Queue programs of owner (a State or Transition of fsm). Returns at once
+  def run(self, fsm, owner, programs):
+    for program in programs:
+      self.submitted += 1
+      task = self.hass.loop.create_task(self.work(self.tails.get(fsm), fsm, owner, program))
+      self.tails[fsm] = task
+      task.add_done_callback(functools.partial(self.work_done, fsm))
+
+
+  # The chain of a machine is dropped when its last task is done
+  def work_done(self, fsm, task):
+    if self.tails.get(fsm) is task:
+      del self.tails[fsm]
+
+
+  async def work(self, previous, fsm, owner, program):
+    if previous is not None:
+      await asyncio.wait([previous])
+    started = time.monotonic()
+    error = None
+    timed_out = False
+    try:
+      result = program.program(owner)
+      if asyncio.iscoroutine(result):
+        await asyncio.wait_for(result, self.timeout)
+    except asyncio.TimeoutError:
+      timed_out = True
+      self.timed_out += 1
+      self.hass.log('{}{} program {} cancelled after {}s'.format(self.prefix(), fsm.id, getattr(program, '__name__', program), self.timeout), level='WARNING')
+    except Exception as e:
+      error = e
+      self.failed += 1
+      self.hass.log('{}{} program {} failed e={}'.format(self.prefix(), fsm.id, getattr(program, '__name__', program), e), level='ERROR')
+    self.completed += 1
+    elapsed = time.monotonic() - started
+    if fsm.metrics is not None:
+      fsm.metrics.program(owner, elapsed)
+    if self.callback:
+      try:
+        self.callback({'fsm': fsm, 'owner': owner, 'program': program, 'error': error,
+                       'elapsed': elapsed, 'timed_out': timed_out})
+      except Exception as e:
+        self.hass.log('{}completion callback failed e={}'.format(self.prefix(), e), level='ERROR')
+
+
+  # Number of machines with programs waiting or running
+  def backlog(self):
+    return len(self.tails)
+
+
+class AsyncFsm(fsm_fsm.Fsm):
+  # Fsm running on the asyncio loop of AppDaemon. Created with await AsyncFsm.create(hass, ...)
+  # with the same arguments as Fsm. The executor defaults to an AsyncExecutor, so programs may be coroutines
+
+  @classmethod
+  async def create(cls, hass, timeout=None, **kwargs):
+    # - hass is the AppDaemon app, using the async API
+    # - timeout is the optional number of seconds a coroutine program may run, when no executor is given
+    adapter = await get_async_hass(hass)
+    if kwargs.get('executor') is None:
+      kwargs['executor'] = AsyncExecutor(adapter, timeout=timeout)
+    return cls(adapter, **kwargs)
@@ -0,0 +1,215 @@
+# Benchmarks for the ha-fsm engine, running on MockHass without AppDaemon.
+#
+# Usage: python fsm_bench.py [--machines 1 100 10000] [--events 20000] [--seed 1] [--json]
+#
+# Every run with the same arguments builds the same machines and feeds them the same
+# synthetic sensor traffic on a virtual clock, so the counters are identical between runs
+# and the timings can be compared between releases.
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from fsm_mock import MockHass
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+from fsm_condition import Condition, GE, GT, LT
+
+SENSOR_KINDS = ('binary_sensor.motion', 'sensor.power', 'sensor.temperature')
+
+
+class count_transition:
+  # Program counting entered states
+  count = 0
+
+  def program(self):
+    count_transition.count += 1
+
+
+# Sensors shared by the machines. Each sensor is used by about four machines
+def make_sensors(machines):
+  sensors = max(4, machines // 4)
+  states = {}
+  for index in range(sensors):
+    states['binary_sensor.motion_{}'.format(index)] = 'off'
+    states['sensor.power_{}'.format(index)] = '0'
+    states['sensor.temperature_{}'.format(index)] = '20'
+  return sensors, states
+
+
+# A room machine with four states and eleven conditions on three sensors
+def make_machine(hass, index, sensors, rng):
+  motion = 'binary_sensor.motion_{}'.format(rng.randrange(sensors))
+  power = 'sensor.power_{}'.format(rng.randrange(sensors))
+  temperature = 'sensor.temperature_{}'.format(rng.randrange(sensors))
+  return Fsm(hass, id='room{}'.format(index), entity='input_text.room{}'.format(index), states=[
+    State(id='Idle', enter_programs=[count_transition], transitions=[
+      Transition(next='Active', conditions=[
+        Condition(entity=motion, operand='on', stability_time=2),
+        Condition(entity=power, operator=GT, operand=100),
+      ]),
+      Transition(next='Hot', conditions=[
+        Condition(entity=temperature, operator=GE, operand=25),
+      ]),
+    ]),
+    State(id='Active', enter_programs=[count_transition], transitions=[
+      Transition(next='Idle', conditions=[
+        Condition(entity=motion, operand='off', stability_time=30),
+      ]),
+      Transition(next='Hot', conditions=[
+        Condition(entity=temperature, operator=GE, operand=25),
+      ]),
+    ]),
+    State(id='Hot', enter_programs=[count_transition], transitions=[
+      Transition(next='Idle', conditions=[
+        Condition(entity=temperature, operator=LT, operand=23),
+      ]),
+      Transition(next='Off', conditions=[
+        Condition(timeout_time=600),
+        Condition(hours=range(8, 20)),
+      ]),
+    ]),
+    State(id='Off', enter_programs=[count_transition], transitions=[
+      Transition(next='Idle', conditions=[
+        Condition(entity=power, operator=LT, operand=5),
+        Condition(timeout_time=60),
+        Condition(minutes=range(0, 30)),
+      ]),
+    ]),
+  ])
+
+
+# Build all machines on a fresh MockHass
+def build(machines, seed):
+  rng = random.Random(seed)
+  sensors, states = make_sensors(machines)
+  for index in range(machines):
+    states['input_text.room{}'.format(index)] = 'Idle'
+  hass = MockHass(states=states)
+  fsms = [make_machine(hass, index, sensors, rng) for index in range(machines)]
+  return hass, fsms, sensors
+
+
+# Synthetic traffic; a random sensor changes every 0.1 s of virtual time
+def make_events(events, sensors, seed):
+  rng = random.Random(seed)
+  values = {}
+  result = []
+  for event in range(events):
+    kind = rng.choice(SENSOR_KINDS)
+    entity = '{}_{}'.format(kind, rng.randrange(sensors))
+    if kind == 'binary_sensor.motion':
+      value = 'on' if values.get(entity) != 'on' else 'off'
+    elif kind == 'sensor.power':
+      value = str(rng.choice((0, 2, 50, 150, 800)))
+    else:
+      value = '{:.1f}'.format(min(30, max(15, float(values.get(entity, 20)) + rng.uniform(-2, 2))))
+    values[entity] = value
+    result.append((entity, value))
+  return result
+
+
+def count_conditions(fsms):
+  return sum(len(transition.conditions) for fsm in fsms for state in fsm.states for transition in state.transitions)
+
+
+# Bytes used by the Condition objects themselves; the instances with their __dict__ (if any) and
+# their private lists. Shared objects like hass, operators and the entity ids are not counted
+def measure_conditions(fsms):
+  total = 0
+  for fsm in fsms:
+    for state in fsm.states:
+      for transition in state.transitions:
+        for condition in transition.conditions:
+          total += sys.getsizeof(condition)
+          # Reading __dict__ creates it, so only the ones holding attributes are counted
+          if hasattr(condition, '__dict__') and condition.__dict__:
+            total += sys.getsizeof(condition.__dict__)
+          total += sys.getsizeof(condition.callbacks)
+  return total
+
+
+def percentile(values, fraction):
+  if not values:
+    return 0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(machines, events, seed):
+  # Memory, measured on its own build since tracemalloc slows everything down
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  hass, fsms, sensors = build(machines, seed)
+  memory = tracemalloc.get_traced_memory()[0] - before
+  tracemalloc.stop()
+  conditions = count_conditions(fsms)
+  condition_memory = measure_conditions(fsms)
+  del hass, fsms
+  gc.collect()
+
+  start = time.perf_counter()
+  hass, fsms, sensors = build(machines, seed)
+  build_time = time.perf_counter() - start
+  traffic = make_events(events, sensors, seed)
+  calls_before = dict(hass.calls)
+
+  count_transition.count = 0
+  latencies = []
+  start = time.perf_counter()
+  for entity, value in traffic:
+    transitions = count_transition.count
+    event_start = time.perf_counter()
+    hass.set_state(entity, state=value)
+    hass.advance(0.1)
+    elapsed = time.perf_counter() - event_start
+    if count_transition.count != transitions:
+      latencies.append(elapsed)
+  run_time = time.perf_counter() - start
+
+  calls = {key: hass.calls[key] - calls_before[key] for key in hass.calls}
+  return {
+    'machines': machines,
+    'events': events,
+    'build_s': round(build_time, 3),
+    'bytes_per_machine': memory // max(1, machines),
+    'bytes_per_condition': condition_memory // max(1, conditions),
+    'events_per_s': round(events / run_time),
+    'transitions': count_transition.count,
+    'latency_p50_us': round(percentile(latencies, 0.5) * 1e6),
+    'latency_p99_us': round(percentile(latencies, 0.99) * 1e6),
+    'hass_callbacks': calls['callbacks'],
+    'hass_listeners': len(hass.listeners),
+    'hass_timers': len(hass.timer_callbacks),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the ha-fsm engine on a virtual clock')
+  parser.add_argument('--machines', type=int, nargs='+', default=[1, 100, 10000])
+  parser.add_argument('--events', type=int, default=20000)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--json', action='store_true', help='print results as json')
+  args = parser.parse_args()
+
+  results = [run(machines, args.events, args.seed) for machines in args.machines]
+  if args.json:
+    print(json.dumps({'python': platform.python_version(), 'results': results}, indent=2))
+    return
+
+  print('python {} on {}'.format(platform.python_version(), platform.machine()))
+  columns = list(results[0])
+  print(' '.join('{:>16}'.format(column) for column in columns))
+  for result in results:
+    print(' '.join('{:>16}'.format(result[column]) for column in columns))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import re
+
+import fsm_shared
+
+debug = False
+
+# Numbers as found in Home Assistant states. Matched before float(), so parsing the usual states never raises
+number_pattern = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+# Helper function to parse a state as a number, as float() does. Returns None if it is not a number
+def to_float(value):
+  if type(value) is float or type(value) is int:
+    return float(value)
+  if type(value) is str:
+    if number_pattern.fullmatch(value):
+      return float(value)
+    # Anything else float() accepts, like ' 21.5' or '1e3 '
+    try:
+      return float(value)
+    except ValueError:
+      return None
+  return None
+
+
+# Function to get the key of an entity, or of one of its attributes. The attribute 'state' is the state itself,
+# so it has the key of the entity, as listen_state calls back with attribute 'state' for both
+def state_key(entity_id, attribute=None):
+  return (entity_id, None if attribute == 'state' else attribute)
+
+
+# Function to get the entity cache shared by all objects using this hass
+def get_entity_cache(hass):
+  return fsm_shared.get_shared(hass, EntityCache)
+
+
+class EntityCache:
+  # Current values of the entities (and attributes) listened to by the EntityDispatcher. The
+  # dispatcher updates an entry before the subscribers are called, and forgets it with the last
+  # subscriber, so a cached value is never older than the last state_changed event. Values of
+  # entities nobody listens to are read from Home Assistant each time.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'EntityCache : '
+
+  def __init__(self, hass):
+    self.hass = hass
+    # (entity, attribute) pairs kept current by the dispatcher
+    self.tracked = set()
+    # (entity, attribute) -> value
+    self.values = {}
+    # (entity, attribute) -> (value, number), the last value parsed as a number
+    self.numbers = {}
+    self.hits = 0
+    self.misses = 0
+
+
+  # Start keeping (entity, attribute) current. Called by the dispatcher when it starts listening
+  def track(self, key):
+    self.tracked.add(key)
+
+
+  # Stop keeping (entity, attribute) current. Called by the dispatcher when it stops listening
+  def forget(self, key):
+    self.tracked.discard(key)
+    self.values.pop(key, None)
+    self.numbers.pop(key, None)
+
+
+  # New value of (entity, attribute) from a state_changed event
+  def update(self, key, value):
+    if key in self.tracked:
+      self.values[key] = value
+
+
+  # Same as hass.get_state(entity_id, attribute), from memory when the entity is listened to
+  def get_state(self, entity_id, attribute=None):
+    key = state_key(entity_id, attribute)
+    if key in self.values:
+      self.hits += 1
+      return self.values[key]
+    self.misses += 1
+    value = self.hass.get_state(entity_id, attribute=attribute)
+    if key in self.tracked:
+      self.values[key] = value
+    return value
+
+
+  # The value of (entity, attribute) as a number, or None if it is not a number
+  def get_number(self, entity_id, attribute=None):
+    return self.to_number(state_key(entity_id, attribute), self.get_state(entity_id, attribute=attribute))
+
+
+  # The value of (entity, attribute) as True (on) or False
+  def get_bool(self, entity_id, attribute=None):
+    return self.get_state(entity_id, attribute=attribute) == 'on'
+
+
+  # Parse value of (entity, attribute) as a number. Parsed once per change, and shared by all readers
+  def to_number(self, key, value):
+    entry = self.numbers.get(key)
+    if entry is not None and entry[0] == value:
+      return entry[1]
+    number = to_float(value)
+    if key in self.tracked:
+      self.numbers[key] = (value, number)
+    return number
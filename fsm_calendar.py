@@ -0,0 +1,97 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+from datetime import datetime, timedelta, time, timezone
+
+debug = False
+
+MINUTES_PER_DAY = 24 * 60
+ALL_MINUTES = (1 << MINUTES_PER_DAY) - 1
+
+
+# Helper function to compile a list of allowed values into a bitset. An empty or missing list allows everything
+def to_bitset(values):
+  if not values:
+    return None
+  bits = 0
+  for value in values:
+    bits |= 1 << value
+  return bits
+
+
+# Helper function to get the wall clock time minute of date, in the time zone of now
+def wall_time(now, date, minute):
+  wall = datetime.combine(date, time(minute // 60, minute % 60))
+  if now.tzinfo is None:
+    return wall
+  # pytz time zones must localize, zoneinfo ones are set as tzinfo
+  if hasattr(now.tzinfo, 'localize'):
+    return now.tzinfo.localize(wall)
+  return wall.replace(tzinfo=now.tzinfo)
+
+
+# Helper function to get the seconds from start to end. Aware times are compared in UTC, to count a DST change in between
+def seconds_between(start, end):
+  if start.tzinfo is not None:
+    start = start.astimezone(timezone.utc)
+    end = end.astimezone(timezone.utc)
+  return (end - start).total_seconds()
+
+
+class CalendarMask:
+  # Allowed times of a Condition, compiled once into bitsets.
+  # Can tell if a time is allowed, and the exact time when that changes next
+
+  def __init__(self, years=None, months=None, weeks=None, days=None, weekdays=None, hours=None, minutes=None, horizon=400):
+    # - years, months, weeks, days, weekdays, hours, minutes are lists of allowed times. If more than one is set, consider an implicit "and" between them
+    # - horizon is the number of days to search for the next change. If none is found, next_change returns the end of the horizon
+    self.years = to_bitset(years)
+    self.months = to_bitset(months)
+    self.weeks = to_bitset(weeks)
+    self.days = to_bitset(days)
+    self.weekdays = to_bitset(weekdays)
+    self.horizon = horizon
+
+    # Minutes of the day allowed by hours and minutes, bit h*60+m
+    hour_bits = to_bitset(hours)
+    minute_bits = to_bitset(minutes)
+    if minute_bits is None:
+      hour_mask = (1 << 60) - 1
+    else:
+      hour_mask = minute_bits & ((1 << 60) - 1)
+    self.day_mask = 0
+    for hour in range(24):
+      if hour_bits is None or hour_bits >> hour & 1:
+        self.day_mask |= hour_mask << (hour * 60)
+
+
+  # Is the date allowed by years, months, weeks, days and weekdays
+  def match_date(self, date):
+    return ( (self.years is None or self.years >> date.year & 1) and
+             (self.months is None or self.months >> date.month & 1) and
+             (self.days is None or self.days >> date.day & 1) and
+             (self.weeks is None or self.weeks >> date.isocalendar()[1] & 1) and
+             (self.weekdays is None or self.weekdays >> date.weekday() & 1) ) == 1
+
+
+  # Is the time allowed
+  def match(self, now):
+    return self.match_date(now) and (self.day_mask >> (now.hour * 60 + now.minute) & 1) == 1
+
+
+  # The first minute after now where match differs from match(now). The minute is wall clock time in the time zone of now
+  def next_change(self, now):
+    status = self.match(now)
+    date = now.date()
+    minute = now.hour * 60 + now.minute + 1
+    for day in range(self.horizon):
+      if self.match_date(date):
+        # Look for the first minute with the opposite status
+        bits = (ALL_MINUTES ^ self.day_mask if status else self.day_mask) >> minute
+        if bits:
+          minute += (bits & -bits).bit_length() - 1
+          return wall_time(now, date, minute)
+      elif status:
+        return wall_time(now, date, 0)
+      date += timedelta(days=1)
+      minute = 0
+    return wall_time(now, date, 0)
@@ -0,0 +1,135 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import json
+import os
+from datetime import timedelta
+
+import fsm_timer
+
+debug = False
+
+version = 1
+
+
+class Checkpoint:
+  # Saves the running state of machines to a local file, and starts them from it after a restart.
+  # For each machine it keeps the current state and, per condition, the absolute time its timeout
+  # and stability timers expire and the last status seen by only_posedge. A machine started from a
+  # checkpoint enters its saved state without running programs, and arms its timers for the time left.
+  # The file is read once, when the first machine starts.
+  #
+  # Usage:
+  #   checkpoint = Checkpoint(self, '/config/appdaemon/fsm_alarm.json')
+  #   Fsm(self, id='Fsm_alarm', states=[...], checkpoint=checkpoint)
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'Checkpoint : '
+
+  def __init__(self, hass, path, interval=60):
+    # - path is the file the checkpoint is written to
+    # - interval is the number of seconds between writes, or None to only write when save() is called
+    self.hass = hass
+    self.timers = fsm_timer.get_timing_wheel(hass)
+    self.path = path
+    self.machines = []
+    # Fsm id -> saved machine, read from the file when first needed
+    self.saved = None
+    self.handle = None
+    if interval:
+      self.handle = self.timers.run_every(self.save_callback, self.timers.now() + timedelta(seconds=interval), interval)
+
+
+  # Register a machine to be saved
+  def add(self, fsm):
+    if fsm not in self.machines:
+      self.machines.append(fsm)
+
+
+  def remove(self, fsm):
+    if fsm in self.machines:
+      self.machines.remove(fsm)
+
+
+  # The saved machine with this id, or None
+  def get(self, id):
+    if self.saved is None:
+      self.saved = self.load()
+    return self.saved.get(id)
+
+
+  # Read the file. A missing or unreadable file gives an empty checkpoint
+  def load(self):
+    try:
+      with open(self.path) as file:
+        data = json.load(file)
+      if data.get('version') != version:
+        self.hass.log('{}{} has version {}, ignored'.format(self.prefix(), self.path, data.get('version')), level='WARNING')
+        return {}
+      return data.get('machines') or {}
+    except FileNotFoundError:
+      return {}
+    except Exception as e:
+      self.hass.log('{}cannot read {} e={}'.format(self.prefix(), self.path, e), level='WARNING')
+      return {}
+
+
+  # Seconds since the epoch, as seen by AppDaemon
+  def now(self):
+    return self.timers.now().timestamp()
+
+
+  # The running state of one machine
+  def save_machine(self, fsm):
+    now = self.now()
+    conditions = {}
+    for state in fsm.states:
+      for transition in state.transitions or ():
+        for condition in transition.conditions:
+          timeout = None
+          if condition.timer_handle is not None:
+            timeout = now + self.timers.remaining(condition.timer_handle)
+          elif state is fsm.state and condition.timeout_status and (condition.timeout_time1 or condition.timeout_time2):
+            timeout = now
+          stability = None
+          if condition.stability_handle is not None:
+            stability = now + self.timers.remaining(condition.stability_handle)
+          elif condition.stability_time and condition.stability_status and condition.entity_status:
+            stability = now
+          last_status = condition.last_status if condition.only_posedge else None
+          if timeout is not None or stability is not None or last_status is not None:
+            conditions[condition.id] = [timeout, stability, last_status]
+    for key, state in fsm.states_dict.items():
+      if state is fsm.state:
+        break
+    return {'state': key, 'conditions': conditions}
+
+
+  # Write all machines to the file; machines not started yet keep what was saved for them.
+  # Written to a temporary file first, so a crash never leaves half a file
+  def save(self):
+    machines = {}
+    for fsm in self.machines:
+      if fsm.started and not fsm.terminated:
+        machines[fsm.id] = self.save_machine(fsm)
+      elif not fsm.started and self.get(fsm.id) is not None:
+        machines[fsm.id] = self.get(fsm.id)
+    temp = '{}.tmp'.format(self.path)
+    with open(temp, 'w') as file:
+      json.dump({'version': version, 'time': self.now(), 'machines': machines}, file, separators=(',', ':'))
+    os.replace(temp, self.path)
+    if debug: self.hass.log('{}saved {} machines'.format(self.prefix(), len(machines)), level='INFO')
+
+
+  def save_callback(self, kwargs):
+    try:
+      self.save()
+    except Exception as e:
+      self.hass.log('{}cannot write {} e={}'.format(self.prefix(), self.path, e), level='ERROR')
+
+
+  # Stop the periodic writes
+  def stop(self):
+    if self.handle is not None:
+      self.timers.cancel_timer(self.handle)
+      self.handle = None
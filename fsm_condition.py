@@ -1,6 +1,12 @@
 # Finite state machine class for AppDaemon (Home Assistant).
 
-from datetime import datetime, timedelta
+import operator
+import sys
+
+import fsm_cache
+import fsm_calendar
+import fsm_queue
+import fsm_trace
 
 debug = False
 
@@ -11,6 +17,54 @@ def enabled_state_transform(state):
     return False
 
 
+# Helper function to parse a state as a number. Returns None if it is not a number
+to_float = fsm_cache.to_float
+
+
+# Registry of operator compilers. A compiler is called once with the Condition, and returns a function
+# taking the entity state and returning True or False. Operators without a compiler are called through
+# their check function on each evaluation
+operators = {}
+
+# Function to register a compiler for an operator
+def register_operator(operator, compile):
+  operators[operator] = compile
+
+
+# Function to compile the operator of a Condition
+def compile_operator(condition):
+  operator = condition.operator
+  compile = operators.get(operator)
+  if compile is None:
+    compile = getattr(operator, 'compile', None)
+  if compile is None:
+    def evaluate(state):
+      return operator.check(condition)
+    return evaluate
+  return compile(condition)
+
+
+# Helper function to get the operand of a Condition, which is required by the operators below
+def required_operand(condition):
+  if condition.operand is None:
+    raise ValueError('{}missing operand'.format(condition.prefix()))
+  return condition.operand
+
+
+# Helper function to get the operand of a Condition as a number
+def numeric_operand(condition):
+  operand = to_float(required_operand(condition))
+  if operand is None:
+    raise ValueError('{}operand is not a number: {}'.format(condition.prefix(), condition.operand))
+  return operand
+
+
+# Helper function to compare the state of a Condition with its operand as numbers
+def compare_numbers(condition, compare):
+  value = to_float(condition.entity_state)
+  return value is not None and compare(value, numeric_operand(condition))
+
+
 class TRUE2:
   # This is a class used as operator for a Condition object. Will always be true
   def check(self):
@@ -27,12 +81,7 @@ class Eq:
   # This is a class used as operator for a Condition object. Will check against required operand
   def check(self):
     if debug: self.hass.log('{}check'.format(self.prefix()), level='INFO')
-    assert self.operand, ('{} : missing operand'.format(self.id))
-    try:
-      status = self.entity_state == self.operand
-    except Exception as e:
-      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
-    return status
+    return self.entity_state == required_operand(self)
 
   # Helper function to get the dot-format representation of this object
   def get_dot(self):
@@ -42,12 +91,7 @@ class Eq:
 class Neq:
   # This is a class used as operator for a Condition object. Will check against required operand
   def check(self):
-    assert self.operand, ('{} : missing operand'.format(self.id))
-    try:
-      status = self.entity_state != self.operand
-    except Exception as e:
-      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
-    return status
+    return self.entity_state != required_operand(self)
 
   # Helper function to get the dot-format representation of this object
   def get_dot(self):
@@ -57,12 +101,7 @@ class Neq:
 class LT:
   # This is a class used as operator for a Condition object. Will check against required operand
   def check(self):
-    assert self.operand, ('{} : missing operand'.format(self.id))
-    try:
-      status = float(self.entity_state) < float(self.operand)
-    except Exception as e:
-      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
-    return status
+    return compare_numbers(self, operator.lt)
 
   # Helper function to get the dot-format representation of this object
   def get_dot(self):
@@ -71,12 +110,7 @@ class LT:
 class LE:
   # This is a class used as operator for a Condition object. Will check against required operand
   def check(self):
-    assert self.operand, ('{} : missing operand'.format(self.id))
-    try:
-      status = float(self.entity_state) <= float(self.operand)
-    except Exception as e:
-      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
-    return status
+    return compare_numbers(self, operator.le)
 
   # Helper function to get the dot-format representation of this object
   def get_dot(self):
@@ -85,12 +119,7 @@ class LE:
 class GT:
   # This is a class used as operator for a Condition object. Will check against required operand
   def check(self):
-    assert self.operand, ('{} : missing operand'.format(self.id))
-    try:
-      status = float(self.entity_state) > float(self.operand)
-    except Exception as e:
-      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
-    return status
+    return compare_numbers(self, operator.gt)
 
   # Helper function to get the dot-format representation of this object
   def get_dot(self):
@@ -99,32 +128,172 @@ class GT:
 class GE:
   # This is a class used as operator for a Condition object. Will check against required operand
   def check(self):
-    assert self.operand, ('{} : missing operand'.format(self.id))
-    try:
-      status = float(self.entity_state) >= float(self.operand)
-      self.hass.log('{} GE {} >= {} is {}'.format(self.prefix(), float(self.entity_state), float(self.operand), status), level='INFO')
-    except Exception as e:
-      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
-    return status
+    return compare_numbers(self, operator.ge)
 
   # Helper function to get the dot-format representation of this object
   def get_dot(self):
     return ">='" + str(self.operand) + "'"
 
+
+# Compilers for the built-in operators. The operand is checked and parsed once
+def compile_true(condition):
+  return lambda state: True
+
+def compile_eq(condition):
+  operand = required_operand(condition)
+  return lambda state: state == operand
+
+def compile_neq(condition):
+  operand = required_operand(condition)
+  return lambda state: state != operand
+
+def compile_numeric(compare):
+  def compile(condition):
+    operand = numeric_operand(condition)
+    # The state is parsed once per change, for all conditions on the same entity
+    to_number = condition.cache.to_number
+    key = fsm_cache.state_key(condition.entity, condition.attribute)
+    def evaluate(state):
+      value = to_number(key, state)
+      return value is not None and compare(value, operand)
+    return evaluate
+  return compile
+
+register_operator(TRUE2, compile_true)
+register_operator(Eq, compile_eq)
+register_operator(Neq, compile_neq)
+register_operator(LT, compile_numeric(operator.lt))
+register_operator(LE, compile_numeric(operator.le))
+register_operator(GT, compile_numeric(operator.gt))
+register_operator(GE, compile_numeric(operator.ge))
+
+
+class Hysteresis:
+  # This is an operator object for a Condition, given as operator=Hysteresis(on=22, off=21), with separate thresholds
+  # to turn on and off. With on above off, the condition turns true when the number reaches on, and false when it
+  # falls to off; with on below off, the other way round (like heating). Between the thresholds the status is kept,
+  # so a sensor hovering around a threshold does not make the condition flap. Changes smaller than deadband from
+  # the last number used are ignored. The operand is not used
+  def __init__(self, on, off, deadband=0):
+    self.on = to_float(on)
+    self.off = to_float(off)
+    assert self.on is not None and self.off is not None, 'Hysteresis thresholds must be numbers: on={} off={}'.format(on, off)
+    self.deadband = deadband
+
+  def __eq__(self, other):
+    return type(self) is type(other) and (self.on, self.off, self.deadband) == (other.on, other.off, other.deadband)
+
+  def __hash__(self):
+    return hash((type(self), self.on, self.off, self.deadband))
+
+  def compile(self, condition):
+    on, off, deadband = self.on, self.off, self.deadband
+    rising = on >= off
+    to_number = condition.cache.to_number
+    key = fsm_cache.state_key(condition.entity, condition.attribute)
+    # The status and the last number used, kept between evaluations of this condition
+    status = False
+    last = None
+    def evaluate(state):
+      nonlocal status, last
+      value = to_number(key, state)
+      if value is None:
+        status = False
+        last = None
+        return False
+      if last is not None and abs(value - last) < deadband:
+        return status
+      last = value
+      if rising:
+        if value >= on:
+          status = True
+        elif value <= off:
+          status = False
+      else:
+        if value <= on:
+          status = True
+        elif value >= off:
+          status = False
+      return status
+    return evaluate
+
+  # Changes while the condition was detached were not seen, so a lazy condition starts again from the thresholds
+  def attach(self, condition):
+    condition.evaluate = self.compile(condition)
+
+  # Helper function to get the dot-format representation of this object
+  def get_dot(self, condition):
+    return " on'{}' off'{}'".format(self.on, self.off)
+
   
+# Helper function to intern entity ids, so machines generated in a loop share one copy of each
+def intern_id(value):
+  if type(value) is str:
+    return sys.intern(value)
+  return value
+
+
 class Condition:
+  # Fixed attributes. Large fleets have many conditions. __dict__ is kept, since operators may store their own attributes
+  __slots__ = ('status', 'last_status', 'pulse', 'id', 'enabled', 'enabled_entity', 'enabled_state',
+               'entity', 'attribute', 'operator', 'operand', 'only_posedge', 'stability_time',
+               'timeout_time1', 'timeout_time2', 'timeout_entity',
+               'years', 'months', 'weeks', 'days', 'weekdays', 'hours', 'minutes', 'calendar',
+               'callbacks', 'entity_state', 'entity_status', 'timeout_status', 'timer_handle',
+               'stability_status', 'stability_handle', 'time_handle', 'time_status', 'attached',
+               'evaluate', 'transition', 'index', 'fsm', 'saved', '__dict__')
+
+  # The objects shared per hass and the settings of the machine are read through the machine, instead of a copy in each condition
+  @property
+  def hass(self):
+    return self.transition.fsm.hass
+
+  @property
+  def dispatcher(self):
+    return self.transition.fsm.dispatcher
+
+  @property
+  def timers(self):
+    return self.transition.fsm.timers
+
+  @property
+  def queue(self):
+    return self.transition.fsm.queue
+
+  @property
+  def snapshot(self):
+    return self.transition.fsm.snapshot
+
+  @property
+  def cache(self):
+    return self.transition.fsm.cache
+
+  @property
+  def lazy(self):
+    return self.transition.fsm.lazy
+
+  @property
+  def trace(self):
+    return self.transition.fsm.trace
+
+  @property
+  def metrics(self):
+    return self.transition.fsm.metrics
+
   # Helper function to simplify print and log messages
   def prefix(self):
     return '{} : '.format(self.id)
   
-  def __init__(self, id=None, enabled=True, enabled_entity=None, entity=None, attribute=None, operator=Eq, operand=None, only_posedge=False, stability_time=None, timeout_time=None, timeout_entity=None, years=None, months=None, weeks=None, days=None, weekdays=None, hours=None, minutes=None):
+  def __init__(self, id=None, enabled=True, enabled_entity=None, entity=None, attribute=None, operator=Eq, operand=None, fsm=None, only_posedge=False, stability_time=None, timeout_time=None, timeout_entity=None, years=None, months=None, weeks=None, days=None, weekdays=None, hours=None, minutes=None):
     # - id is optional but useful for debugging
     # - enabled tells if this Condition is enabled ((default) or not
     # - enabled_entity is an optional name of entity to tell if this Condition is enabled or not
     # - entity is an optional hass entity which can be tested by the operator
     # - attribute is an optional hass attribute for entity which can be tested by the operator
-    # - operator is required if entity is used, and is an object with a check function
+    # - operator is required if entity is used, and is an object with a check function, or an object with a compile function like fsm_window.Mean(300)
     # - operand is the operand for the operator above
+    # - fsm is an optional Fsm whose state (name) is tested by the operator instead of an entity. The state is seen in process,
+    #   when the other machine changes state, without waiting for it to reach Home Assistant
     # - only_posedge can be set to True if the condition should only be evaluated just when the entity changes value from False to True
     # - stability_time is optional but only used if entity is used, and sets a minimum time operator must be true before this condition evaluates as true
     # - timeout_time is optional and a minimum time before this condition evaluates as true
@@ -133,21 +302,25 @@ class Condition:
 
     # status will always reflect the status of this condition and is intended to be probed from outside
     self.status = self.last_status = None
+    # True while an only_posedge pulse is announced
+    self.pulse = False
     
     self.id = id
 
     assert isinstance(enabled, (bool, type(None)))
     self.enabled = enabled
-    self.enabled_entity = enabled_entity
+    self.enabled_entity = intern_id(enabled_entity)
     self.enabled_state = True # ??
-    self.entity = entity
-    self.attribute = attribute
+    self.entity = intern_id(entity)
+    self.attribute = intern_id(attribute)
     self.operator = operator
     self.operand = operand
+    assert fsm is None or entity is None, 'entity and fsm cannot both be set'
+    self.fsm = fsm
     self.only_posedge = only_posedge
     self.stability_time = stability_time
     self.timeout_time1 = timeout_time
-    self.timeout_entity = timeout_entity
+    self.timeout_entity = intern_id(timeout_entity)
 
     assert isinstance(years, (list, range, type(None)))
     self.years = years
@@ -170,8 +343,15 @@ class Condition:
     assert isinstance(minutes, (list, range, type(None)))
     self.minutes = minutes
 
+    # The allowed times compiled into bitsets, or None if all times are allowed
+    if years or months or weeks or days or weekdays or hours or minutes:
+      self.calendar = fsm_calendar.CalendarMask(years, months, weeks, days, weekdays, hours, minutes)
+    else:
+      self.calendar = None
+
     self.callbacks = []
   
+    self.entity_state = None
     self.entity_status = False
   
     self.timeout_status = False
@@ -181,24 +361,33 @@ class Condition:
     self.stability_handle = None
   
     self.time_handle = None
+    self.time_status = False
 
     self.timeout_time2 = None
 
+    self.attached = False
+    self.evaluate = None
+    # Saved [timeout deadline, stability deadline, last_status] while the Fsm starts from a checkpoint
+    self.saved = None
+    # Set by initialize
+    self.transition = None
+
     
   def initialize(self, hass, transition, index):
     try:
-      self.hass = hass
       self.transition = transition
       self.index = index
   
       if not self.id:
         self.id = '{}_c{}'.format(self.transition.id, index)
+      restored = transition.fsm.restored
+      self.saved = restored.get(self.id) if restored else None
       
       if debug: self.hass.log('{}Condition inititilizing'.format(self.prefix()), level='INFO')
 
-      self.update_time_status()
-  
-      if self.entity == None or self.operator == None:
+      if self.fsm != None and self.operator != None:
+        self.evaluate = compile_operator(self)
+      elif self.entity == None or self.operator == None:
         if debug: self.hass.log('{}State is disabled'.format(self.prefix()), level='INFO')
         self.entity_status = True
         self.stability_status = True
@@ -209,58 +398,160 @@ class Condition:
           raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
          
         assert temp, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
-  
-        if self.attribute != None:
-          #          self.hass.log('{}Added listen_state entity={} attribute={} callback={}'.format(self.prefix(), self.entity, self.attribute, self.condition_state_callback), level='INFO')
-          kwargs = "attribute='" + self.attribute + "'"
-          self.hass.listen_state(self.condition_state_callback, self.entity, attribute=self.attribute)
-          entity_state = self.hass.get_state(self.entity, attribute=self.attribute)
-          assert entity_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
-        else:
-          #          self.hass.log('{}Added listen_state entity={} callback={}'.format(self.prefix(), self.entity, self.condition_state_callback), level='INFO')
-          self.hass.listen_state(self.condition_state_callback, self.entity)
-          entity_state = self.try_get_state(self.entity)
-          assert entity_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
-          
-        self.condition_state_change(entity_state)
+
+        self.evaluate = compile_operator(self)
   
       if self.timeout_entity:
         temp = self.try_get_state(self.timeout_entity)
         assert temp, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
 
-        self.hass.listen_state(self.timeout_state_callback, self.timeout_entity)
-        timeout_state = self.try_get_state(self.timeout_entity)
-        assert timeout_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
-        
-        self.timeout_time2 = float(timeout_state)
-#        self.hass.log('{}Timeout_entity {} with value {}'.format(self.prefix(), self.timeout_entity, self.timeout_time2), level='INFO')
-  
-        
-      if self.enabled_entity:
-        #        temp = self.try_get_state(self.enabled_entity)
-        #        assert temp, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
-        
-        self.hass.listen_state(self.enabled_state_callback, self.enabled_entity)
-        self.enabled_state = enabled_state_transform( self.hass.get_state(self.enabled_entity) )
-        #        assert self.enabled_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+      # In lazy mode, listeners and time schedules are attached when the state is entered
+      if not self.lazy:
+        self.attach()
       else:
-        self.enabled_state = True
-        
-      self.update_status()
+        self.update_status()
       #      self.hass.log('{}Condition inititilizing done'.format(self.prefix()), level='ERROR')
     except Exception as e:
       raise ValueError("Condition Error: name={} id={} e={}".format(__name__, self.id, e))
       
 
-  def try_get_state(self, entity_id):
+  # Move an initialized condition to a new Transition, keeping its listeners, timers and status. Used by Fsm.reload
+  def rebind(self, transition, index):
+    self.transition = transition
+    self.index = index
+    self.callbacks = []
+
+
+  # The arguments this condition was created with, except id. Conditions with the same spec behave the same
+  def spec(self):
+    return (self.enabled, self.enabled_entity, self.entity, self.attribute, self.operator, self.operand, self.fsm,
+            self.only_posedge, self.stability_time, self.timeout_time1, self.timeout_entity,
+            self.years, self.months, self.weeks, self.days, self.weekdays, self.hours, self.minutes)
+
+
+  # Attach listeners and time schedules, and read the entities once listened to
+  def attach(self):
+    if self.attached:
+      return
+    self.attached = True
+    if debug: self.hass.log('{}attach'.format(self.prefix()), level='INFO')
+
+    self.update_time_status()
+
+    if self.operator != None and (self.entity != None or self.fsm != None):
+      # Evaluated afresh, so the first update after attaching always runs, even if the status is the same as before
+      self.entity_status = None
+
+    if self.entity != None and self.operator != None:
+      # Operators keeping state of the entity, like the window operators, start before the condition listens
+      attach = getattr(self.operator, 'attach', None)
+      if attach:
+        attach(self)
+      if self.attribute != None:
+        #          self.hass.log('{}Added listen_state entity={} attribute={} callback={}'.format(self.prefix(), self.entity, self.attribute, self.condition_state_callback), level='INFO')
+        self.dispatcher.subscribe(self.condition_state_callback, self.entity, attribute=self.attribute)
+        entity_state = self.try_get_state(self.entity, attribute=self.attribute)
+        assert entity_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+      else:
+        #          self.hass.log('{}Added listen_state entity={} callback={}'.format(self.prefix(), self.entity, self.condition_state_callback), level='INFO')
+        self.dispatcher.subscribe(self.condition_state_callback, self.entity)
+        entity_state = self.try_get_state(self.entity)
+        assert entity_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+        
+      self.condition_state_change(entity_state)
+
+    if self.fsm != None and self.operator != None:
+      self.fsm.add_callback(self.fsm_state_callback)
+      self.condition_state_change(self.get_fsm_state())
+
+    if self.timeout_entity:
+      self.dispatcher.subscribe(self.timeout_state_callback, self.timeout_entity)
+      timeout_state = self.try_get_state(self.timeout_entity)
+      assert timeout_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+      
+      self.timeout_time2 = float(timeout_state)
+#        self.hass.log('{}Timeout_entity {} with value {}'.format(self.prefix(), self.timeout_entity, self.timeout_time2), level='INFO')
+
+      
+    if self.enabled_entity:
+      #        temp = self.try_get_state(self.enabled_entity)
+      #        assert temp, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+      
+      self.dispatcher.subscribe(self.enabled_state_callback, self.enabled_entity)
+      self.enabled_state = enabled_state_transform( self.try_get_state(self.enabled_entity) )
+      #        assert self.enabled_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+    else:
+      self.enabled_state = True
+      
+    self.update_status()
+
+
+  # Detach listeners, stability timer and time schedule. Used in lazy mode when the state is exited
+  def detach(self):
+    if not self.attached:
+      return
+    self.attached = False
+    if debug: self.hass.log('{}detach'.format(self.prefix()), level='INFO')
+
+    if self.entity != None and self.operator != None:
+      if self.attribute != None:
+        self.dispatcher.unsubscribe(self.condition_state_callback, (self.entity, self.attribute))
+      else:
+        self.dispatcher.unsubscribe(self.condition_state_callback, (self.entity, None))
+      detach = getattr(self.operator, 'detach', None)
+      if detach:
+        detach(self)
+    if self.fsm != None and self.operator != None:
+      self.fsm.remove_callback(self.fsm_state_callback)
+    if self.timeout_entity:
+      self.dispatcher.unsubscribe(self.timeout_state_callback, (self.timeout_entity, None))
+    if self.enabled_entity:
+      self.dispatcher.unsubscribe(self.enabled_state_callback, (self.enabled_entity, None))
+
+    if self.stability_handle != None:
+      self.timers.cancel_timer(self.stability_handle)
+      self.stability_handle = None
+      self.stability_status = False
+
+    if self.time_handle != None:
+      self.timers.cancel_timer(self.time_handle)
+      self.time_handle = None
+      
+
+  # Helper function to read a state; from the snapshot while initializing, otherwise from the entity cache
+  def try_get_state(self, entity_id, attribute=None):
     try:
-      state = self.hass.get_state(entity_id=entity_id)
+      # The snapshot is held while machines are initialized
+      if self.snapshot.depth > 0:
+        return self.snapshot.get_state(entity_id, attribute=attribute)
+      state = self.cache.get_state(entity_id, attribute=attribute)
       return state
     except:
       self.hass.log("{}: Failed to get_state for entity_id: {}".format(__name__, entity_id))
       return None
 
           
+  # Helper function to get the state of the other machine. Before it is started, the state published in its entity is used
+  def get_fsm_state(self):
+    if self.fsm.state != None:
+      return self.fsm.state.name
+    if self.fsm.entity:
+      return self.try_get_state(self.fsm.entity)
+    return None
+
+
+  # Callback when the other machine changes state. Called in process, while the other machine makes the transition
+  def fsm_state_callback(self, kwargs):
+    try:
+      if debug: self.hass.log('{}Fsm {} state changed to <{}>'.format(self.prefix(), self.fsm.id, kwargs['new'].name), level='INFO')
+      metrics = self.metrics
+      if metrics is not None:
+        metrics.events += 1
+      self.condition_state_change(kwargs['new'].name)
+    except Exception as e:
+      raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
+
+
   # Callback if the entity containing the timeout_time changes
   def timeout_state_callback(self, entity, attribute, old, new, kwargs):
     try:
@@ -275,43 +566,30 @@ class Condition:
     try:
       self.enabled_state = enabled_state_transform(new)
       if debug: self.hass.log('{}Enabled state changed to <{}>'.format(self.prefix(), self.enabled_state), level='ERROR')
+      # The entity status may be unchanged, so the next state change of the entity would not check
+      self.check()
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
 
 
+  # Update time_status, and schedule a single wakeup when it changes next
   def update_time_status(self):
     try:
       #      self.hass.log('{}update_time_status'.format(self.prefix(), level='ERROR'))
       
-      if self.years is None and self.months is None and self.weeks is None and self.days is None and self.weekdays is None and self.hours is None and self.minutes is None:
+      if self.calendar is None:
         self.time_status = True
       else:
+        # Aware local time, so that the delay to the next change counts a DST change in between
+        now = self.timers.now(aware=True)
+        self.time_status = self.calendar.match(now)
+
         if self.time_handle == None:
-          callback_time = datetime.now()
-        
-          callback_time = callback_time.replace(microsecond=0)
-          callback_time = callback_time.replace(second=0) + timedelta(minutes=1)
-          callback_interval = 60
-          if self.minutes == None:
-            callback_time = callback_time.replace(minute=0) + timedelta(hours=1)
-            callback_interval = 3600
-            if self.hours == None:
-              callback_time = callback_time.replace(hour=0) + timedelta(days=1)
-              callback_interval = 24*3600
-            
-          #          self.hass.log('{}callback: {} every {}'.format(self.prefix(), callback_time, callback_interval), level='INFO')
-          self.time_handle = self.hass.run_every(self.time_callback, callback_time, callback_interval)
-      
-        now = datetime.now()
-        self.time_status = ( (not self.years or now.year in self.years) and
-                             (not self.months or now.month in self.months) and
-                             (not self.days or now.day in self.days) and
-                             (not self.hours or now.hour in self.hours) and
-                             (not self.minutes or now.minute in self.minutes) and
-                             (not self.weeks or now.isocalendar()[1] in self.weeks) and
-                             (not self.weekdays or now.weekday() in self.weekdays) )
-
-        #        self.hass.log('{}callback: time_status={} self.minutes={} now.minute={} now.weekday={}'.format(self.prefix(), self.time_status, self.minutes, now.minute, now.weekday()), level='ERROR')
+          callback_time = self.calendar.next_change(now)
+          #          self.hass.log('{}callback: {}'.format(self.prefix(), callback_time), level='INFO')
+          self.time_handle = self.timers.run_in(self.time_callback, fsm_calendar.seconds_between(now, callback_time))
+
+        #        self.hass.log('{}callback: time_status={} now={}'.format(self.prefix(), self.time_status, now), level='ERROR')
     #      self.hass.log('{}update_time_status done'.format(self.prefix(), level='ERROR'))
         
     except Exception as e:
@@ -322,7 +600,14 @@ class Condition:
     try:
       #      self.hass.log('{}time_callback'.format(self.prefix(), level='INFO'))
 
+      self.time_handle = None
+      metrics = self.metrics
+      if metrics is not None:
+        metrics.events += 1
       self.update_time_status()
+      trace = self.trace
+      if trace is not None:
+        trace.add(fsm_trace.TIME, self.id, self.time_status)
       self.check()
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
@@ -331,6 +616,9 @@ class Condition:
   def condition_state_callback(self, entity, attribute, old, new, kwargs):
     try:
       if debug: self.hass.log('{}Condition state changed from <{}> to <{}>'.format(self.prefix(), old, new), level='ERROR')
+      metrics = self.metrics
+      if metrics is not None:
+        metrics.events += 1
       self.condition_state_change(new)
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
@@ -340,14 +628,25 @@ class Condition:
     try:
       self.entity_state = new
       
-      self.entity_status = self.operator.check(self)
+      last_entity_status = self.entity_status
+      self.entity_status = self.evaluate(new)
+      metrics = self.metrics
+      if metrics is not None:
+        metrics.evaluations += 1
+      if self.entity_status == last_entity_status:
+        # Nothing changed for this condition; the stability timer keeps running, or stays expired
+        return
 
       if self.entity_status:
         if self.stability_time:
           if self.stability_handle == None:
             #        self.hass.log('{}activate stability {}s'.format(self.prefix(), self.stability_time), level='INFO')
-            self.stability_handle = self.hass.run_in(self.stability_callback, self.stability_time)
-            self.stability_status = False
+            stability_time = self.saved_time(1, self.stability_time)
+            if stability_time > 0:
+              self.stability_handle = self.timers.run_in(self.stability_callback, stability_time)
+              self.stability_status = False
+            else:
+              self.stability_status = True
         else:
           #      self.hass.log('{}Stability is disabled'.format(self.prefix()), level='INFO')
           self.stability_status = True
@@ -355,7 +654,7 @@ class Condition:
         if self.stability_time != None:
           if self.stability_handle != None:
             #      self.hass.log('{}deactivate stability'.format(self.prefix()), level='INFO')
-            self.hass.cancel_timer(self.stability_handle)
+            self.timers.cancel_timer(self.stability_handle)
             self.stability_handle = None
             self.stability_status = False
         else:
@@ -372,11 +671,15 @@ class Condition:
       #    self.hass.log('{}deactivate'.format(self.prefix()), level='INFO')
       if self.timer_handle != None:
         #      self.hass.log('{}cancel timer'.format(self.prefix()), level='INFO')
-        self.hass.cancel_timer(self.timer_handle)
+        self.timers.cancel_timer(self.timer_handle)
         self.timer_handle = None
       self.timeout_status = False
   
       self.status = self.last_status = None
+      self.pulse = False
+
+      if self.lazy:
+        self.detach()
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
        
@@ -384,6 +687,15 @@ class Condition:
   def activate(self):
     try:
       #      self.hass.log('{}activate'.format(self.prefix()), level='INFO')
+      if self.lazy:
+        self.attach()
+        # attach checked before the timeout status below was set; entering with the condition already true is no posedge
+        self.last_status = None
+
+      if self.saved is not None and self.only_posedge:
+        # A change while AppDaemon was down still makes a pulse
+        self.last_status = self.saved[2]
+
       if self.timeout_time1!=None or self.timeout_time2!=None:
         timeout_time = 0
         if self.timeout_time1:
@@ -393,8 +705,12 @@ class Condition:
           
         if self.timer_handle == None:
           #          self.hass.log('{}activate timer {}s'.format(self.prefix(), timeout_time), level='INFO')
-          self.timer_handle = self.hass.run_in(self.timer_callback, timeout_time)
-          self.timeout_status = False
+          timeout_time = self.saved_time(0, timeout_time)
+          if timeout_time > 0:
+            self.timer_handle = self.timers.run_in(self.timer_callback, timeout_time)
+            self.timeout_status = False
+          else:
+            self.timeout_status = True
         else:
           self.hass.log('{}activate timer - already active?!'.format(self.prefix()), level='ERROR')
         
@@ -407,12 +723,25 @@ class Condition:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
       
       
+  # Helper function to get the time left of a timer saved in a checkpoint, or time if none was saved
+  def saved_time(self, index, time):
+    if self.saved is None or self.saved[index] is None:
+      return time
+    return max(0, self.saved[index] - self.timers.now().timestamp())
+
+
   # This is the callback function when timeout timer expires
   def timer_callback(self, kwargs):
     try:
       if debug: self.hass.log('{}Timer callback'.format(self.prefix()), level='INFO')
       self.timeout_status = True
       self.timer_handle = None
+      metrics = self.metrics
+      if metrics is not None:
+        metrics.events += 1
+      trace = self.trace
+      if trace is not None:
+        trace.add(fsm_trace.TIMEOUT, self.id)
       self.check()
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
@@ -424,6 +753,12 @@ class Condition:
       if debug: self.hass.log('{}Stability callback'.format(self.prefix()), level='INFO')
       self.stability_status = True
       self.stability_handle = None
+      metrics = self.metrics
+      if metrics is not None:
+        metrics.events += 1
+      trace = self.trace
+      if trace is not None:
+        trace.add(fsm_trace.STABILITY, self.id)
       self.check()
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
@@ -445,55 +780,58 @@ class Condition:
     try:
       self.update_status()
       
-      if not self.last_status == self.status:
-        if debug: self.hass.log('{}check change status from {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
-
-        if self.only_posedge:
-          if (self.last_status == False) and (self.status == True):
-            # Pos-edge
+      if self.only_posedge:
+        # Listeners only see True for one pulse, when status goes from False to True
+        if (self.last_status == False) and (self.status == True):
+          # Pos-edge
+
+          #            self.hass.log('{}Posedge ok {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
+          self.last_status = self.status
+          self.pulse = True
+          # Announce True to listeners
+          self.announce_to_callbacks(True)
+
+          #            self.hass.log('{}Posedge - setting status back to false'.format(self.prefix()), level='ERROR')
+          # Announce False to listeners, once the states have seen the True
+          self.queue.post(self.posedge_callback, fsm_queue.DEFERRED)
+        else:
+          if debug and self.last_status != self.status: self.hass.log('{}Posedge blocking {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
+          self.last_status = self.status
+          self.status = self.pulse
 
-            #            self.hass.log('{}Posedge ok {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
-            # Announce True to listeners
-            self.announce_to_callbacks(True)
-            
-            #            self.hass.log('{}Posedge - setting status back to false'.format(self.prefix()), level='ERROR')
-            # Announce False to listeners
-            self.announce_to_callbacks(False)
-
-            # Set back status to the currently correct value. Not needed?
-            self.status = True
-          elif self.status == False:
-            #            self.hass.log('{}Posedge reset {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
-            self.last_status = self.status
-            
-          #          else:
-            #            self.hass.log('{}Posedge blocking {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
+      elif not self.last_status == self.status:
+        if debug: self.hass.log('{}check change status from {} to {}'.format(self.prefix(), self.last_status, self.status), level='ERROR')
 
-        else:
-            # Announce change to listeners
-            self.announce_to_callbacks(self.status)
-            self.last_status = self.status
+        # Announce change to listeners
+        self.announce_to_callbacks(self.status)
+        self.last_status = self.status
             
     except Exception as e:
       raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
 
 
-  # Function to call all callbacks
+  # Function to call all callbacks. They are posted to the event queue, which runs them once the current event is handled
   def announce_to_callbacks(self, value):
-      old_status = self.status
       self.status = value
+      trace = self.trace
+      if trace is not None:
+        trace.add(fsm_trace.CONDITION, self.id, value)
+      self.transition.condition_changed(self.index, value)
       for callback in self.callbacks:
 
         # --- This type of code results in infinit recursion ---
         #          for callback in self.callbacks:
         #             callback()
         if debug: self.hass.log('{}announce_to_callbacks'.format(self.prefix()), level='ERROR')
-        try:
-          self.hass.run_in(callback, 0)
-        except Exception as e:
-          raise ValueError("Error: name={} id={} e={}".format(__name__, self.id, e))
+        self.queue.post(callback)
+
+
+  # Falling edge of an only_posedge pulse
+  def posedge_callback(self, kwargs):
+    if debug: self.hass.log('{}Posedge callback'.format(self.prefix()), level='INFO')
+    self.pulse = False
+    self.announce_to_callbacks(False)
 
-      self.status = old_status
   
   # Function called from super object to register a callback function
   def add_callback(self, callback):
@@ -510,6 +848,8 @@ class Condition:
       if self.entity != None:
         dot += self.entity + self.operator.get_dot(self)
         # operator=None, stability_time=None
+      elif self.fsm != None:
+        dot += self.fsm.id + self.operator.get_dot(self)
       if self.timeout_time1 != None:
         dot += '#' + str(self.timeout_time1) + 's'
       if self.timeout_time2 != None:
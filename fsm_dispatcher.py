@@ -0,0 +1,87 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import fsm_cache
+import fsm_queue
+import fsm_shared
+
+debug = False
+
+
+# Function to get the dispatcher shared by all objects using this hass
+def get_dispatcher(hass):
+  return fsm_shared.get_shared(hass, EntityDispatcher)
+
+
+class EntityDispatcher:
+  # Registers one listen_state per (entity, attribute) pair in Home Assistant, and routes
+  # each change to all subscribers of that pair. The callback volume seen by AppDaemon then
+  # grows with the number of distinct entities, not with the number of conditions.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'EntityDispatcher : '
+
+  def __init__(self, hass):
+    self.hass = hass
+    self.queue = fsm_queue.get_event_queue(hass)
+    self.cache = fsm_cache.get_entity_cache(hass)
+    # (entity, attribute) -> list of callbacks, in subscription order
+    self.index = {}
+    # (entity, attribute) -> handle returned by listen_state
+    self.handles = {}
+
+  # Subscribe callback to changes of entity (or of one of its attributes). The callback has
+  # the same signature as a listen_state callback. Returns a key used to unsubscribe.
+  def subscribe(self, callback, entity, attribute=None):
+    key = fsm_cache.state_key(entity, attribute)
+    attribute = key[1]
+    callbacks = self.index.get(key)
+    if callbacks is None:
+      callbacks = self.index[key] = []
+      if debug: self.hass.log('{}listen_state entity={} attribute={}'.format(self.prefix(), entity, attribute), level='INFO')
+      if attribute is None:
+        self.handles[key] = self.hass.listen_state(self.state_callback, entity)
+      else:
+        self.handles[key] = self.hass.listen_state(self.state_callback, entity, attribute=attribute)
+      self.cache.track(key)
+    callbacks.append(callback)
+    return key
+
+  # Remove a subscription. The listener in Home Assistant is cancelled with the last subscriber
+  def unsubscribe(self, callback, key):
+    key = fsm_cache.state_key(*key)
+    callbacks = self.index.get(key)
+    if not callbacks or callback not in callbacks:
+      return
+    callbacks.remove(callback)
+    if not callbacks:
+      del self.index[key]
+      self.cache.forget(key)
+      handle = self.handles.pop(key, None)
+      if handle is not None:
+        if debug: self.hass.log('{}cancel_listen_state entity={} attribute={}'.format(self.prefix(), key[0], key[1]), level='INFO')
+        self.hass.cancel_listen_state(handle)
+
+  # The only callback registered in Home Assistant. Fans out to the subscribers of the pair
+  def state_callback(self, entity, attribute, old, new, kwargs):
+    key = fsm_cache.state_key(entity, attribute)
+    self.cache.update(key, new)
+    callbacks = self.index.get(key)
+    if debug: self.hass.log('{}state_callback entity={} attribute={} subscribers={}'.format(self.prefix(), entity, attribute, len(callbacks) if callbacks else 0), level='INFO')
+    if callbacks:
+      # All subscribers see the change before the queued checks run
+      with self.queue:
+        # Copy, since subscribers may subscribe or unsubscribe while being called
+        for callback in tuple(callbacks):
+          try:
+            callback(entity, attribute, old, new, kwargs)
+          except Exception as e:
+            self.hass.log('{}callback {} failed e={}'.format(self.prefix(), callback, e), level='ERROR')
+
+  # Number of listeners registered in Home Assistant
+  def listener_count(self):
+    return len(self.handles)
+
+  # Number of subscribers across all listeners
+  def subscriber_count(self):
+    return sum(len(callbacks) for callbacks in self.index.values())
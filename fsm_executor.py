@@ -0,0 +1,181 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import concurrent.futures
+import time
+from collections import deque
+
+import fsm_timer
+
+debug = False
+
+
+# Helper function to name a program in log messages
+def program_name(program):
+  return getattr(program, '__name__', program)
+
+
+class InlineExecutor:
+  # Runs programs directly, in the callback making the transition. This is the default, and
+  # the transition is only finished when all its programs have returned.
+
+  def run(self, fsm, owner, programs):
+    metrics = fsm.metrics
+    for program in programs:
+      if metrics is None:
+        program.program(owner)
+      else:
+        started = time.perf_counter()
+        try:
+          program.program(owner)
+        finally:
+          metrics.program(owner, time.perf_counter() - started)
+
+
+# The executor used by machines created without one
+inline = InlineExecutor()
+
+
+class Job:
+  # One program to run for a machine
+  __slots__ = ('fsm', 'owner', 'program', 'timer', 'started', 'elapsed', 'error', 'done', 'timed_out')
+
+  def __init__(self, fsm, owner, program):
+    self.fsm = fsm
+    self.owner = owner
+    self.program = program
+    self.timer = None
+    self.started = None
+    self.elapsed = None
+    self.error = None
+    self.done = False
+    self.timed_out = False
+
+
+class ThreadExecutor:
+  # Runs programs on a bounded pool of worker threads, so a slow program does not hold up the
+  # transitions of its own or other machines. Programs of one machine run one at a time, in the
+  # order of the transitions; programs of different machines run in parallel. Completion is
+  # handled back in an AppDaemon callback, where the completion callback is called and the
+  # next program of the machine is started.
+  #
+  # A program still running after timeout seconds is reported. The machine keeps waiting for it, so
+  # its programs never overlap, unless move_on is set; then the next program of the machine is started
+  # at once. A thread cannot be stopped, so the program keeps its worker until it returns.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'ThreadExecutor : '
+
+  def __init__(self, hass, workers=4, timeout=None, callback=None, move_on=False):
+    # - workers is the number of worker threads, shared by all machines using this executor
+    # - timeout is the optional number of seconds a program may run before it is reported
+    # - callback is an optional function called as callback(kwargs) when a program has finished, or with move_on when it timed out.
+    #   kwargs has fsm, owner (the State or Transition), program, error (None or the exception), elapsed (seconds) and timed_out
+    # - move_on can be set to True to start the next program of the machine when a program times out, while it still runs
+    self.hass = hass
+    self.timers = fsm_timer.get_timing_wheel(hass)
+    self.timeout = timeout
+    self.callback = callback
+    self.move_on = move_on
+    self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fsm_program')
+    # Per machine; the programs waiting, and the program running
+    self.pending = {}
+    self.running = {}
+    self.submitted = 0
+    self.completed = 0
+    self.failed = 0
+    self.timed_out = 0
+
+
+  # Queue programs of owner (a State or Transition of fsm). Returns at once
+  def run(self, fsm, owner, programs):
+    if not programs:
+      return
+    queue = self.pending.get(fsm)
+    if queue is None:
+      queue = self.pending[fsm] = deque()
+    for program in programs:
+      queue.append(Job(fsm, owner, program))
+      self.submitted += 1
+    if fsm not in self.running:
+      self.start_next(fsm)
+
+
+  # Start the next program of fsm, if any
+  def start_next(self, fsm):
+    queue = self.pending.get(fsm)
+    if not queue:
+      self.pending.pop(fsm, None)
+      self.running.pop(fsm, None)
+      return
+    job = self.running[fsm] = queue.popleft()
+    if debug: self.hass.log('{}start {} {}'.format(self.prefix(), fsm.id, program_name(job.program)), level='INFO')
+    if self.timeout:
+      job.timer = self.timers.run_in(self.timeout_callback, self.timeout, job=job)
+    job.started = time.monotonic()
+    self.pool.submit(self.work, job)
+
+
+  # Runs in a worker thread. Only touches the job, and hands it back through run_in
+  def work(self, job):
+    try:
+      job.program.program(job.owner)
+    except Exception as e:
+      job.error = e
+    job.elapsed = time.monotonic() - job.started
+    self.hass.run_in(self.done_callback, 0, job=job)
+
+
+  def done_callback(self, kwargs):
+    job = kwargs['job']
+    if job.done:
+      # The machine moved on when it timed out
+      return
+    if job.timer is not None:
+      self.timers.cancel_timer(job.timer)
+      job.timer = None
+    if job.error is not None:
+      self.failed += 1
+      self.hass.log('{}{} program {} failed e={}'.format(self.prefix(), job.fsm.id, program_name(job.program), job.error), level='ERROR')
+    self.completed += 1
+    self.finish(job, False)
+
+
+  def timeout_callback(self, kwargs):
+    job = kwargs['job']
+    if job.done:
+      return
+    job.timer = None
+    job.timed_out = True
+    self.timed_out += 1
+    if self.move_on:
+      self.hass.log('{}{} program {} still running after {}s, starting the next program'.format(self.prefix(), job.fsm.id, program_name(job.program), self.timeout), level='WARNING')
+      self.finish(job, True)
+    else:
+      self.hass.log('{}{} program {} still running after {}s'.format(self.prefix(), job.fsm.id, program_name(job.program), self.timeout), level='WARNING')
+
+
+  def finish(self, job, moved_on):
+    job.done = True
+    elapsed = job.elapsed if not moved_on else time.monotonic() - job.started
+    if job.fsm.metrics is not None:
+      job.fsm.metrics.program(job.owner, elapsed)
+    if self.callback:
+      try:
+        self.callback({'fsm': job.fsm, 'owner': job.owner, 'program': job.program, 'error': job.error,
+                       'elapsed': elapsed, 'timed_out': job.timed_out})
+      except Exception as e:
+        self.hass.log('{}completion callback failed e={}'.format(self.prefix(), e), level='ERROR')
+    if self.running.get(job.fsm) is job:
+      del self.running[job.fsm]
+      self.start_next(job.fsm)
+
+
+  # Number of programs waiting or running
+  def backlog(self):
+    return sum(len(queue) for queue in self.pending.values()) + len(self.running)
+
+
+  # Stop the worker threads, after the programs already started have returned
+  def shutdown(self):
+    self.pool.shutdown(wait=True)
@@ -1,8 +1,20 @@
 
 # Finite state machine class for AppDaemon (Home Assistant).
 
+import time
 from urllib.parse import quote
-from datetime import datetime, timedelta
+from datetime import timedelta
+
+import fsm_cache
+import fsm_dispatcher
+import fsm_executor
+import fsm_metrics
+import fsm_publish
+import fsm_queue
+import fsm_snapshot
+import fsm_table
+import fsm_timer
+import fsm_trace
 
 debug = False
 
@@ -13,61 +25,219 @@ class Fsm:
   def prefix(self):
     return '{} : '.format(self.id)
   
-  def __init__(self, hass, id='', states=None, entity=None):
+  def __init__(self, hass, id='', states=None, entity=None, lazy=False, publish_delay=0, executor=None, watchdog=True, start=True, trace=256, metrics=True, checkpoint=None):
     # - id is optional but useful for debugging
     # - states is a required list of; State objects
     # - entity is an optional hass entity where the current state is published
+    # - lazy can be set to True to only listen to entities, and run stability timers and time schedules, for the transitions of the current state
+    # - publish_delay is the optional number of seconds the state may wait before it is written to entity. Writes of all machines within the delay are combined
+    # - executor is an optional object running the programs, like fsm_executor.ThreadExecutor. Default is to run them inline
+    # - watchdog can be set to False when the machine is watched by someone else, like an FsmRuntime
+    # - start can be set to False to create the machine without starting it. It is then started with start()
+    # - trace is the number of records kept in the trace of the machine (see fsm_trace), or 0 to keep none
+    # - metrics can be set to False to keep no counters and histograms for the machine (see fsm_metrics)
+    # - checkpoint is an optional fsm_checkpoint.Checkpoint. The machine is saved in it, and started from what was saved
     
     self.hass = hass
+    self.dispatcher = fsm_dispatcher.get_dispatcher(hass)
+    self.timers = fsm_timer.get_timing_wheel(hass)
+    self.queue = fsm_queue.get_event_queue(hass)
+    self.publisher = fsm_publish.get_publisher(hass)
+    self.snapshot = fsm_snapshot.get_snapshot(hass)
+    # Entity values kept current by the listeners of all machines, readable by programs
+    self.cache = fsm_cache.get_entity_cache(hass)
     self.id = id
     self.states = states
     self.entity = entity
+    self.lazy = lazy
+    self.publish_delay = publish_delay
+    self.executor = executor or fsm_executor.inline
+    self.state = None
+    self.callbacks = []
+    self.trace = fsm_trace.Trace(trace, clock=self.clock) if trace else None
+    self.metrics = fsm_metrics.get_registry(hass).add(self) if metrics else None
+    self.checkpoint = checkpoint
+    # Condition id -> saved timers and posedge memory, while starting from a checkpoint
+    self.restored = None
+    if checkpoint:
+      checkpoint.add(self)
+    self.use_watchdog = watchdog
+    self.watchdog_handle = None
+    self.feed_handle = None
+    self.started = False
+    self.terminated = False
+
+    if start:
+      self.initialize2({})
+
 
-    self.initialize2({})
+  # Start a machine created with start=False
+  def start(self):
+    if not self.started:
+      self.initialize2({})
         
 
   def initialize2(self, kwargs):
-    self.state = None
+    # Transitions found true while initializing are run when everything is initialized.
+    # The entities are read in one bulk snapshot, shared by machines started together
+    with self.queue, self.snapshot:
+      self.state = None
     
-    self.watchdog_handle = None
-    self.feed()
+      self.watchdog_handle = None
+      if self.use_watchdog:
+        self.feed()
 
-    self.states_dict = {}
-    for state in self.states:
-      #      self.hass.log('{}State : {}'.format(self.prefix(), state.id), level='INFO')
-      self.states_dict[state.id] = state
+      self.states_dict = {}
+      for state in self.states:
+        #      self.hass.log('{}State : {}'.format(self.prefix(), state.id), level='INFO')
+        self.states_dict[state.id] = state
+      # Integer-indexed tables used for dispatch, compiled before the conditions start announcing
+      self.table = fsm_table.FsmTable(self.states)
+
+      saved = self.checkpoint.get(self.id) if self.checkpoint else None
+      if saved and saved.get('state') in self.states_dict:
+        self.state = self.states_dict[saved['state']]
+        self.restored = saved.get('conditions') or {}
+        self.hass.log('{}Restored state {} from checkpoint'.format(self.prefix(), saved['state']), level='INFO')
     
-    if self.entity:
-      # Try loading the state from Home Assistant.
-      entity_state = self.hass.get_state(self.entity)
-      assert entity_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
+      if self.entity:
+        # Try loading the state from Home Assistant.
+        entity_state = self.snapshot.get_state(self.entity)
+        assert entity_state, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
       
-      if entity_state in {state.id for key,state in self.states_dict.items()}:
-        self.state = self.states_dict[entity_state]
-      else:
-        self.hass.log('{}Unrecognized state: {}'.format(self.prefix(), entity_state), level='WARNING')
+        if self.restored is not None:
+          pass
+        elif entity_state in {state.id for key,state in self.states_dict.items()}:
+          self.state = self.states_dict[entity_state]
+        else:
+          self.hass.log('{}Unrecognized state: {}'.format(self.prefix(), entity_state), level='WARNING')
 
-      # Listen for state changes initiated in Home Assistant.
-      temp = self.hass.get_state(self.entity)
-      assert temp, ('Entity not found: {} {} {}'.format(__name__, self.id, self.entity))
-      
-      #      self.hass.log('{}Added listen_state <{}> <{}>'.format(self.prefix(), self.entity, self.external_state_callback), level='INFO')
-      self.hass.listen_state(self.external_state_callback, self.entity)
+        # Listen for state changes initiated in Home Assistant.
+        #      self.hass.log('{}Added listen_state <{}> <{}>'.format(self.prefix(), self.entity, self.external_state_callback), level='INFO')
+        self.dispatcher.subscribe(self.external_state_callback, self.entity)
 
-    if not self.state:
-      self.state = list(self.states)[0]
-      self.hass.log('{}Initial state unset - using {}'.format(self.prefix(), self.state.id), level='INFO')
+      if not self.state:
+        self.state = list(self.states)[0]
+        self.hass.log('{}Initial state unset - using {}'.format(self.prefix(), self.state.id), level='INFO')
 
-      #    self.hass.log('{}Initializing'.format(self.prefix()), level='INFO')
-    for index, state in enumerate(self.states):
-      state.initialize(self.hass, self, index)
-      #    self.hass.log('{}Initializing DONE'.format(self.prefix()), level='INFO')
+        #    self.hass.log('{}Initializing'.format(self.prefix()), level='INFO')
+      for index, state in enumerate(self.states):
+        state.initialize(self.hass, self, index)
+        #    self.hass.log('{}Initializing DONE'.format(self.prefix()), level='INFO')
       
-    #    self.hass.log('{} initial state set to {}'.format(self.prefix(), self.state.id), level='INFO')
-    self.change_state(self.state)
-    self.state.activate()
+      #    self.hass.log('{} initial state set to {}'.format(self.prefix(), self.state.id), level='INFO')
+      self.change_state(self.state)
+      self.state.activate()
+      self.started = True
+      if self.restored is not None:
+        # The saved timers are only used by the first activation
+        self.restored = None
+        for state in self.states:
+          for transition in state.transitions or ():
+            for condition in transition.conditions:
+              condition.saved = None
+
+    if self.use_watchdog:
+      self.feed_handle = self.timers.run_every(self.feed_callback, self.timers.now()+timedelta(seconds=3), 60)
+
+
+  # Replace the states of a running machine with a new definition. A condition with the same arguments, in a
+  # state with the same id and a transition to the same next state, is kept with its listeners, timers and status.
+  # Other conditions are started or stopped. The machine stays in the state with the same id, without running
+  # programs. Returns the number of conditions kept, added and removed
+  def reload(self, states):
+    started = time.perf_counter()
+    keys = {state: key for key, state in self.states_dict.items()}
+    # (state id, next state id) -> running conditions not matched yet
+    pool = {}
+    for state in self.states:
+      for transition in state.transitions or ():
+        for condition in transition.conditions:
+          pool.setdefault((keys.get(state), transition.next_state_name), []).append(condition)
+
+    kept = set()
+    added = 0
+    for state in states:
+      for transition in state.transitions or ():
+        candidates = pool.get((state.id, transition.next_state_name)) or []
+        for index, condition in enumerate(transition.conditions):
+          spec = condition.spec()
+          for old in candidates:
+            if old.spec() == spec:
+              candidates.remove(old)
+              if condition.id:
+                old.id = condition.id
+              transition.conditions[index] = old
+              kept.add(old)
+              break
+          else:
+            added += 1
+    removed = [condition for candidates in pool.values() for condition in candidates]
 
-    self.hass.run_every(self.feed_callback, datetime.now()+timedelta(seconds=3), 60)
+    current = keys.get(self.state)
+    # The new conditions read their entities from one snapshot
+    with self.queue, self.snapshot:
+      self.states = states
+      self.states_dict = {}
+      for state in self.states:
+        self.states_dict[state.id] = state
+      self.table = fsm_table.FsmTable(self.states)
+      for index, state in enumerate(self.states):
+        state.initialize(self.hass, self, index)
+
+      state = self.states_dict.get(current)
+      if state is None:
+        self.hass.log('{}State {} removed by reload, using {}'.format(self.prefix(), current, self.states[0].name), level='WARNING')
+        self.change_state(self.states[0])
+        self.state.activate()
+      else:
+        # Kept conditions of the current state are already active
+        self.state = state
+        for transition in state.transitions or ():
+          transition.status = transition.last_status = None
+          for condition in transition.conditions:
+            if condition not in kept:
+              condition.activate()
+          transition.check()
+
+      # After the new conditions subscribed, lazy ones included, so entities still used keep their listener in AppDaemon
+      for condition in removed:
+        condition.deactivate()
+        condition.detach()
+
+    self.hass.log('{}Reloaded in {:.1f} ms; {} conditions kept, {} added, {} removed'.format(
+      self.prefix(), (time.perf_counter() - started) * 1000, len(kept), added, len(removed)), level='INFO')
+    return len(kept), added, len(removed)
+
+
+  # Stop the machine for good. Listeners, timers and the watchdog are removed, and the state is left as it is
+  def terminate(self):
+    if not self.started or self.terminated:
+      return
+    self.terminated = True
+    with self.queue:
+      for state in self.states:
+        for transition in state.transitions or ():
+          for condition in transition.conditions:
+            condition.deactivate()
+            condition.detach()
+      if self.entity:
+        self.dispatcher.unsubscribe(self.external_state_callback, (self.entity, None))
+      self.stop_watchdog()
+    fsm_metrics.get_registry(self.hass).remove(self)
+    if self.checkpoint:
+      self.checkpoint.remove(self)
+
+
+  # Stop the feed and watchdog timers of this machine
+  def stop_watchdog(self):
+    self.use_watchdog = False
+    if self.feed_handle != None:
+      self.timers.cancel_timer(self.feed_handle)
+      self.feed_handle = None
+    if self.watchdog_handle != None:
+      self.timers.cancel_timer(self.watchdog_handle)
+      self.watchdog_handle = None
 
 
   def feed_callback(self, kwargs):
@@ -77,16 +247,29 @@ class Fsm:
   def feed(self):
     #    self.hass.log("{} Feed".format(self.prefix()), level='ERROR')
     if self.watchdog_handle != None:
-      self.hass.cancel_timer(self.watchdog_handle)
+      self.timers.cancel_timer(self.watchdog_handle)
       self.watchdog_handle = None
             
-    self.watchdog_handle = self.hass.run_in(self.watchdog, 120)
+    self.watchdog_handle = self.timers.run_in(self.watchdog, 120)
 
 
   def watchdog(self, kwargs):
     self.hass.log("{} Bark!".format(self.prefix()), level='ERROR')
+    self.log_trace(level='ERROR')
+
+
+  # Function to log the last n records of the trace
+  def log_trace(self, n=20, level='INFO'):
+    if self.trace is not None:
+      for line in self.trace.dump(n):
+        self.hass.log('{}{}'.format(self.prefix(), line), level=level)
 
     
+  # Seconds since the epoch, as seen by AppDaemon. Stamps the trace records, so they follow time travel and virtual clocks
+  def clock(self):
+    return self.timers.now().timestamp()
+
+
   # Function to find an object with certain id
   def find_state(self, state_name):
     if state_name in self.states_dict:
@@ -97,12 +280,33 @@ class Fsm:
 
 
   def change_state(self, state):
+    old_state = self.state
     self.state = state
+    if self.trace is not None:
+      self.trace.add(fsm_trace.STATE, state.name, old_state.name if old_state else None)
+    if self.metrics is not None:
+      self.metrics.entered(state)
     if self.entity:
+      # Written after the event is processed, so only the settled state of a cascade reaches Home Assistant
+      self.publisher.publish(self.entity, self.state.name, self.publish_delay)
+
+    # A copy, since callbacks may add or remove callbacks
+    for callback in tuple(self.callbacks):
       try:
-        self.hass.set_state(self.entity, state=self.state.name)
+        callback({'fsm': self, 'old': old_state, 'new': state})
       except Exception as e:
-        self.hass.log('{}set_state cannot find self.state.name = {}'.format(self.prefix(), self.state.name), level='ERROR')
+        self.hass.log('{}state change callback {} failed e={}'.format(self.prefix(), callback, e), level='ERROR')
+
+
+  # Function to register a callback function, called with kwargs fsm, old and new (State objects) when the state changes
+  def add_callback(self, callback):
+    self.callbacks.append(callback)
+
+
+  # Function to remove a callback function registered with add_callback
+  def remove_callback(self, callback):
+    if callback in self.callbacks:
+      self.callbacks.remove(callback)
         
 
   # Call check when something happened
@@ -0,0 +1,229 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import bisect
+import os
+
+import fsm_shared
+import fsm_timer
+
+debug = False
+
+# Upper bounds in seconds of the histogram buckets. The last bucket (+Inf) is implicit
+buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Function to get the metrics registry shared by all machines using this hass
+def get_registry(hass):
+  return fsm_shared.get_shared(hass, MetricsRegistry)
+
+
+# Helper function to quote a label value in the text format
+def quote_label(value):
+  return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+# Helper function to format the labels of a sample
+def format_labels(labels):
+  return '{' + ','.join('{}={}'.format(name, quote_label(value)) for name, value in labels) + '}'
+
+
+class Histogram:
+  # Counts of observed values per bucket, with their sum
+  __slots__ = ('counts', 'sum', 'count')
+
+  def __init__(self):
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  # Lines of the histogram in the text format
+  def lines(self, name, labels):
+    lines = []
+    total = 0
+    for bound, count in zip(buckets + ('+Inf',), self.counts):
+      total += count
+      lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), total))
+    lines.append('{}_sum{} {}'.format(name, format_labels(labels), self.sum))
+    lines.append('{}_count{} {}'.format(name, format_labels(labels), self.count))
+    return lines
+
+
+class FsmMetrics:
+  # Counters and histograms of one machine. Updated by the machine as it runs; the timers and
+  # listeners of the machine are counted when the metrics are read
+
+  def __init__(self, fsm):
+    self.fsm = fsm
+    # Callbacks received by the conditions; entity changes and timers
+    self.events = 0
+    # Operator evaluations of the conditions
+    self.evaluations = 0
+    self.transitions = 0
+    # Transition id -> number of times fired
+    self.transition_counts = {}
+    # State id -> number of times entered
+    self.state_counts = {}
+    # Seconds from the start of the event to the transition
+    self.latency = Histogram()
+    # State or Transition id -> Histogram of the seconds its programs ran
+    self.programs = {}
+
+
+  def transition(self, transition, latency):
+    self.transitions += 1
+    self.transition_counts[transition.id] = self.transition_counts.get(transition.id, 0) + 1
+    if latency is not None:
+      self.latency.observe(latency)
+
+
+  def entered(self, state):
+    self.state_counts[state.id] = self.state_counts.get(state.id, 0) + 1
+
+
+  def program(self, owner, elapsed):
+    histogram = self.programs.get(owner.id)
+    if histogram is None:
+      histogram = self.programs[owner.id] = Histogram()
+    histogram.observe(elapsed)
+
+
+  # All conditions of the machine
+  def conditions(self):
+    for state in self.fsm.states:
+      for transition in state.transitions or ():
+        for condition in transition.conditions:
+          yield condition
+
+
+  # Number of armed timers of the conditions
+  def timers(self):
+    count = 0
+    for condition in self.conditions():
+      for handle in (condition.timer_handle, condition.stability_handle, condition.time_handle):
+        if handle is not None:
+          count += 1
+    return count
+
+
+  # Number of subscriptions of the conditions, to entities or other machines
+  def listeners(self):
+    count = 0
+    for condition in self.conditions():
+      if condition.attached:
+        for subscribed in (condition.entity, condition.fsm, condition.timeout_entity, condition.enabled_entity):
+          if subscribed is not None:
+            count += 1
+    return count
+
+
+  # The metrics as a dict
+  def stats(self):
+    return {
+      'state': self.fsm.state.name if self.fsm.state else None,
+      'events': self.events,
+      'evaluations': self.evaluations,
+      'transitions': self.transitions,
+      'transition_counts': dict(self.transition_counts),
+      'state_counts': dict(self.state_counts),
+      'latency_count': self.latency.count,
+      'latency_sum': self.latency.sum,
+      'program_count': sum(histogram.count for histogram in self.programs.values()),
+      'program_sum': sum(histogram.sum for histogram in self.programs.values()),
+      'timers': self.timers(),
+      'listeners': self.listeners(),
+    }
+
+
+class MetricsRegistry:
+  # The metrics of all machines using one hass, readable as dicts or in the Prometheus text format.
+  # The text can be written to a file, for example for the textfile collector of node_exporter
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'MetricsRegistry : '
+
+  def __init__(self, hass):
+    self.hass = hass
+    self.timers = fsm_timer.get_timing_wheel(hass)
+    # Fsm -> FsmMetrics, in the order the machines were created
+    self.machines = {}
+    self.export_handle = None
+
+
+  def add(self, fsm):
+    metrics = self.machines[fsm] = FsmMetrics(fsm)
+    return metrics
+
+
+  def remove(self, fsm):
+    self.machines.pop(fsm, None)
+
+
+  # Fsm id -> metrics as a dict
+  def stats(self):
+    return {fsm.id: metrics.stats() for fsm, metrics in self.machines.items()}
+
+
+  # All metrics in the Prometheus text format
+  def render(self):
+    families = [
+      ('fsm_events_total', 'counter', 'Callbacks received by the conditions of the machine', []),
+      ('fsm_condition_evaluations_total', 'counter', 'Operator evaluations of the conditions of the machine', []),
+      ('fsm_transitions_total', 'counter', 'Transitions fired', []),
+      ('fsm_state_entered_total', 'counter', 'Times a state was entered', []),
+      ('fsm_state', 'gauge', 'Current state of the machine', []),
+      ('fsm_timers', 'gauge', 'Armed timers of the conditions of the machine', []),
+      ('fsm_listeners', 'gauge', 'Subscriptions of the conditions of the machine', []),
+      ('fsm_transition_latency_seconds', 'histogram', 'Seconds from the start of handling an event to a transition', []),
+      ('fsm_program_seconds', 'histogram', 'Seconds the programs of a state or transition ran', []),
+    ]
+    lines = dict((name, samples) for name, kind, help, samples in families)
+    for fsm, metrics in self.machines.items():
+      machine = (('fsm', fsm.id),)
+      lines['fsm_events_total'].append('fsm_events_total{} {}'.format(format_labels(machine), metrics.events))
+      lines['fsm_condition_evaluations_total'].append('fsm_condition_evaluations_total{} {}'.format(format_labels(machine), metrics.evaluations))
+      for id, count in metrics.transition_counts.items():
+        lines['fsm_transitions_total'].append('fsm_transitions_total{} {}'.format(format_labels(machine + (('transition', id),)), count))
+      for id, count in metrics.state_counts.items():
+        lines['fsm_state_entered_total'].append('fsm_state_entered_total{} {}'.format(format_labels(machine + (('state', id),)), count))
+      if fsm.state is not None:
+        lines['fsm_state'].append('fsm_state{} 1'.format(format_labels(machine + (('state', fsm.state.name),))))
+      lines['fsm_timers'].append('fsm_timers{} {}'.format(format_labels(machine), metrics.timers()))
+      lines['fsm_listeners'].append('fsm_listeners{} {}'.format(format_labels(machine), metrics.listeners()))
+      lines['fsm_transition_latency_seconds'].extend(metrics.latency.lines('fsm_transition_latency_seconds', machine))
+      for id, histogram in metrics.programs.items():
+        lines['fsm_program_seconds'].extend(histogram.lines('fsm_program_seconds', machine + (('owner', id),)))
+
+    text = []
+    for name, kind, help, samples in families:
+      text.append('# HELP {} {}'.format(name, help))
+      text.append('# TYPE {} {}'.format(name, kind))
+      text.extend(samples)
+    return '\n'.join(text) + '\n'
+
+
+  # Write the text format to path. Written to a temporary file first, so a reader never sees half a file
+  def write(self, path):
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as file:
+      file.write(self.render())
+    os.replace(temp, path)
+
+
+  # Write the text format to path every interval seconds
+  def export(self, path, interval=60):
+    if self.export_handle is not None:
+      self.timers.cancel_timer(self.export_handle)
+    self.export_handle = self.timers.run_every(self.export_callback, 'now', interval, path=path)
+
+
+  def export_callback(self, kwargs):
+    try:
+      self.write(kwargs['path'])
+    except Exception as e:
+      self.hass.log('{}cannot write {} e={}'.format(self.prefix(), kwargs['path'], e), level='ERROR')
@@ -0,0 +1,152 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import heapq
+from datetime import datetime, timedelta
+
+
+class MockHass:
+  # In-memory stand-in for the part of hassapi used by ha-fsm, running on a virtual clock.
+  # Makes it possible to run machines without AppDaemon, for benchmarks and replays.
+  # Time only moves when advance() or run_until() is called; timers due are then run in order.
+
+  def __init__(self, now=None, states=None, verbose=False):
+    # - now is the start time of the virtual clock, default 2024-01-01 00:00:00
+    # - states is an optional dict of entity -> state to start with
+    # - verbose can be set to True to print log messages with level WARNING and ERROR
+    self.now = now or datetime(2024, 1, 1)
+    self.verbose = verbose
+    self.states = {}
+    self.listeners = {}
+    self.entity_listeners = {}
+    self.timers = []
+    self.timer_callbacks = {}
+    self.handle_count = 0
+    self.logs = []
+    # Number of calls to each hassapi function
+    self.calls = {'get_state': 0, 'set_state': 0, 'listen_state': 0, 'cancel_listen_state': 0, 'run_in': 0, 'run_every': 0, 'cancel_timer': 0, 'callbacks': 0}
+
+    if states:
+      for entity, state in states.items():
+        self.states[entity] = {'entity_id': entity, 'state': state, 'attributes': {}}
+
+  def new_handle(self):
+    self.handle_count += 1
+    return self.handle_count
+
+
+  def log(self, msg, level='INFO'):
+    self.logs.append((self.now, level, msg))
+    if self.verbose and level in ('WARNING', 'ERROR'):
+      print('{} {} {}'.format(self.now, level, msg))
+
+
+  def datetime(self, aware=False):
+    return self.now
+
+
+  def get_state(self, entity_id=None, attribute=None, default=None, **kwargs):
+    self.calls['get_state'] += 1
+    if entity_id is None:
+      return {entity: {'entity_id': entity, 'state': state['state'], 'attributes': dict(state['attributes'])} for entity, state in self.states.items()}
+    state = self.states.get(entity_id)
+    if state is None:
+      return default
+    if attribute == 'all':
+      return {'entity_id': entity_id, 'state': state['state'], 'attributes': dict(state['attributes'])}
+    if attribute is not None and attribute != 'state':
+      return state['attributes'].get(attribute, default)
+    return state['state']
+
+
+  def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+    self.calls['set_state'] += 1
+    old = self.states.get(entity_id)
+    if old is None:
+      old = {'entity_id': entity_id, 'state': None, 'attributes': {}}
+    new = {'entity_id': entity_id, 'state': old['state'] if state is None else state, 'attributes': dict(old['attributes'])}
+    if attributes:
+      new['attributes'].update(attributes)
+    self.states[entity_id] = new
+
+    # Run listeners of the entity whose state or attribute changed, like AppDaemon
+    for handle in tuple(self.entity_listeners.get(entity_id, ())):
+      listener = self.listeners.get(handle)
+      if listener is None:
+        continue
+      callback, attribute, kwargs = listener
+      if attribute is None or attribute == 'state':
+        # AppDaemon calls back with attribute 'state' for a listener of the entity
+        attribute = 'state'
+        old_value, new_value = old['state'], new['state']
+      else:
+        old_value, new_value = old['attributes'].get(attribute), new['attributes'].get(attribute)
+      if old_value != new_value:
+        self.calls['callbacks'] += 1
+        callback(entity_id, attribute, old_value, new_value, kwargs)
+    return new
+
+
+  def listen_state(self, callback, entity=None, attribute=None, **kwargs):
+    self.calls['listen_state'] += 1
+    handle = self.new_handle()
+    self.listeners[handle] = (callback, attribute, kwargs)
+    self.entity_listeners.setdefault(entity, []).append(handle)
+    return handle
+
+
+  def cancel_listen_state(self, handle):
+    self.calls['cancel_listen_state'] += 1
+    if self.listeners.pop(handle, None) is not None:
+      for handles in self.entity_listeners.values():
+        if handle in handles:
+          handles.remove(handle)
+          break
+
+
+  def run_in(self, callback, delay, **kwargs):
+    self.calls['run_in'] += 1
+    return self.schedule(self.now + timedelta(seconds=delay), None, callback, kwargs)
+
+
+  def run_every(self, callback, start, interval, **kwargs):
+    self.calls['run_every'] += 1
+    if start == 'now':
+      start = self.now
+    return self.schedule(start, interval, callback, kwargs)
+
+
+  def cancel_timer(self, handle):
+    self.calls['cancel_timer'] += 1
+    self.timer_callbacks.pop(handle, None)
+
+
+  def schedule(self, time, interval, callback, kwargs):
+    handle = self.new_handle()
+    self.timer_callbacks[handle] = (interval, callback, kwargs)
+    heapq.heappush(self.timers, (time, handle))
+    return handle
+
+
+  # Move the virtual clock to time, running all timers due on the way
+  def run_until(self, time):
+    while self.timers and self.timers[0][0] <= time:
+      when, handle = heapq.heappop(self.timers)
+      timer = self.timer_callbacks.get(handle)
+      if timer is None:
+        continue
+      interval, callback, kwargs = timer
+      if interval:
+        heapq.heappush(self.timers, (when + timedelta(seconds=interval), handle))
+      else:
+        del self.timer_callbacks[handle]
+      if when > self.now:
+        self.now = when
+      self.calls['callbacks'] += 1
+      callback(kwargs)
+    if time > self.now:
+      self.now = time
+
+
+  # Move the virtual clock forward, running all timers due on the way
+  def advance(self, seconds=0):
+    self.run_until(self.now + timedelta(seconds=seconds))
@@ -0,0 +1,48 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+from datetime import datetime, timedelta
+
+debug = False
+
+
+class StringProgram:
+  # A program given as a python string, compiled once. Runs with the names;
+  # - hass, fsm and state; the hass object, the Fsm and the State entered or exited (for a transition, the state it leaves)
+  # - transition; the Transition, for transition programs
+  # - self; the State or Transition running the program, as when the string was run by exec
+  # - datetime and timedelta
+  # Names assigned by the program are local to one run.
+  __slots__ = ('source', 'code', '__name__')
+
+  def __init__(self, source, code):
+    self.source = source
+    self.code = code
+    self.__name__ = source[:20]
+
+  def program(self, owner):
+    # Only a State has transitions among its slots; programs may add their own attributes to either
+    if hasattr(type(owner), 'transitions'):
+      state, transition = owner, None
+    else:
+      state, transition = owner.state, owner
+    namespace = {'hass': owner.hass, 'fsm': state.fsm, 'state': state, 'transition': transition, 'self': owner,
+                 'datetime': datetime, 'timedelta': timedelta}
+    exec(self.code, namespace)
+
+
+# Function to compile the programs of a State or Transition. Strings are compiled to StringProgram
+# objects, other programs are kept as they are. A program with a syntax error is logged and left out,
+# so it is found when the machine starts and not when the state is entered
+def compile_programs(owner, programs):
+  if not programs:
+    return []
+  compiled = []
+  for program in programs:
+    if type(program) != str:
+      compiled.append(program)
+      continue
+    try:
+      compiled.append(StringProgram(program, compile(program, '<{}>'.format(owner.id), 'exec')))
+    except SyntaxError as e:
+      owner.hass.log('{}program syntax error line {}: {} in {!r}'.format(owner.prefix(), e.lineno, e.msg, program), level='ERROR')
+  return compiled
@@ -0,0 +1,69 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+from datetime import timedelta
+
+import fsm_shared
+
+debug = False
+
+
+# Function to get the publisher shared by all objects using this hass
+def get_publisher(hass):
+  return fsm_shared.get_shared(hass, Publisher)
+
+
+class Publisher:
+  # Coalesces writes of entity states. Only the last state published for an entity before the
+  # flush is written, so a cascade through transient states costs one set_state. The flush runs
+  # in its own AppDaemon callback, after the event that changed the states has been processed,
+  # and writes the entities of all machines together.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'Publisher : '
+
+  def __init__(self, hass):
+    self.hass = hass
+    # entity -> state, in order of first publication
+    self.pending = {}
+    self.handle = None
+    self.flush_time = None
+    # Number of publications, and of set_state calls actually made
+    self.published = 0
+    self.written = 0
+
+
+  # Publish state to entity within delay seconds. Writes to the same entity before the flush replace each other
+  def publish(self, entity, state, delay=0):
+    self.published += 1
+    self.pending[entity] = state
+
+    time = self.hass.datetime() + timedelta(seconds=delay)
+    if self.handle is not None:
+      if self.flush_time <= time:
+        return
+      # Somebody wants it sooner
+      self.hass.cancel_timer(self.handle)
+    self.flush_time = time
+    self.handle = self.hass.run_in(self.flush_callback, delay)
+
+
+  def flush_callback(self, kwargs):
+    self.handle = None
+    self.flush()
+
+
+  # Write all pending states now
+  def flush(self):
+    if self.handle is not None:
+      self.hass.cancel_timer(self.handle)
+      self.handle = None
+    pending = self.pending
+    self.pending = {}
+    for entity, state in pending.items():
+      if debug: self.hass.log('{}set_state {} = {}'.format(self.prefix(), entity, state), level='INFO')
+      try:
+        self.hass.set_state(entity, state=state)
+        self.written += 1
+      except Exception as e:
+        self.hass.log('{}set_state failed entity={} state={} e={}'.format(self.prefix(), entity, state, e), level='ERROR')
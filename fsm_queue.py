@@ -0,0 +1,98 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import time
+from collections import deque
+
+import fsm_shared
+
+debug = False
+
+# Stages, run in this order. A stage is only run when all earlier stages are empty
+TRANSITION = 0  # Transition.check after conditions changed status
+STATE = 1       # State.check after transitions changed status
+DEFERRED = 2    # Work that must see the result of the state checks, like the falling edge of only_posedge
+
+
+# Function to get the event queue shared by all objects using this hass
+def get_event_queue(hass):
+  return fsm_shared.get_shared(hass, EventQueue)
+
+
+class EventQueue:
+  # In-process run-to-completion queue. Callbacks posted while the queue is running, or held
+  # with a 'with' block, are run when the outermost block ends. A callback already pending
+  # in a stage is not added again, so each Transition.check runs once per event and State.check
+  # runs once after all conditions have settled.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'EventQueue : '
+
+  def __init__(self, hass, limit=100000):
+    # - limit is the maximum number of callbacks run for one event. Protects against machines looping forever
+    self.hass = hass
+    self.limit = limit
+    # Per stage; the pending callbacks with their kwargs, and their order
+    self.pending = [{} for stage in range(DEFERRED + 1)]
+    self.order = [deque() for stage in range(DEFERRED + 1)]
+    self.depth = 0
+    # perf_counter when the current event started to be handled
+    self.started = None
+
+
+  # Post callback(kwargs) to be run in stage. Runs the queue unless it is already running or held
+  def post(self, callback, stage=TRANSITION, kwargs=None):
+    pending = self.pending[stage]
+    if callback not in pending:
+      pending[callback] = kwargs
+      self.order[stage].append(callback)
+    if self.depth == 0:
+      self.started = time.perf_counter()
+      self.run()
+
+
+  # Hold the queue while a batch of changes is applied
+  def __enter__(self):
+    if self.depth == 0:
+      self.started = time.perf_counter()
+    self.depth += 1
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.depth -= 1
+    if self.depth == 0:
+      self.run()
+
+
+  # Run callbacks until all stages are empty
+  def run(self):
+    self.depth += 1
+    count = 0
+    try:
+      while True:
+        for stage, order in enumerate(self.order):
+          if order:
+            break
+        else:
+          return
+        count += 1
+        if count > self.limit:
+          self.hass.log('{}more than {} callbacks for one event, dropping the queue. Is a machine looping?'.format(self.prefix(), self.limit), level='ERROR')
+          self.clear()
+          return
+        callback = order.popleft()
+        kwargs = self.pending[stage].pop(callback)
+        if debug: self.hass.log('{}run stage={} callback={}'.format(self.prefix(), stage, callback), level='INFO')
+        try:
+          callback(kwargs)
+        except Exception as e:
+          self.hass.log('{}callback {} failed e={}'.format(self.prefix(), callback, e), level='ERROR')
+    finally:
+      self.depth -= 1
+
+
+  # Drop all pending callbacks
+  def clear(self):
+    for stage in range(DEFERRED + 1):
+      self.pending[stage].clear()
+      self.order[stage].clear()
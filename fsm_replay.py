@@ -0,0 +1,159 @@
+# Replay of recorded Home Assistant state changes into ha-fsm machines, faster than real time.
+#
+# Usage: python fsm_replay.py module:function events [--until 2024-01-08T00:00:00] [--trace trace.csv]
+#
+# module:function is a function taking a hass object and returning the Fsm objects to replay,
+# for example my_machines:build. events is a file with recorded state changes in one of the formats
+# read by load_events. The machines run on the virtual clock of MockHass, so stability_time,
+# timeout_time and time windows fire in virtual time, and a week of events replays in seconds.
+
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from fsm_mock import MockHass
+
+
+# Helper function to parse a time from Home Assistant into a naive local time, like AppDaemon uses
+def parse_time(value):
+  if isinstance(value, datetime):
+    time = value
+  else:
+    time = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+  if time.tzinfo is not None:
+    time = time.astimezone().replace(tzinfo=None)
+  return time
+
+
+# Helper function to convert a state object (as in the REST API and in state_changed events) to an event
+def state_to_event(state, time=None):
+  return (parse_time(time or state.get('last_changed') or state.get('last_updated')),
+          state['entity_id'], state['state'], state.get('attributes') or {})
+
+
+# Function to load recorded state changes, returning a time-sorted list of (time, entity_id, state, attributes).
+# Reads;
+# - state_changed events, as json lines or a json list, as exported from the event bus or the websocket API
+# - history from the REST API /api/history/period, a json list with one list of states per entity
+# - csv exported from the history panel, with the columns entity_id, state and last_changed
+def load_events(path):
+  events = []
+  with open(path, newline='') as file:
+    text = file.read()
+
+  if path.endswith('.csv'):
+    for row in csv.DictReader(text.splitlines()):
+      events.append((parse_time(row['last_changed']), row['entity_id'], row['state'], {}))
+  else:
+    try:
+      records = json.loads(text)
+    except ValueError:
+      records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(records, dict):
+      records = [records]
+
+    for record in records:
+      if isinstance(record, list):
+        # History; a list of states for one entity
+        for state in record:
+          events.append(state_to_event(state))
+      elif 'event_type' in record:
+        if record['event_type'] != 'state_changed':
+          continue
+        new_state = record['data'].get('new_state')
+        if new_state:
+          events.append(state_to_event(new_state, record.get('time_fired')))
+      else:
+        events.append(state_to_event(record))
+
+  events.sort(key=lambda event: event[0])
+  return events
+
+
+class Replay:
+  # Feeds recorded events into machines on a virtual clock and records every state change
+
+  def __init__(self, build, events, start=None):
+    # - build is a function taking a hass object, and returning a list of Fsm objects
+    # - events is a list of (time, entity_id, state, attributes), as returned by load_events
+    # - start is the optional virtual start time. Default is the time of the first event
+    assert events, 'No events to replay'
+    self.events = events
+    self.start = start or events[0][0]
+
+    # The machines start from the first recorded state of each entity
+    states = {}
+    for event_time, entity, state, attributes in events:
+      if entity not in states:
+        states[entity] = {'entity_id': entity, 'state': state, 'attributes': dict(attributes)}
+    self.hass = MockHass(now=self.start)
+    self.hass.states.update(states)
+
+    self.fsms = list(build(self.hass) or [])
+    # (time, fsm id, old state, new state)
+    self.trace = [(self.start, fsm.id, None, fsm.state.name) for fsm in self.fsms]
+    for fsm in self.fsms:
+      fsm.add_callback(self.state_callback)
+    self.elapsed = 0
+
+
+  def state_callback(self, kwargs):
+    old = kwargs['old']
+    self.trace.append((self.hass.now, kwargs['fsm'].id, old.name if old else None, kwargs['new'].name))
+
+
+  # Run all events up to until (default all of them). Returns the trace
+  def run(self, until=None):
+    started = time.perf_counter()
+    for event_time, entity, state, attributes in self.events:
+      if until and event_time > until:
+        break
+      if event_time < self.hass.now:
+        continue
+      self.hass.run_until(event_time)
+      self.hass.set_state(entity, state=state, attributes=attributes)
+    if until:
+      self.hass.run_until(until)
+    self.elapsed += time.perf_counter() - started
+    return self.trace
+
+
+  # Virtual time replayed per second of real time
+  def speedup(self):
+    return (self.hass.now - self.start).total_seconds() / max(self.elapsed, 1e-9)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay recorded Home Assistant state changes into ha-fsm machines')
+  parser.add_argument('build', help='module:function returning the Fsm objects, given a hass object')
+  parser.add_argument('events', help='recorded state changes (state_changed events, REST history or csv)')
+  parser.add_argument('--until', type=parse_time, help='stop at this time, running timers up to it')
+  parser.add_argument('--trace', help='write the transition trace to this csv file instead of printing it')
+  args = parser.parse_args()
+
+  # The module is looked up in the current directory, like python -m does
+  sys.path.insert(0, os.getcwd())
+  module, function = args.build.split(':')
+  build = getattr(importlib.import_module(module), function)
+  replay = Replay(build, load_events(args.events))
+  trace = replay.run(args.until)
+
+  if args.trace:
+    with open(args.trace, 'w', newline='') as file:
+      writer = csv.writer(file)
+      writer.writerow(('time', 'fsm', 'old', 'new'))
+      writer.writerows((event_time.isoformat(), fsm, old, new) for event_time, fsm, old, new in trace)
+  else:
+    for event_time, fsm, old, new in trace:
+      print('{} {} {} -> {}'.format(event_time.isoformat(), fsm, old, new))
+  print('{} events, {} transitions, {} of virtual time in {:.2f} s ({:.0f}x real time)'.format(
+    len(replay.events), len(trace) - len(replay.fsms), replay.hass.now - replay.start, replay.elapsed, replay.speedup()))
+
+
+if __name__ == '__main__':
+  main()
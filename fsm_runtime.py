@@ -0,0 +1,142 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+from datetime import timedelta
+
+import fsm_cache
+import fsm_dispatcher
+import fsm_queue
+import fsm_snapshot
+import fsm_timer
+import fsm_trace
+
+debug = False
+
+
+class FsmRuntime:
+  # Container for many machines created with the same hass. The machines already share one
+  # dispatcher, timing wheel, event queue and entity cache per hass; the runtime adds one
+  # watchdog for all of them instead of a feed and a watchdog timer per machine, starts and
+  # stops machines in bulk, keeps a failing machine from stopping the others, and sums up stats.
+  #
+  # Usage:
+  #   runtime = FsmRuntime(self)
+  #   runtime.add([Fsm(self, id='room{}'.format(n), states=[...], start=False) for n in range(500)])
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'FsmRuntime : '
+
+  def __init__(self, hass, watchdog_time=120):
+    # - watchdog_time is the number of seconds without a feed before the watchdog barks
+    self.hass = hass
+    self.timers = fsm_timer.get_timing_wheel(hass)
+    self.queue = fsm_queue.get_event_queue(hass)
+    self.dispatcher = fsm_dispatcher.get_dispatcher(hass)
+    self.cache = fsm_cache.get_entity_cache(hass)
+    self.snapshot = fsm_snapshot.get_snapshot(hass)
+    self.watchdog_time = watchdog_time
+    # id -> Fsm, in the order they were added
+    self.machines = {}
+    # id -> number of failures
+    self.errors = {}
+    self.transitions = 0
+
+    self.watchdog_handle = None
+    self.feed()
+    self.feed_handle = self.timers.run_every(self.feed_callback, self.timers.now() + timedelta(seconds=3), 60)
+
+
+  def feed_callback(self, kwargs):
+    self.feed()
+
+
+  def feed(self):
+    if self.watchdog_handle != None:
+      self.timers.cancel_timer(self.watchdog_handle)
+    self.watchdog_handle = self.timers.run_in(self.watchdog, self.watchdog_time)
+
+
+  def watchdog(self, kwargs):
+    self.hass.log('{}Bark! {} machines'.format(self.prefix(), len(self.machines)), level='ERROR')
+    self.log_trace(level='ERROR')
+
+
+  # Function to log the last n records of the traces of all machines, merged by time
+  def log_trace(self, n=20, level='INFO'):
+    for line in fsm_trace.merge(self.machines.values(), n):
+      self.hass.log('{}{}'.format(self.prefix(), line), level=level)
+
+
+  # Add and start machines; an Fsm or a list of them, best created with start=False. Machines are started
+  # together, sharing one snapshot of the entities. A machine failing to start is logged and left out.
+  # Returns the machines added
+  def add(self, fsms):
+    if not isinstance(fsms, (list, tuple)):
+      fsms = [fsms]
+    added = []
+    # Transitions found true while starting are run when all machines are started
+    with self.queue, self.snapshot:
+      for fsm in fsms:
+        if fsm.id in self.machines:
+          self.hass.log('{}{} already added'.format(self.prefix(), fsm.id), level='ERROR')
+          continue
+        try:
+          fsm.stop_watchdog()
+          fsm.start()
+        except Exception as e:
+          self.errors[fsm.id] = self.errors.get(fsm.id, 0) + 1
+          self.hass.log('{}{} failed to start e={}'.format(self.prefix(), fsm.id, e), level='ERROR')
+          continue
+        fsm.add_callback(self.state_callback)
+        self.machines[fsm.id] = fsm
+        added.append(fsm)
+    if debug: self.hass.log('{}added {} of {} machines'.format(self.prefix(), len(added), len(fsms)), level='INFO')
+    return added
+
+
+  # Terminate and remove machines; an Fsm, an id or a list of them
+  def remove(self, fsms):
+    if not isinstance(fsms, (list, tuple)):
+      fsms = [fsms]
+    with self.queue:
+      for fsm in fsms:
+        fsm = self.machines.pop(fsm if isinstance(fsm, str) else fsm.id, None)
+        if fsm is None:
+          continue
+        try:
+          fsm.terminate()
+        except Exception as e:
+          self.errors[fsm.id] = self.errors.get(fsm.id, 0) + 1
+          self.hass.log('{}{} failed to terminate e={}'.format(self.prefix(), fsm.id, e), level='ERROR')
+
+
+  # Terminate all machines and the watchdog
+  def terminate(self):
+    self.remove(list(self.machines))
+    self.timers.cancel_timer(self.feed_handle)
+    self.timers.cancel_timer(self.watchdog_handle)
+
+
+  def get(self, id):
+    return self.machines.get(id)
+
+
+  def state_callback(self, kwargs):
+    self.transitions += 1
+
+
+  # Aggregate numbers for all machines
+  def stats(self):
+    states = {}
+    for fsm in self.machines.values():
+      states[fsm.state.name] = states.get(fsm.state.name, 0) + 1
+    return {
+      'machines': len(self.machines),
+      'states': states,
+      'transitions': self.transitions,
+      'errors': sum(self.errors.values()),
+      'listeners': self.dispatcher.listener_count(),
+      'subscribers': self.dispatcher.subscriber_count(),
+      'timers': self.timers.count,
+      'cached_entities': len(self.cache.values),
+    }
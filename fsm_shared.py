@@ -0,0 +1,18 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+# Name of the attribute of hass holding its shared objects
+attribute = 'fsm_shared'
+
+
+# Function to get the object of class cls shared by all objects using this hass, created with cls(hass) on first use.
+# The objects are kept by hass itself and go away with it. A module-level registry keyed by hass would keep every
+# hass alive, since the shared objects (and the machines they call back) refer to it
+def get_shared(hass, cls):
+  shared = getattr(hass, attribute, None)
+  if shared is None:
+    shared = {}
+    setattr(hass, attribute, shared)
+  instance = shared.get(cls)
+  if instance is None:
+    instance = shared[cls] = cls(hass)
+  return instance
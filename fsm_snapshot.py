@@ -0,0 +1,111 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import fsm_cache
+import fsm_dispatcher
+import fsm_shared
+
+debug = False
+
+
+# Function to get the state snapshot shared by all objects using this hass
+def get_snapshot(hass):
+  return fsm_shared.get_shared(hass, Snapshot)
+
+
+class Snapshot:
+  # Copy of all entity states, read with a single get_state() call. Machines started in the same
+  # AppDaemon callback, like all machines created in initialize, share it, instead of reading every
+  # entity of every condition one by one. It is read when first used inside a 'with' block around
+  # the start of a machine, and kept until the callback returns.
+  #
+  # Conditions read the snapshot when they subscribe, so a condition subscribed after the read could
+  # miss a change made in between. Once the callback has returned, the states are read once more, each
+  # entity listened to since the read whose state changed is sent to its listeners as a state change,
+  # and the snapshot is dropped.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'Snapshot : '
+
+  def __init__(self, hass):
+    self.hass = hass
+    self.cache = fsm_cache.get_entity_cache(hass)
+    self.depth = 0
+    # entity -> state dict, or None when there is no snapshot
+    self.states = None
+    # (entity, attribute) pairs listened to when the snapshot was read
+    self.tracked = None
+    # (entity, attribute) -> value, as given from the snapshot
+    self.served = {}
+    self.handle = None
+
+
+  # Start a batch. Batches may be nested; the end of the outermost one schedules the check
+  def __enter__(self):
+    self.depth += 1
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.depth -= 1
+    if self.depth == 0 and self.states is not None and self.handle is None:
+      self.handle = self.hass.run_in(self.recheck_callback, 0)
+
+
+  # Read all states. Gives None if hass cannot give them all at once
+  def read(self):
+    try:
+      states = self.hass.get_state()
+    except Exception as e:
+      self.hass.log('{}get_state failed, reading entities one by one e={}'.format(self.prefix(), e), level='WARNING')
+      return None
+    if debug: self.hass.log('{}{} entities'.format(self.prefix(), len(states or ())), level='INFO')
+    return states if isinstance(states, dict) else None
+
+
+  # Send the changes since the read to the listeners added after it, and drop the snapshot
+  def recheck_callback(self, kwargs):
+    keys = [key for key in self.served if key in self.cache.tracked and key not in self.tracked]
+    served = self.served
+    self.handle = self.states = self.tracked = None
+    self.served = {}
+    if not keys:
+      return
+    states = self.read()
+    if states is None:
+      return
+    dispatcher = fsm_dispatcher.get_dispatcher(self.hass)
+    for key in keys:
+      # A change already received by the listener is in the cache
+      old = self.cache.values.get(key, served[key])
+      new = self.value(states, key)
+      if new != old:
+        if debug: self.hass.log('{}{} changed from {} to {} while starting'.format(self.prefix(), key, old, new), level='INFO')
+        dispatcher.state_callback(key[0], key[1] or 'state', old, new, {})
+
+
+  # Helper function to get the value of (entity, attribute) from a dict of states
+  def value(self, states, key):
+    state = states.get(key[0])
+    if state is None:
+      return None
+    if key[1] is None:
+      return state.get('state')
+    if key[1] == 'all':
+      return state
+    return (state.get('attributes') or {}).get(key[1])
+
+
+  # Same as hass.get_state(entity_id, attribute); inside a batch from the entity cache when the entity
+  # is listened to, otherwise from the snapshot
+  def get_state(self, entity_id, attribute=None):
+    if self.depth > 0:
+      key = fsm_cache.state_key(entity_id, attribute)
+      if key in self.cache.values:
+        return self.cache.values[key]
+      if self.states is None:
+        self.tracked = set(self.cache.tracked)
+        self.states = self.read() or {}
+      if key[0] in self.states:
+        value = self.served[key] = self.value(self.states, key)
+        return value
+    return self.hass.get_state(entity_id, attribute=attribute)
@@ -3,10 +3,15 @@
 from datetime import datetime, timedelta
 
 import fsm_fsm
+import fsm_program
 
 debug = False
 
 class State:
+  # Fixed attributes. __dict__ is kept, since programs run with the State as self and may store their own attributes
+  __slots__ = ('id', 'name', 'enter_programs', 'exit_programs', 'compiled_enter_programs', 'compiled_exit_programs',
+               'transitions', 'hass', 'fsm', 'index', 'number', '__dict__')
+
   # Helper function to simplify print and log messages
   def prefix(self):
     return '{}_{} : '.format(self.fsm.id, self.id)
@@ -22,7 +27,12 @@ class State:
     self.name = name
     self.enter_programs = enter_programs
     self.exit_programs = exit_programs
+    # The programs with strings compiled, set by initialize
+    self.compiled_enter_programs = []
+    self.compiled_exit_programs = []
     self.transitions = transitions
+    # Number of this state in the table of the Fsm
+    self.number = None
 
     if self.name == None:
       self.name = self.id
@@ -41,7 +51,9 @@ class State:
         self.id = '{}_s{}'.format(self.fsm.id, index)
       else:
         self.id = '{}_{}'.format(self.fsm.id, self.id)
-      
+
+      self.compiled_enter_programs = fsm_program.compile_programs(self, self.enter_programs)
+      self.compiled_exit_programs = fsm_program.compile_programs(self, self.exit_programs)
       
       if self.transitions:
           for index, transition in enumerate(self.transitions):
@@ -72,12 +84,7 @@ class State:
       #    self.hass.log('{}enter'.format(self.prefix(), level='INFO'))
       self.fsm.change_state(self)
 
-      if self.enter_programs:
-        for enter_program in self.enter_programs:
-          if type(enter_program) == str:
-            exec(enter_program)
-          else:
-            enter_program.program(self)
+      self.fsm.executor.run(self.fsm, self, self.compiled_enter_programs)
       self.activate()
       
     except Exception as e:
@@ -92,9 +99,7 @@ class State:
         for transition in self.transitions:
           transition.deactivate()
       
-          if self.exit_programs:
-            for exit_program in self.exit_programs:
-              exit_program.program(self)
+      self.fsm.executor.run(self.fsm, self, self.compiled_exit_programs)
     except Exception as e:
       raise ValueError("State exit Error: name={} id={} e={}".format(__name__, self.id, e))
 
@@ -106,20 +111,18 @@ class State:
           if self.fsm.state != self:
               raise ValueError("State check1 Error: name={} id={} e={}".format(__name__, self.id, e))
      
-          if self.transitions:
-              if debug: self.hass.log('{}checking transitions = {}'.format(self.prefix(), len(self.transitions)), level='ERROR')
-              for transition in self.transitions:
-                  if debug: self.hass.log('{}check {} = {}'.format(self.prefix(), transition.id, transition.status), level='INFO')
-                  if transition.status:
-                      transition.execute()
-                      break
+          # The first true transition in guard order, from the ready bitmap of this state
+          transition = self.fsm.table.first_ready(self.number)
+          if debug: self.hass.log('{}check first ready = {}'.format(self.prefix(), transition.id if transition else None), level='INFO')
+          if transition is not None:
+              transition.execute()
       except Exception as e:
           raise ValueError("State check2 Error: name={} id={} e={}".format(__name__, self.id, e))
            
 
           
   # Callback when status for a transition has changed
-  def transition_callback(self):
+  def transition_callback(self, kwargs):
       try:
           if debug: self.hass.log('{}transition_callback'.format(self.prefix()), level='INFO')
           if self.fsm.state == self:
@@ -134,18 +137,15 @@ class State:
 
     label = self.id
     
-    if self.enter_programs:
+    if self.compiled_enter_programs:
       label += '\\n [enter_programs: '
-      for enter_program in self.enter_programs:
-        if type(enter_program) == str:
-          label += enter_program[:20]
-        else:
-          label += enter_program.__name__ + ' '
+      for enter_program in self.compiled_enter_programs:
+        label += enter_program.__name__ + ' '
       label += ']'
 
-    if self.exit_programs:
+    if self.compiled_exit_programs:
       label += '\\n [exit_programs: '
-      for exit_program in self.exit_programs:
+      for exit_program in self.compiled_exit_programs:
         label += exit_program.__name__ + ' '
       label += ']'
       
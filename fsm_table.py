@@ -0,0 +1,77 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+debug = False
+
+
+class FsmTable:
+  # Integer-indexed tables compiled from the State, Transition and Condition objects of one Fsm.
+  # States and transitions are numbered in definition order. Each transition keeps a bitmap of
+  # its true conditions, and each state a bitmap of its true transitions, with one bit per
+  # transition in guard order. Finding the transition to run is then a test of the lowest set bit.
+
+  def __init__(self, states):
+    # - states is the list of State objects of the Fsm, before they are initialized
+    self.states = list(states)
+    # Per transition; the Transition object, its state, and its bit in ready
+    self.transitions = []
+    self.transition_state = []
+    self.transition_bit = []
+    # Per transition; bitmap of the true conditions, and the bitmap when all conditions are true
+    self.condition_bits = []
+    self.full_mask = []
+    # Per state; the transition numbers in guard order, and bitmap of the true transitions
+    self.state_transitions = []
+    self.ready = [0] * len(self.states)
+
+    for number, state in enumerate(self.states):
+      state.number = number
+      transitions = []
+      for index, transition in enumerate(state.transitions or ()):
+        transition.table = self
+        transition.number = len(self.transitions)
+        transitions.append(transition.number)
+        self.transitions.append(transition)
+        self.transition_state.append(number)
+        self.transition_bit.append(1 << index)
+        self.condition_bits.append(0)
+        self.full_mask.append((1 << len(transition.conditions or ())) - 1)
+      self.state_transitions.append(tuple(transitions))
+
+
+  # Set the status of condition index of transition
+  def set_condition(self, transition, index, status):
+    if status:
+      self.condition_bits[transition] |= 1 << index
+    else:
+      self.condition_bits[transition] &= ~(1 << index)
+
+
+  # Rebuild the condition bitmap of transition from the statuses of its conditions
+  def recount(self, transition, conditions):
+    bits = 0
+    for index, condition in enumerate(conditions):
+      if condition.status == True:
+        bits |= 1 << index
+    self.condition_bits[transition] = bits
+
+
+  # True if all conditions of transition are true
+  def all_true(self, transition):
+    return self.condition_bits[transition] == self.full_mask[transition]
+
+
+  # Set the status of transition in the ready bitmap of its state
+  def set_ready(self, transition, status):
+    state = self.transition_state[transition]
+    if status:
+      self.ready[state] |= self.transition_bit[transition]
+    else:
+      self.ready[state] &= ~self.transition_bit[transition]
+
+
+  # The first true transition of state in guard order, or None
+  def first_ready(self, state):
+    ready = self.ready[state]
+    if not ready:
+      return None
+    return self.transitions[self.state_transitions[state][(ready & -ready).bit_length() - 1]]
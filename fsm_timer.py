@@ -0,0 +1,235 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import math
+from datetime import timedelta
+
+import fsm_queue
+import fsm_shared
+
+debug = False
+
+
+# Function to get the timing wheel shared by all objects using this hass
+def get_timing_wheel(hass):
+  return fsm_shared.get_shared(hass, TimingWheel)
+
+
+class Timer:
+  # A timer armed in a TimingWheel. Used as handle when cancelling it
+  __slots__ = ('deadline', 'interval', 'callback', 'kwargs', 'slot')
+
+  def __init__(self, deadline, interval, callback, kwargs):
+    self.deadline = deadline
+    self.interval = interval
+    self.callback = callback
+    self.kwargs = kwargs
+    # The slot (dict) currently holding this timer, or None if it is not armed
+    self.slot = None
+
+
+class TimingWheel:
+  # Hierarchical timing wheel woken by a single AppDaemon run_in, armed for the earliest deadline only.
+  # Arming and cancelling a timer is O(1), and all timers expiring on the same tick are run in one batch.
+  # The methods mirror run_in/run_every/cancel_timer of hassapi, and callbacks get the same kwargs argument.
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'TimingWheel : '
+
+  def __init__(self, hass, resolution=1, bits=6, levels=4):
+    # - resolution is the tick length in seconds
+    # - bits is log2 of the number of slots per level
+    # - levels is the number of levels. Timers further away than resolution * 2**(bits*levels) are kept in an overflow list
+    self.hass = hass
+    self.queue = fsm_queue.get_event_queue(hass)
+    self.resolution = resolution
+    self.bits = bits
+    self.mask = (1 << bits) - 1
+    self.levels = levels
+    self.wheel = [[{} for slot in range(1 << bits)] for level in range(levels)]
+    self.overflow = {}
+
+    self.tick = 0
+    self.origin = None
+    self.count = 0
+    # The AppDaemon one-shot timer and the tick it is armed for
+    self.handle = None
+    self.armed = None
+    self.running = False
+
+
+  # Current time as seen by AppDaemon, naive local time unless aware is True
+  def now(self, aware=False):
+    return self.hass.datetime(aware=aware)
+
+
+  # Arm a one-shot timer, calling callback(kwargs) after delay seconds
+  def run_in(self, callback, delay, **kwargs):
+    timer = Timer(self.deadline(self.now() + timedelta(seconds=float(delay))), None, callback, kwargs)
+    self.arm(timer)
+    return timer
+
+
+  # Arm a periodic timer, calling callback(kwargs) at start and then every interval seconds
+  def run_every(self, callback, start, interval, **kwargs):
+    if start == 'now':
+      start = self.now()
+    timer = Timer(self.deadline(start), max(1, math.ceil(float(interval) / self.resolution)), callback, kwargs)
+    self.arm(timer)
+    return timer
+
+
+  # First tick at or after time, and never the current tick
+  def deadline(self, time):
+    if self.origin is None:
+      self.origin = self.now()
+    return max(self.tick + 1, math.ceil((time - self.origin).total_seconds() / self.resolution))
+
+
+  # Place a new timer, and wake up earlier if it is the first to expire
+  def arm(self, timer):
+    self.place(timer)
+    if self.handle is None or timer.deadline < self.armed:
+      self.schedule()
+
+
+  # Cancel a timer returned by run_in or run_every
+  def cancel_timer(self, timer):
+    if timer.slot is not None:
+      del timer.slot[timer]
+      timer.slot = None
+      self.count -= 1
+      if self.count == 0:
+        self.stop()
+    # A periodic timer being run is re-armed afterwards unless interval is cleared
+    timer.interval = None
+
+
+  # Seconds left until timer expires, or None if it is not armed
+  def remaining(self, timer):
+    if timer.slot is None:
+      return None
+    elapsed = (self.now() - self.origin).total_seconds() - self.tick * self.resolution
+    return max(0, (timer.deadline - self.tick) * self.resolution - elapsed)
+
+
+  # Put a timer in the slot matching its deadline
+  def place(self, timer):
+    deadline = timer.deadline
+    if deadline < self.tick:
+      deadline = timer.deadline = self.tick
+    for level in range(self.levels):
+      shift = self.bits * (level + 1)
+      if (deadline >> shift) == (self.tick >> shift):
+        slot = self.wheel[level][(deadline >> (self.bits * level)) & self.mask]
+        break
+    else:
+      slot = self.overflow
+    slot[timer] = None
+    timer.slot = slot
+    self.count += 1
+
+
+  # The first occupied slot after the current tick, and the tick its timers expire or cascade to a lower level.
+  # All timers in it expire before the timers of any other slot. Returns (None, None) if no timer is armed
+  def next_slot(self):
+    tick = self.tick
+    for level in range(self.levels):
+      shift = self.bits * level
+      base = (tick >> (shift + self.bits)) << (shift + self.bits)
+      slots = self.wheel[level]
+      for index in range(((tick >> shift) & self.mask) + 1, 1 << self.bits):
+        if slots[index]:
+          return base | (index << shift), slots[index]
+    if self.overflow:
+      shift = self.bits * self.levels
+      return ((tick >> shift) + 1) << shift, self.overflow
+    return None, None
+
+
+  # Arm the AppDaemon one-shot timer for the earliest deadline
+  def schedule(self):
+    # The timers armed by callbacks are scheduled when the wheel has advanced
+    if self.running:
+      return
+    self.stop()
+    tick, slot = self.next_slot()
+    if slot is not None:
+      self.armed = min(timer.deadline for timer in slot)
+      delay = self.armed * self.resolution - (self.now() - self.origin).total_seconds()
+      if debug: self.hass.log('{}schedule tick={} armed={} delay={}'.format(self.prefix(), self.tick, self.armed, delay), level='INFO')
+      self.handle = self.hass.run_in(self.tick_callback, max(0, delay))
+
+
+  # Cancel the AppDaemon one-shot timer
+  def stop(self):
+    if self.handle is not None:
+      self.hass.cancel_timer(self.handle)
+      self.handle = None
+
+
+  # The only callback registered in AppDaemon. Advances the wheel up to the current time and sleeps until the next deadline
+  def tick_callback(self, kwargs):
+    self.handle = None
+    # Never stop short of the tick armed for, even if woken a little early
+    target = max(self.armed, int((self.now() - self.origin).total_seconds() // self.resolution))
+    if target - self.armed > 10:
+      self.hass.log('{}tick late by {} s'.format(self.prefix(), (target - self.armed) * self.resolution), level='WARNING')
+    self.running = True
+    try:
+      while True:
+        tick, slot = self.next_slot()
+        if tick is None or tick > target:
+          break
+        # The ticks skipped have no timer to run or cascade
+        self.tick = tick - 1
+        # All timers of a tick expire before the queued checks run
+        with self.queue:
+          self.advance()
+      self.tick = max(self.tick, target)
+    finally:
+      self.running = False
+    self.schedule()
+
+
+  # Advance the wheel one tick, cascading higher levels and running expired timers
+  def advance(self):
+    self.tick += 1
+    tick = self.tick
+
+    # Cascade from the highest level reaching a boundary and down
+    if tick & self.mask == 0:
+      level = 1
+      while level < self.levels and (tick >> (self.bits * level)) & self.mask == 0:
+        level += 1
+      if level == self.levels:
+        self.cascade(self.overflow)
+      for level in range(min(level, self.levels - 1), 0, -1):
+        self.cascade(self.wheel[level][(tick >> (self.bits * level)) & self.mask])
+
+    slot = self.wheel[0][tick & self.mask]
+    if slot:
+      for timer in list(slot):
+        # Skip timers cancelled by an earlier callback in the same batch
+        if timer.slot is not slot:
+          continue
+        del slot[timer]
+        timer.slot = None
+        self.count -= 1
+        if timer.interval:
+          timer.deadline = tick + timer.interval
+          self.place(timer)
+        try:
+          timer.callback(timer.kwargs)
+        except Exception as e:
+          self.hass.log('{}timer callback {} failed e={}'.format(self.prefix(), timer.callback, e), level='ERROR')
+
+
+  # Move all timers of a slot to lower levels
+  def cascade(self, slot):
+    if slot:
+      timers = list(slot)
+      slot.clear()
+      self.count -= len(timers)
+      for timer in timers:
+        self.place(timer)
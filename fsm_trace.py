@@ -0,0 +1,71 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+
+import heapq
+import time
+from collections import deque
+from datetime import datetime
+
+debug = False
+
+# Kinds of records
+CONDITION = 'condition'
+TIMEOUT = 'timeout'
+STABILITY = 'stability'
+TIME = 'time'
+TRANSITION = 'transition'
+STATE = 'state'
+
+# How records of each kind are shown; id and value
+formats = {
+  CONDITION: '{} = {}',
+  TIMEOUT: '{} timeout',
+  STABILITY: '{} stable',
+  TIME: '{} time = {}',
+  TRANSITION: '{} to {}',
+  STATE: '{} from {}',
+}
+
+
+# Helper function to format a record as one line
+def format_record(record):
+  stamp, kind, id, value = record
+  return '{} {} {}'.format(datetime.fromtimestamp(stamp).strftime('%H:%M:%S.%f')[:-3], kind,
+                           formats.get(kind, '{} {}').format(id, value))
+
+
+class Trace:
+  # The last records of what happened in a machine; condition status changes, timer events, transitions
+  # and state changes. A record is a tuple (time, kind, id, value) of objects already at hand, so adding one
+  # costs a tuple and a deque append, and nothing is formatted until the trace is dumped. The deque drops the
+  # oldest record when full, and appending is atomic, so no lock is needed.
+
+  def __init__(self, size=256, clock=time.time):
+    # - size is the number of records kept
+    # - clock is the function giving the time of a record, in seconds since the epoch
+    self.records = deque(maxlen=size)
+    self.clock = clock
+
+
+  def add(self, kind, id, value=None):
+    self.records.append((self.clock(), kind, id, value))
+
+
+  # The last n records (all if n is None), oldest first, formatted as lines
+  def dump(self, n=None):
+    records = list(self.records)
+    if n is not None:
+      records = records[-n:] if n > 0 else []
+    return [format_record(record) for record in records]
+
+
+  def clear(self):
+    self.records.clear()
+
+
+# Function to merge the traces of many machines by time. Returns the last n lines, oldest first, each starting with the id of the machine
+def merge(fsms, n=None):
+  streams = [[(record, fsm.id) for record in fsm.trace.records] for fsm in fsms if fsm.trace is not None]
+  records = list(heapq.merge(*streams, key=lambda entry: entry[0][0]))
+  if n is not None:
+    records = records[-n:] if n > 0 else []
+  return ['{} : {}'.format(id, format_record(record)) for record, id in records]
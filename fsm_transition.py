@@ -1,18 +1,28 @@
 
+import time
 from datetime import datetime, timedelta
 
+import fsm_program
+import fsm_queue
+import fsm_trace
+
 debug = False
 
 class Transition:
+  # Fixed attributes. __dict__ is kept, since programs run with the Transition as self and may store their own attributes
+  __slots__ = ('status', 'last_status', 'id', 'conditions', 'next_state_name', 'next_state', 'programs', 'compiled_programs',
+               'counted', 'table', 'number', 'hass', 'queue', 'callbacks', 'state', 'fsm', 'index', '__dict__')
+
   # Helper function to simplify print and log messages
   def prefix(self):
     return '{} : '.format(self.id)
   
-  def __init__(self, id=None, next='', conditions=None, programs=None):
+  def __init__(self, id=None, next='', conditions=None, programs=None, counted=True):
     # - id is optional but useful for debugging
     # - next is the id of the next state if all conditions are found true
     # - conditions is a list of; Condition objects
     # - programs is an optional object containing a list of program functions
+    # - counted can be set to False to walk the conditions (stopping at the first false) on each check, instead of keeping a bitmap of the true ones as they change
 
     # status will always reflect the status of this condition and is intended to be probed from outside
     self.status = self.last_status = None
@@ -24,14 +34,24 @@ class Transition:
 
     assert isinstance(programs, (list, type(None)))
     self.programs = programs
+    # The programs with strings compiled, set by initialize
+    self.compiled_programs = []
+
+    self.counted = counted
+    # The tables of the Fsm and the number of this transition in them. Set when the Fsm compiles its table
+    self.table = None
+    self.number = None
 
       
   def initialize(self, hass, state, index):
     assert hass is not None
 
     self.hass = hass
+    self.queue = fsm_queue.get_event_queue(hass)
     self.callbacks = []
     self.state = state
+    # The machine, through which the conditions reach the objects shared per hass
+    self.fsm = state.fsm
     self.index = index
 
     try:
@@ -39,12 +59,17 @@ class Transition:
         self.id = '{}_t{}'.format(self.state.id, index)
       
       self.next_state = self.state.fsm.find_state(self.next_state_name)
+      self.compiled_programs = fsm_program.compile_programs(self, self.programs)
 
       #      self.hass.log('{}Initializing'.format(self.prefix()), level='INFO')
       for index, condition in enumerate(self.conditions):
-        condition.initialize(self.hass, self, index)
+        if condition.transition is None:
+          condition.initialize(self.hass, self, index)
+        else:
+          # Kept by Fsm.reload
+          condition.rebind(self, index)
         condition.add_callback(self.condition_callback)
-      self.update_status()
+      self.recount()
       #      self.hass.log('{}Initializing done'.format(self.prefix()), level='INFO')
 
       #    self.hass.log('{}Initial status={}'.format(self.prefix(), self.status, level='INFO'))
@@ -58,6 +83,7 @@ class Transition:
               #      self.hass.log('{}deactivate {}'.format(self.prefix(), condition.id), level='INFO')
               condition.deactivate()
               self.status = self.last_status = None
+          self.recount()
 
               
   def activate(self):
@@ -70,10 +96,26 @@ class Transition:
       
   def update_status(self):
       #    self.hass.log('{}update_status'.format(self.prefix()), level='ERROR')
-      self.status = True
-      for condition in self.conditions:
-          if condition.status != True:
-              self.status = False
+      if self.counted:
+          self.status = self.table.all_true(self.number)
+      else:
+          self.status = True
+          for condition in self.conditions:
+              if condition.status != True:
+                  self.status = False
+                  break
+      self.table.set_ready(self.number, self.status)
+
+
+  # Called by a condition when it announces a new status. Keeps the condition bitmap up to date in O(1)
+  def condition_changed(self, index, status):
+      self.table.set_condition(self.number, index, status == True)
+
+
+  # Rebuild the condition bitmap from scratch
+  def recount(self):
+      self.table.recount(self.number, self.conditions)
+      self.update_status()
     
 
   # Call check when something happened. If the status changes, all subscribing listeners will have their callback called  
@@ -91,19 +133,24 @@ class Transition:
       if self.callbacks != []:
         for callback in self.callbacks:
           if debug: self.hass.log('{}  ..{}'.format(self.prefix(), callback), level='ERROR')
-          callback()
+          self.queue.post(callback, fsm_queue.STATE)
       self.last_status = self.status
 
   def execute(self):
       if debug: self.hass.log('{}Started in <{}> used <{}> to get to <{}>'.format(self.prefix(), self.state.id, self.id, self.next_state_name), level='INFO')
     
+      trace = self.state.fsm.trace
+      if trace is not None:
+        trace.add(fsm_trace.TRANSITION, self.id, self.next_state_name)
+      metrics = self.state.fsm.metrics
+      if metrics is not None:
+        metrics.transition(self, time.perf_counter() - self.queue.started if self.queue.started else None)
+
       # Exit state
       self.state.exit()
     
       # Transition programs
-      if self.programs:
-          for program in self.programs:
-              program.program(self)
+      self.state.fsm.executor.run(self.state.fsm, self, self.compiled_programs)
 
       # Enter state
       assert self.next_state, ('Next state not set: {} {} {}'.format(__name__, self.id, self.next_state))
@@ -134,8 +181,8 @@ class Transition:
         sub_dot += ')'
       
     label = self.id
-    if self.programs:
-      for program in self.programs:
+    if self.compiled_programs:
+      for program in self.compiled_programs:
         label += '\\n [program: ' + program.__name__ + ']'
 
     dot = '"{}"->"{}"[label="{}\\n {}"];'.format(self.state.id, self.next_state.id, label, sub_dot)
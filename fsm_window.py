@@ -0,0 +1,409 @@
+# Finite state machine class for AppDaemon (Home Assistant).
+#
+# Sliding window operators for a Condition. They test an aggregate of the entity over the last
+# window seconds instead of its current state:
+#
+#   Condition(entity='sensor.power', operator=Mean(300, GT), operand=1500)       # mean above 1500 for the last 5 minutes
+#   Condition(entity='sensor.temperature', operator=Rate(600, LT), operand=-0.01) # falling faster than 0.01 per second
+#   Condition(entity='binary_sensor.door', operator=TrueFor(600, 120), operand='on') # open at least 2 of the last 10 minutes
+
+import operator
+
+import fsm_cache
+import fsm_condition
+import fsm_dispatcher
+import fsm_shared
+import fsm_timer
+
+debug = False
+
+# Comparisons of the window operators, by the operator they are named after
+comparisons = {
+  fsm_condition.Eq: operator.eq,
+  fsm_condition.Neq: operator.ne,
+  fsm_condition.LT: operator.lt,
+  fsm_condition.LE: operator.le,
+  fsm_condition.GT: operator.gt,
+  fsm_condition.GE: operator.ge,
+}
+
+# How comparisons are shown by get_dot
+symbols = {
+  fsm_condition.Eq: '==',
+  fsm_condition.Neq: '!=',
+  fsm_condition.LT: '<',
+  fsm_condition.LE: '<=',
+  fsm_condition.GT: '>',
+  fsm_condition.GE: '>=',
+}
+
+
+# Function to get the windows shared by all conditions using this hass
+def get_windows(hass):
+  return fsm_shared.get_shared(hass, Windows)
+
+
+class Windows:
+  # The sliding windows of one hass. Conditions on the same entity, attribute, window length and kind
+  # share one window, which is kept while at least one of them is attached
+
+  # Helper function to simplify print and log messages
+  def prefix(self):
+    return 'Windows : '
+
+  def __init__(self, hass):
+    self.hass = hass
+    # key -> SlidingWindow
+    self.windows = {}
+
+
+  def acquire(self, key, condition, transform, buckets):
+    window = self.windows.get(key)
+    if window is None:
+      if debug: self.hass.log('{}new window {}'.format(self.prefix(), key), level='INFO')
+      window = self.windows[key] = SlidingWindow(self.hass, key[0], key[1], key[2], transform, buckets)
+    if condition not in window.users:
+      window.users.append(condition)
+    return window
+
+
+  def release(self, key, condition):
+    window = self.windows.get(key)
+    if window is None:
+      return
+    if condition in window.users:
+      window.users.remove(condition)
+    if not window.users:
+      window.stop()
+      del self.windows[key]
+
+
+class SlidingWindow:
+  # History of one entity (or attribute) over the last length seconds, in a ring of buckets. A state
+  # holds until it changes, so each bucket keeps the integral of the value over the time it covers, and
+  # its lowest, highest and first value. The window moves one bucket at a time, and the bucket leaving
+  # it is reused, so memory is fixed and a change costs the same whatever the number of samples. The
+  # mean uses running totals; min, max and rate look at the buckets, whose number is fixed.
+  #
+  # The window listens to the entity itself, before the conditions using it, and re-evaluates them
+  # once per bucket, since the aggregates change with time alone.
+
+  def __init__(self, hass, entity, attribute, length, transform, buckets=60):
+    # - length is the window in seconds
+    # - transform is a function giving the value of a state as a float, or None if it has no value
+    # - buckets is the number of buckets. The window moves in steps of length / buckets seconds
+    self.hass = hass
+    self.timers = fsm_timer.get_timing_wheel(hass)
+    self.dispatcher = fsm_dispatcher.get_dispatcher(hass)
+    self.cache = fsm_cache.get_entity_cache(hass)
+    self.entity = entity
+    self.attribute = attribute
+    self.length = length
+    self.transform = transform
+    self.buckets = buckets
+    self.step = float(length) / buckets
+    self.area = [0.0] * buckets
+    self.covered = [0.0] * buckets
+    self.low = [None] * buckets
+    self.high = [None] * buckets
+    self.first = [None] * buckets
+    self.total_area = 0.0
+    self.total_covered = 0.0
+    self.users = []
+
+    self.value = None
+    now = self.clock()
+    self.started = self.time = now
+    # Absolute number of the current bucket
+    self.number = int(now // self.step)
+
+    self.dispatcher.subscribe(self.state_callback, entity, attribute=attribute)
+    self.set(self.cache.get_state(entity, attribute=attribute))
+    self.handle = self.timers.run_every(self.tick_callback, 'now', self.step)
+
+
+  def stop(self):
+    self.dispatcher.unsubscribe(self.state_callback, (self.entity, self.attribute))
+    self.timers.cancel_timer(self.handle)
+
+
+  # Seconds since the epoch, as seen by AppDaemon
+  def clock(self):
+    return self.timers.now().timestamp()
+
+
+  # Add the current value from the last update until time, in the current bucket
+  def accumulate(self, time):
+    elapsed = time - self.time
+    if elapsed > 0 and self.value is not None:
+      index = self.number % self.buckets
+      self.area[index] += self.value * elapsed
+      self.covered[index] += elapsed
+      self.total_area += self.value * elapsed
+      self.total_covered += elapsed
+    self.time = max(self.time, time)
+
+
+  # Start bucket index over, holding the current value
+  def reset(self, index):
+    self.total_area -= self.area[index]
+    self.total_covered -= self.covered[index]
+    self.area[index] = self.covered[index] = 0.0
+    self.low[index] = self.high[index] = self.first[index] = self.value
+
+
+  # Move the window up to time
+  def advance(self, time):
+    number = int(time // self.step)
+    if number - self.number > self.buckets:
+      # Quiet for more than a window; only the last buckets matter
+      self.accumulate((self.number + 1) * self.step)
+      self.number = number - self.buckets
+      self.time = self.number * self.step
+    while self.number < number:
+      self.accumulate((self.number + 1) * self.step)
+      self.number += 1
+      self.reset(self.number % self.buckets)
+    self.accumulate(time)
+
+
+  # A new state of the entity
+  def set(self, state):
+    self.advance(self.clock())
+    self.value = value = self.transform(state)
+    if value is not None:
+      index = self.number % self.buckets
+      if self.covered[index] == 0:
+        # Nothing held any time in the bucket yet, as for a change right at its start
+        self.low[index] = self.high[index] = self.first[index] = value
+      if self.low[index] is None or value < self.low[index]:
+        self.low[index] = value
+      if self.high[index] is None or value > self.high[index]:
+        self.high[index] = value
+      if self.first[index] is None:
+        self.first[index] = value
+
+
+  def state_callback(self, entity, attribute, old, new, kwargs):
+    self.set(new)
+
+
+  def tick_callback(self, kwargs):
+    self.advance(self.clock())
+    for condition in tuple(self.users):
+      if condition.attached:
+        condition.condition_state_change(condition.entity_state)
+
+
+  # True once the window has run for its whole length, so its aggregates are not judged on a few seconds of history
+  def full(self):
+    return self.clock() - self.started >= self.length - 1e-6
+
+
+  # Time-weighted mean over the window, or None if the entity had no value
+  def mean(self):
+    self.advance(self.clock())
+    if self.total_covered > 0:
+      return self.total_area / self.total_covered
+    return self.value
+
+
+  def minimum(self):
+    self.advance(self.clock())
+    values = [value for value in self.low if value is not None]
+    return min(values) if values else None
+
+
+  def maximum(self):
+    self.advance(self.clock())
+    values = [value for value in self.high if value is not None]
+    return max(values) if values else None
+
+
+  # Change per second, from the oldest value in the window to the current value
+  def rate(self):
+    now = self.clock()
+    self.advance(now)
+    for number in range(self.number - self.buckets + 1, self.number + 1):
+      first = self.first[number % self.buckets]
+      if first is not None:
+        since = max(self.started, number * self.step)
+        if now > since and self.value is not None:
+          return (self.value - first) / (now - since)
+        return None
+    return None
+
+
+  # Integral of the value over the window. For a value of 1 when true and 0 when false, the number of seconds true
+  def total(self):
+    self.advance(self.clock())
+    return self.total_area
+
+
+class WindowOperator:
+  # Base of the window operators. An operator is an object, like Mean(300, GT), given as operator of a Condition.
+  # The operand is compared with the aggregate of the window
+
+  name = 'window'
+
+  def __init__(self, window, compare=fsm_condition.GE, buckets=60):
+    # - window is the number of seconds
+    # - compare is the comparison of the aggregate with the operand; LT, LE, GT, GE, Eq or Neq
+    # - buckets is the number of steps the window moves in. More buckets give a smoother window and use more memory
+    assert compare in comparisons, 'compare must be one of LT, LE, GT, GE, Eq, Neq'
+    self.window = window
+    self.compare = compare
+    self.buckets = buckets
+
+
+  # The arguments of the operator. Operators with the same arguments are equal, so Fsm.reload keeps their conditions
+  def params(self):
+    return (self.window, self.compare, self.buckets)
+
+  def __eq__(self, other):
+    return type(self) is type(other) and self.params() == other.params()
+
+  def __hash__(self):
+    return hash((type(self), self.params()))
+
+
+  # Key of the window of a condition. Conditions with the same key share the window. Mean, Min, Max and Rate all keep
+  # the number of the entity, so one window serves all of them
+  def key(self, condition):
+    entity, attribute = fsm_cache.state_key(condition.entity, condition.attribute)
+    return (entity, attribute, self.window, self.buckets, 'number')
+
+
+  def transform(self, condition):
+    return fsm_cache.to_float
+
+
+  # The aggregate tested, from the window
+  def aggregate(self, window):
+    return None
+
+
+  # True if the comparison can be trusted before the window has run for its whole length
+  def partial(self):
+    return False
+
+
+  def compile(self, condition):
+    compare = comparisons[self.compare]
+    operand = fsm_condition.numeric_operand(condition)
+    key = self.key(condition)
+    windows = get_windows(condition.hass).windows
+    aggregate = self.aggregate
+    partial = self.partial()
+    def evaluate(state):
+      window = windows.get(key)
+      if window is None or not (partial or window.full()):
+        return False
+      value = aggregate(window)
+      return value is not None and compare(value, operand)
+    return evaluate
+
+
+  # Called by the condition before it listens to its entity, and after it stops
+  def attach(self, condition):
+    get_windows(condition.hass).acquire(self.key(condition), condition, self.transform(condition), self.buckets)
+
+  def detach(self, condition):
+    get_windows(condition.hass).release(self.key(condition), condition)
+
+
+  # Helper function to get the dot-format representation of this object
+  def get_dot(self, condition):
+    return "{}({}s){}'{}'".format(self.name, self.window, symbols[self.compare], condition.operand)
+
+
+class Mean(WindowOperator):
+  # Time-weighted mean of the entity over the window
+  name = 'mean'
+
+  def aggregate(self, window):
+    return window.mean()
+
+
+class Min(WindowOperator):
+  # Lowest value of the entity over the window
+  name = 'min'
+
+  def aggregate(self, window):
+    return window.minimum()
+
+  # A value below the operand seen in part of the window is in the whole window too
+  def partial(self):
+    return self.compare in (fsm_condition.LT, fsm_condition.LE)
+
+
+class Max(WindowOperator):
+  # Highest value of the entity over the window
+  name = 'max'
+
+  def aggregate(self, window):
+    return window.maximum()
+
+  def partial(self):
+    return self.compare in (fsm_condition.GT, fsm_condition.GE)
+
+
+class Rate(WindowOperator):
+  # Change of the entity per second over the window
+  name = 'rate'
+
+  def aggregate(self, window):
+    return window.rate()
+
+
+class TrueFor(WindowOperator):
+  # True when the entity compared with the operand was true for at least seconds of the last window seconds.
+  # The comparison is of the state (Eq, Neq) or of its number (LT, LE, GT, GE)
+  name = 'true_for'
+
+  def __init__(self, window, seconds, compare=fsm_condition.Eq, buckets=60):
+    # - seconds is the number of seconds the comparison must have been true
+    WindowOperator.__init__(self, window, compare, buckets)
+    self.seconds = seconds
+
+
+  def params(self):
+    return (self.window, self.seconds, self.compare, self.buckets)
+
+
+  # The window keeps 1 when the comparison is true and 0 when false, so one window per comparison and operand
+  def key(self, condition):
+    entity, attribute = fsm_cache.state_key(condition.entity, condition.attribute)
+    return (entity, attribute, self.window, self.buckets, 'true', self.compare, condition.operand)
+
+
+  def transform(self, condition):
+    compare = comparisons[self.compare]
+    if self.compare in (fsm_condition.Eq, fsm_condition.Neq):
+      operand = fsm_condition.required_operand(condition)
+      def transform(state):
+        return 1.0 if compare(state, operand) else 0.0
+    else:
+      operand = fsm_condition.numeric_operand(condition)
+      def transform(state):
+        value = fsm_cache.to_float(state)
+        return 1.0 if value is not None and compare(value, operand) else 0.0
+    return transform
+
+
+  # True as soon as the seconds add up; a window not full yet can only count fewer of them
+  def compile(self, condition):
+    # Checks the operand now, and not when the window starts
+    self.transform(condition)
+    key = self.key(condition)
+    seconds = self.seconds
+    windows = get_windows(condition.hass).windows
+    def evaluate(state):
+      window = windows.get(key)
+      # Allow for rounding in the sum of the seconds
+      return window is not None and window.total() >= seconds - 1e-6
+    return evaluate
+
+
+  def get_dot(self, condition):
+    return "true_for({}s of {}s){}'{}'".format(self.seconds, self.window, symbols[self.compare], condition.operand)
@@ -0,0 +1,93 @@
+# Tests of AsyncHass and AsyncFsm, on a stand-in for an AppDaemon app using the async API. Run with: python -m pytest
+#
+# AsyncHass keeps the states in memory and serves get_state and listen_state like hassapi, so attribute 'state'
+# must read the state itself, as it does in AppDaemon.
+
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import fsm_async
+from fsm_condition import Condition
+from fsm_state import State
+from fsm_transition import Transition
+
+
+class App:
+  # The part of adapi.ADAPI used by AsyncHass. set_state sends a state_changed event, as Home Assistant does
+  def __init__(self, states):
+    self.states = {entity: {'entity_id': entity, 'state': state, 'attributes': {}} for entity, state in states.items()}
+    self.event_callbacks = []
+    self.logs = []
+
+  def log(self, msg, level='INFO'):
+    self.logs.append((level, msg))
+
+  async def datetime(self, aware=False):
+    now = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+    return now if aware else now.replace(tzinfo=None)
+
+  async def get_state(self, entity_id=None, **kwargs):
+    return {entity: dict(state) for entity, state in self.states.items()}
+
+  async def listen_event(self, callback, event):
+    self.event_callbacks.append(callback)
+    return 1
+
+  async def cancel_listen_event(self, handle):
+    self.event_callbacks.clear()
+
+  async def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+    old = self.states.get(entity_id)
+    new = {'entity_id': entity_id, 'state': state, 'attributes': dict(attributes or {})}
+    self.states[entity_id] = new
+    for callback in self.event_callbacks:
+      await callback('state_changed', {'entity_id': entity_id, 'old_state': old, 'new_state': new}, {})
+
+
+# Helper function to run a coroutine function on a new loop
+def run(test):
+  return asyncio.run(test())
+
+
+# get_state reads attribute 'state' as the state itself
+def test_get_state():
+  async def test():
+    hass = await fsm_async.get_async_hass(App({'input_boolean.s': 'on'}))
+    assert hass.get_state('input_boolean.s') == 'on'
+    assert hass.get_state('input_boolean.s', attribute='state') == 'on'
+    assert hass.get_state('input_boolean.s', attribute='friendly_name', default='none') == 'none'
+    assert hass.get_state('input_boolean.x', attribute='state') is None
+  run(test)
+
+
+# A listener of attribute 'state' is called on state changes, with the states
+def test_listen_state_attribute_state():
+  async def test():
+    app = App({'input_boolean.s': 'off'})
+    hass = await fsm_async.get_async_hass(app)
+    changes = []
+    hass.listen_state(lambda entity, attribute, old, new, kwargs: changes.append((old, new)), 'input_boolean.s', attribute='state')
+    await app.set_state('input_boolean.s', 'on')
+    assert changes == [('off', 'on')]
+  run(test)
+
+
+# Conditions on attribute 'state' work in lazy and non-lazy machines
+@pytest.mark.parametrize('lazy', [False, True])
+def test_fsm_attribute_state(lazy):
+  async def test():
+    app = App({'input_boolean.s': 'off'})
+    fsm = await fsm_async.AsyncFsm.create(app, id='f', lazy=lazy, watchdog=False, states=[
+      State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.s', attribute='state', operand='on')])]),
+      State(id='on', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.s', attribute='state', operand='off')])]),
+    ])
+    await asyncio.sleep(0)
+    assert fsm.state.name == 'idle'
+    await app.set_state('input_boolean.s', 'on')
+    assert fsm.state.name == 'on'
+    await app.set_state('input_boolean.s', 'off')
+    assert fsm.state.name == 'idle'
+    assert not [msg for level, msg in app.logs if level == 'ERROR']
+  run(test)
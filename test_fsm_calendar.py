@@ -0,0 +1,100 @@
+# Tests of CalendarMask, and of the time wakeups of a Condition. Run with: python -m pytest
+#
+# next_change gives the wall clock minute where match changes next, and the condition sleeps until then on a single
+# timer. The first tests cross day, week and year boundaries; the DST ones check that the delay to the change is
+# counted in real seconds.
+
+from datetime import datetime
+
+import pytest
+
+import fsm_mock
+from fsm_calendar import CalendarMask, seconds_between
+from fsm_condition import Condition
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+
+
+# Helper function to get a time zone, skipping the test when the system has no time zone database
+def zone(name):
+  zoneinfo = pytest.importorskip('zoneinfo')
+  try:
+    return zoneinfo.ZoneInfo(name)
+  except zoneinfo.ZoneInfoNotFoundError:
+    pytest.skip('no time zone database')
+
+
+# Each case is the mask, now, match(now), and next_change(now)
+@pytest.mark.parametrize('mask, now, match, change', [
+  # Day boundaries
+  (dict(hours=range(22, 24)), datetime(2024, 1, 1, 21, 30), False, datetime(2024, 1, 1, 22, 0)),
+  (dict(hours=range(22, 24)), datetime(2024, 1, 1, 23, 59), True, datetime(2024, 1, 2, 0, 0)),
+  (dict(hours=range(0, 2)), datetime(2024, 1, 1, 23, 0), False, datetime(2024, 1, 2, 0, 0)),
+  (dict(hours=[6], minutes=[0, 30]), datetime(2024, 1, 1, 6, 0), True, datetime(2024, 1, 1, 6, 1)),
+  (dict(hours=[6], minutes=[0, 30]), datetime(2024, 1, 1, 6, 1), False, datetime(2024, 1, 1, 6, 30)),
+  (dict(hours=[6], minutes=[0, 30]), datetime(2024, 1, 1, 6, 30), True, datetime(2024, 1, 1, 6, 31)),
+  (dict(hours=[6], minutes=[0, 30]), datetime(2024, 1, 1, 6, 31), False, datetime(2024, 1, 2, 6, 0)),
+  # Week boundaries. 2024-01-05 is a Friday, and 2024-01-08 starts ISO week 2
+  (dict(weekdays=[5, 6]), datetime(2024, 1, 5, 12, 0), False, datetime(2024, 1, 6, 0, 0)),
+  (dict(weekdays=[5, 6]), datetime(2024, 1, 7, 23, 0), True, datetime(2024, 1, 8, 0, 0)),
+  (dict(weeks=[2]), datetime(2024, 1, 7, 12, 0), False, datetime(2024, 1, 8, 0, 0)),
+  (dict(weeks=[2]), datetime(2024, 1, 14, 23, 59), True, datetime(2024, 1, 15, 0, 0)),
+  (dict(weekdays=[0], hours=range(8, 10)), datetime(2024, 1, 7, 12, 0), False, datetime(2024, 1, 8, 8, 0)),
+  (dict(weekdays=[0], hours=range(8, 10)), datetime(2024, 1, 8, 9, 59), True, datetime(2024, 1, 8, 10, 0)),
+  # Year boundaries. ISO week 1 of 2025 starts on 2024-12-30
+  (dict(weeks=[1]), datetime(2024, 12, 29, 12, 0), False, datetime(2024, 12, 30, 0, 0)),
+  (dict(months=[12]), datetime(2024, 12, 31, 23, 59), True, datetime(2025, 1, 1, 0, 0)),
+  (dict(years=[2025], months=[1], days=[1], hours=[0]), datetime(2024, 12, 31, 12, 0), False, datetime(2025, 1, 1, 0, 0)),
+])
+def test_next_change(mask, now, match, change):
+  calendar = CalendarMask(**mask)
+  assert calendar.match(now) == match
+  assert calendar.next_change(now) == change
+  assert calendar.match(change) != match
+
+
+# The delay over the night DST starts is one hour shorter than the wall clock difference
+def test_next_change_dst_start():
+  paris = zone('Europe/Paris')
+  calendar = CalendarMask(hours=range(8, 20))
+  now = datetime(2024, 3, 31, 1, 0, tzinfo=paris)
+  change = calendar.next_change(now)
+  assert change == datetime(2024, 3, 31, 8, 0, tzinfo=paris)
+  assert change.utcoffset().total_seconds() == 7200
+  assert seconds_between(now, change) == 6 * 3600
+  assert calendar.match(change)
+
+
+# The delay over the night DST ends is one hour longer than the wall clock difference
+def test_next_change_dst_end():
+  paris = zone('Europe/Paris')
+  calendar = CalendarMask(hours=range(8, 20))
+  now = datetime(2024, 10, 27, 1, 0, tzinfo=paris)
+  change = calendar.next_change(now)
+  assert change == datetime(2024, 10, 27, 8, 0, tzinfo=paris)
+  assert change.utcoffset().total_seconds() == 3600
+  assert seconds_between(now, change) == 8 * 3600
+  assert not calendar.match(now) and calendar.match(change)
+
+
+# Naive times are plain wall clock times
+def test_seconds_between_naive():
+  assert seconds_between(datetime(2024, 3, 31, 1, 0), datetime(2024, 3, 31, 8, 0)) == 7 * 3600
+
+
+# A machine waiting for a time window is woken once, at the first minute of the window
+def test_condition_wakes_at_change():
+  hass = fsm_mock.MockHass(now=datetime(2024, 1, 1, 6, 0))
+  fsm = Fsm(hass, id='f', watchdog=False, states=[
+    State(id='night', transitions=[Transition(next='day', conditions=[Condition(hours=range(8, 20))])]),
+    State(id='day', transitions=[Transition(next='night', conditions=[Condition(hours=range(20, 24))])]),
+  ])
+  hass.advance(0)
+  callbacks = hass.calls['callbacks']
+  hass.advance(2 * 3600 - 1)
+  assert fsm.state.name == 'night'
+  assert hass.calls['callbacks'] == callbacks
+  hass.advance(1)
+  assert fsm.state.name == 'day'
+  assert hass.calls['callbacks'] == callbacks + 1
@@ -0,0 +1,175 @@
+# Tests of Checkpoint, saving machines on one MockHass and starting them again on another. Run with: python -m pytest
+#
+# A machine restarted from a checkpoint enters its saved state without running programs, arms its timeout and
+# stability timers for the time left, and remembers the last status seen by only_posedge.
+
+from datetime import datetime, timedelta
+
+import fsm_mock
+from fsm_checkpoint import Checkpoint
+from fsm_condition import GT, Condition
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+
+START = datetime(2024, 1, 1, 8, 0)
+
+
+# Helper function to build the machine on hass, saved in the checkpoint file path. entered lists the states entered
+def build(hass, path, entered, states=None):
+  if states is None:
+    states = [
+      State(id='idle', enter_programs=[Enter('idle', entered)], transitions=[
+        Transition(next='armed', conditions=[Condition(entity='input_boolean.arm', operand='on')]),
+      ]),
+      State(id='armed', enter_programs=[Enter('armed', entered)], transitions=[
+        Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, stability_time=60)]),
+        Transition(next='idle', conditions=[Condition(entity='input_boolean.arm', operand='off')]),
+        Transition(next='expired', conditions=[Condition(timeout_time=600)]),
+      ]),
+      State(id='hot', enter_programs=[Enter('hot', entered)]),
+      State(id='expired', enter_programs=[Enter('expired', entered)]),
+    ]
+  checkpoint = Checkpoint(hass, str(path), interval=None)
+  fsm = Fsm(hass, id='f', states=states, checkpoint=checkpoint, watchdog=False)
+  hass.advance(0)
+  return fsm, checkpoint
+
+
+class Enter:
+  # Program recording the state entered
+  def __init__(self, name, entered):
+    self.__name__ = name
+    self.entered = entered
+
+  def program(self, owner):
+    self.entered.append(self.__name__)
+
+
+# Helper function to start a new MockHass, seconds after START, with the states given
+def restart(seconds, states):
+  return fsm_mock.MockHass(now=START + timedelta(seconds=seconds), states=states)
+
+
+# The machine starts in the saved state
+def test_restore_state(tmp_path):
+  path = tmp_path / 'fsm.json'
+  hass = restart(0, {'input_boolean.arm': 'off', 'sensor.t': '15'})
+  entered = []
+  fsm, checkpoint = build(hass, path, entered)
+  hass.set_state('input_boolean.arm', 'on')
+  hass.advance(10)
+  assert fsm.state.name == 'armed'
+  checkpoint.save()
+
+  hass = restart(20, {'input_boolean.arm': 'on', 'sensor.t': '15'})
+  entered = []
+  fsm, checkpoint = build(hass, path, entered)
+  assert fsm.state.name == 'armed'
+  # The saved state is entered without running its programs
+  assert entered == []
+  assert any('Restored state armed' in msg for at, level, msg in hass.logs)
+
+
+# The stability timer expires at the time it would have without the restart
+def test_stability_time_left(tmp_path):
+  path = tmp_path / 'fsm.json'
+  hass = restart(0, {'input_boolean.arm': 'on', 'sensor.t': '15'})
+  fsm, checkpoint = build(hass, path, [])
+  hass.set_state('sensor.t', '25')
+  hass.advance(20)
+  checkpoint.save()
+
+  # Restarted 30 s after the sensor got hot; the 60 s of stability end 30 s later
+  hass = restart(30, {'input_boolean.arm': 'on', 'sensor.t': '25'})
+  fsm, checkpoint = build(hass, path, [])
+  assert fsm.state.name == 'armed'
+  hass.advance(29)
+  assert fsm.state.name == 'armed'
+  hass.advance(1)
+  assert fsm.state.name == 'hot'
+
+
+# The timeout keeps its deadline over a restart
+def test_timeout_time_left(tmp_path):
+  path = tmp_path / 'fsm.json'
+  hass = restart(0, {'input_boolean.arm': 'on', 'sensor.t': '15'})
+  fsm, checkpoint = build(hass, path, [])
+  hass.advance(100)
+  checkpoint.save()
+
+  hass = restart(400, {'input_boolean.arm': 'on', 'sensor.t': '15'})
+  fsm, checkpoint = build(hass, path, [])
+  hass.advance(199)
+  assert fsm.state.name == 'armed'
+  hass.advance(1)
+  assert fsm.state.name == 'expired'
+
+
+# A timeout expiring while AppDaemon was down is true at once
+def test_timeout_expired_during_restart(tmp_path):
+  path = tmp_path / 'fsm.json'
+  hass = restart(0, {'input_boolean.arm': 'on', 'sensor.t': '15'})
+  fsm, checkpoint = build(hass, path, [])
+  hass.advance(100)
+  checkpoint.save()
+
+  hass = restart(1000, {'input_boolean.arm': 'on', 'sensor.t': '15'})
+  entered = []
+  fsm, checkpoint = build(hass, path, entered)
+  assert fsm.state.name == 'expired'
+  assert entered == ['expired']
+
+
+# only_posedge remembers the last status, so an entity still on after the restart is not a new rising edge
+def test_posedge_memory(tmp_path):
+  path = tmp_path / 'fsm.json'
+
+  def states():
+    return [
+      State(id='idle', transitions=[Transition(next='rang', conditions=[Condition(entity='binary_sensor.bell', operand='on', only_posedge=True)])]),
+      State(id='rang', transitions=[Transition(next='idle', conditions=[Condition(timeout_time=5)])]),
+    ]
+
+  hass = restart(0, {'binary_sensor.bell': 'off'})
+  fsm, checkpoint = build(hass, path, [], states())
+  hass.set_state('binary_sensor.bell', 'on')
+  hass.advance(10)
+  assert fsm.state.name == 'idle'
+  checkpoint.save()
+  assert checkpoint.save_machine(fsm)['conditions'] == {'f_idle_t0_c0': [None, None, True]}
+
+  hass = restart(20, {'binary_sensor.bell': 'on'})
+  fsm, checkpoint = build(hass, path, [], states())
+  hass.advance(1)
+  assert fsm.state.name == 'idle'
+  # A new rising edge is still seen
+  hass.set_state('binary_sensor.bell', 'off')
+  hass.set_state('binary_sensor.bell', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'rang'
+
+
+# A checkpoint naming a state the machine no longer has is ignored, with its timers. The machine starts as without one
+def test_removed_state(tmp_path):
+  path = tmp_path / 'fsm.json'
+  hass = restart(0, {'input_boolean.arm': 'on', 'sensor.t': '25'})
+  fsm, checkpoint = build(hass, path, [])
+  hass.advance(20)
+  checkpoint.save()
+
+  hass = restart(30, {'input_boolean.arm': 'off', 'sensor.t': '25'})
+  entered = []
+  fsm, checkpoint = build(hass, path, entered, [
+    State(id='idle', enter_programs=[Enter('idle', entered)], transitions=[
+      Transition(next='heating', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, stability_time=60)]),
+    ]),
+    State(id='heating', enter_programs=[Enter('heating', entered)]),
+  ])
+  assert fsm.state.name == 'idle'
+  assert not any('Restored' in msg for at, level, msg in hass.logs)
+  # The stability timer starts from the restart
+  hass.advance(59)
+  assert fsm.state.name == 'idle'
+  hass.advance(1)
+  assert fsm.state.name == 'heating'
@@ -0,0 +1,213 @@
+# Tests of Condition, driven by machines on MockHass. Run with: python -m pytest
+#
+# A state change that does not change the result of the operator is dropped by the condition. The first tests
+# check that stability, only_posedge, re-entered states and enabled_entity still behave under it, and that operators
+# can keep their own attributes on the condition; the last ones check the Hysteresis operator.
+
+from datetime import datetime
+
+import pytest
+
+import fsm_mock
+from fsm_condition import GT, Condition, Hysteresis
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+
+
+# Helper function to create a machine on a new MockHass, with the sensor at temperature and the switches off
+def machine(states, temperature='15', lazy=False):
+  hass = fsm_mock.MockHass(now=datetime(2024, 1, 1), states={'sensor.t': temperature, 'input_boolean.s': 'off', 'input_boolean.e': 'off'})
+  fsm = Fsm(hass, id='f', states=states, lazy=lazy, watchdog=False)
+  hass.advance(0)
+  return hass, fsm
+
+
+# Helper function to send samples of the sensor, one every interval seconds
+def samples(hass, values, interval=5):
+  for value in values:
+    hass.set_state('sensor.t', value)
+    hass.advance(interval)
+
+
+# A sensor sending new true samples keeps the condition stable; the samples do not restart the stability timer
+@pytest.mark.parametrize('lazy', [False, True])
+def test_stability_not_restarted_by_true_samples(lazy):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[
+      Condition(entity='sensor.t', operator=GT, operand=20, stability_time=10),
+      Condition(entity='input_boolean.s', operand='on'),
+    ])]),
+    State(id='on'),
+  ], lazy=lazy)
+  samples(hass, ['25', '26', '27', '26', '25', '26'])
+  assert fsm.state.name == 'idle'
+  # Stable for 20 s while the samples kept coming
+  hass.set_state('input_boolean.s', 'on')
+  assert fsm.state.name == 'on'
+
+
+# A false sample stops the stability timer, and the next true sample starts it again
+@pytest.mark.parametrize('lazy', [False, True])
+def test_stability_restarted_after_false(lazy):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, stability_time=10)])]),
+    State(id='on'),
+  ], lazy=lazy)
+  samples(hass, ['25', '26', '15'], interval=4)
+  samples(hass, ['25', '26'], interval=4)
+  assert fsm.state.name == 'idle'
+  hass.advance(2)
+  assert fsm.state.name == 'on'
+
+
+# An only_posedge condition fires once per rising edge, whatever the number of true samples, and not again
+# when its state is entered while the sensor is still above
+@pytest.mark.parametrize('lazy', [False, True])
+def test_posedge(lazy):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='alarm', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, only_posedge=True)])]),
+    State(id='alarm', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.s', operand='on')])]),
+  ], lazy=lazy)
+  samples(hass, ['25', '26', '27'])
+  assert fsm.state.name == 'alarm'
+  hass.set_state('input_boolean.s', 'on')
+  assert fsm.state.name == 'idle'
+  hass.set_state('input_boolean.s', 'off')
+  samples(hass, ['26', '27'])
+  assert fsm.state.name == 'idle'
+  samples(hass, ['15', '25'])
+  assert fsm.state.name == 'alarm'
+
+
+# A condition listening all along keeps its stability while its state is left and entered again, even with new
+# true samples meanwhile. A lazy condition only listens in its state, so its stability starts again when entered
+@pytest.mark.parametrize('lazy, delay', [(False, 0), (True, 10)])
+def test_reentered_state(lazy, delay):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, stability_time=10)])]),
+    State(id='hot', transitions=[Transition(next='wait', conditions=[Condition(entity='input_boolean.s', operand='on')])]),
+    State(id='wait', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.s', operand='off')])]),
+  ], temperature='25', lazy=lazy)
+  hass.advance(10)
+  assert fsm.state.name == 'hot'
+  hass.set_state('input_boolean.s', 'on')
+  samples(hass, ['26', '27'])
+  hass.set_state('input_boolean.s', 'off')
+  if delay:
+    assert fsm.state.name == 'idle'
+    hass.advance(delay)
+  assert fsm.state.name == 'hot'
+
+
+# A condition on a time window, without an entity, still turns true after its state is entered again in a lazy machine
+def test_lazy_time_condition_reentered():
+  hass = fsm_mock.MockHass(now=datetime(2024, 1, 1, 21, 0), states={'input_text.f': 'day'})
+  fsm = Fsm(hass, id='f', entity='input_text.f', lazy=True, watchdog=False, states=[
+    State(id='day', transitions=[Transition(next='night', conditions=[Condition(hours=[22, 23, 0, 1, 2, 3, 4, 5])])]),
+    State(id='night', transitions=[Transition(next='day', conditions=[Condition(hours=range(6, 22))])]),
+  ])
+  seen = []
+  for minute in range(3 * 24 * 60):
+    hass.advance(60)
+    if not seen or seen[-1] != fsm.state.name:
+      seen.append(fsm.state.name)
+  assert seen == ['day', 'night', 'day', 'night', 'day', 'night', 'day']
+
+
+# A condition whose entity is already true turns true when its enabled_entity turns on, without waiting for the entity
+@pytest.mark.parametrize('lazy', [False, True])
+def test_enabled_entity(lazy):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='run', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, enabled_entity='input_boolean.e')])]),
+    State(id='run'),
+  ], temperature='25', lazy=lazy)
+  samples(hass, ['26', '27'])
+  assert fsm.state.name == 'idle'
+  hass.set_state('input_boolean.e', 'on')
+  assert fsm.state.name == 'run'
+
+
+class Counting:
+  # Operator keeping its own attribute on the condition: the number of samples evaluated
+  def compile(self, condition):
+    condition.samples = 0
+    def evaluate(state):
+      condition.samples += 1
+      return state == condition.operand
+    return evaluate
+
+
+# Conditions have fixed attributes, but operators can still store their own
+@pytest.mark.parametrize('lazy', [False, True])
+def test_operator_attributes(lazy):
+  condition = Condition(entity='input_boolean.s', operator=Counting(), operand='on')
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[condition])]),
+    State(id='on'),
+  ], lazy=lazy)
+  hass.set_state('input_boolean.s', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'on'
+  assert condition.samples >= 2
+  assert condition.hass is hass and condition.timers is fsm.timers
+
+
+# Helper function to create a machine staying in idle, and give the entity status of condition after each sample
+def hysteresis(condition, values, lazy=False):
+  blocked = Condition(entity='input_boolean.e', operand='on')
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[condition, blocked])]),
+    State(id='on'),
+  ], temperature=values[0], lazy=lazy)
+  statuses = [condition.entity_status]
+  for value in values[1:]:
+    samples(hass, [value])
+    statuses.append(condition.entity_status)
+  return statuses
+
+
+# With on above off, true from on, false from off, and kept between them
+def test_hysteresis_thresholds():
+  condition = Condition(entity='sensor.t', operator=Hysteresis(on=22, off=21))
+  assert hysteresis(condition, ['21.5', '22', '21.5', '21.1', '21', '21.9', '25']) == [False, True, True, True, False, False, True]
+
+
+# With on below off, like heating, true from on and below, false from off and above
+def test_hysteresis_reversed():
+  condition = Condition(entity='sensor.t', operator=Hysteresis(on=19.5, off=20.5))
+  assert hysteresis(condition, ['20', '19.5', '20', '20.4', '20.5', '19.6', '18']) == [False, True, True, True, False, False, True]
+
+
+# Changes smaller than deadband from the last number used are ignored, even when they cross a threshold
+def test_hysteresis_deadband():
+  condition = Condition(entity='sensor.t', operator=Hysteresis(on=22, off=21, deadband=0.5))
+  assert hysteresis(condition, ['21.8', '22.1', '22.4', '22.0', '21.1', '20.9', '20.5']) == [False, False, True, True, True, True, False]
+
+
+# A state that is not a number makes the condition false, and forgets the status and the last number used
+def test_hysteresis_not_a_number():
+  condition = Condition(entity='sensor.t', operator=Hysteresis(on=22, off=21, deadband=0.5))
+  assert hysteresis(condition, ['23', 'unavailable', '21.5', 'abc', '22.1', '21.9']) == [True, False, False, False, True, True]
+
+
+# Listening all along, the status is kept while the state is away. A lazy condition saw nothing while away,
+# so it starts again from the thresholds when the state is entered
+@pytest.mark.parametrize('lazy, expected', [(False, True), (True, False)])
+def test_hysteresis_reattached(lazy, expected):
+  condition = Condition(entity='sensor.t', operator=Hysteresis(on=22, off=21))
+  hass, fsm = machine([
+    State(id='idle', transitions=[
+      Transition(next='on', conditions=[condition, Condition(entity='input_boolean.e', operand='on')]),
+      Transition(next='away', conditions=[Condition(entity='input_boolean.s', operand='on')]),
+    ]),
+    State(id='away', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.s', operand='off')])]),
+    State(id='on'),
+  ], temperature='23', lazy=lazy)
+  assert condition.entity_status == True
+  hass.set_state('input_boolean.s', 'on')
+  assert fsm.state.name == 'away'
+  samples(hass, ['21.8', '21.5'])
+  hass.set_state('input_boolean.s', 'off')
+  assert fsm.state.name == 'idle'
+  assert condition.entity_status == expected
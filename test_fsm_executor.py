@@ -0,0 +1,141 @@
+# Tests of ThreadExecutor on MockHass. Run with: python -m pytest
+#
+# Programs of one machine run one at a time and in order, programs of different machines in parallel. A program
+# running longer than timeout is reported, and the machine waits for it unless move_on is set.
+
+import threading
+import time
+
+import fsm_executor
+import fsm_mock
+
+
+class ThreadedHass(fsm_mock.MockHass):
+  # MockHass taking run_in calls from worker threads, as AppDaemon does
+
+  def __init__(self):
+    super().__init__()
+    self.lock = threading.RLock()
+
+  def run_in(self, callback, delay, **kwargs):
+    with self.lock:
+      return super().run_in(callback, delay, **kwargs)
+
+  def advance(self, seconds=0):
+    with self.lock:
+      super().advance(seconds)
+
+
+class Machine:
+  # The part of Fsm used by the executor
+  def __init__(self, id):
+    self.id = id
+    self.metrics = None
+
+
+class Program:
+  # Program recording when it starts and ends. It waits for the event wait first if set, and sets the event signal
+  def __init__(self, name, log, wait=None, signal=None, error=None):
+    self.__name__ = name
+    self.log = log
+    self.wait = wait
+    self.signal = signal
+    self.error = error
+
+  def program(self, owner):
+    self.log.append(('start', self.__name__))
+    if self.signal is not None:
+      self.signal.set()
+    if self.wait is not None and not self.wait.wait(5):
+      self.log.append(('not released', self.__name__))
+    self.log.append(('end', self.__name__))
+    if self.error is not None:
+      raise self.error
+
+
+# Helper function to run the completions handed back by the workers, until done() is true
+def drain(hass, done, seconds=0):
+  deadline = time.monotonic() + 5
+  while not done():
+    assert time.monotonic() < deadline, 'programs did not finish'
+    time.sleep(0.001)
+    hass.advance(seconds)
+
+
+# Helper function to create an executor recording the completion callbacks in finished
+def executor(hass, finished, **kwargs):
+  return fsm_executor.ThreadExecutor(hass, callback=lambda kwargs: finished.append(kwargs), **kwargs)
+
+
+# The programs of a machine run one at a time in order, while another machine runs in parallel
+def test_order_per_machine():
+  hass = ThreadedHass()
+  finished, log = [], []
+  pool = executor(hass, finished, workers=4)
+  m1, m2 = Machine('m1'), Machine('m2')
+  # a1 can only return once b1 has started, on another worker
+  b1_started = threading.Event()
+  pool.run(m1, 'owner', [Program('a1', log, wait=b1_started), Program('a2', log), Program('a3', log)])
+  pool.run(m2, 'owner', [Program('b1', log, signal=b1_started)])
+  drain(hass, lambda: pool.backlog() == 0)
+  pool.shutdown()
+
+  assert ('not released', 'a1') not in log
+  m1_log = [entry for entry in log if entry[1].startswith('a')]
+  assert m1_log == [('start', 'a1'), ('end', 'a1'), ('start', 'a2'), ('end', 'a2'), ('start', 'a3'), ('end', 'a3')]
+  assert [kwargs['program'].__name__ for kwargs in finished if kwargs['fsm'] is m1] == ['a1', 'a2', 'a3']
+  assert pool.submitted == pool.completed == 4
+
+
+# A failing program is logged and counted, and the next program of the machine still runs
+def test_failing_program():
+  hass = ThreadedHass()
+  finished, log = [], []
+  pool = executor(hass, finished)
+  pool.run(Machine('m1'), 'owner', [Program('a1', log, error=RuntimeError('boom')), Program('a2', log)])
+  drain(hass, lambda: pool.backlog() == 0)
+  pool.shutdown()
+
+  assert [(kwargs['program'].__name__, type(kwargs['error'])) for kwargs in finished] == [('a1', RuntimeError), ('a2', type(None))]
+  assert pool.failed == 1
+  assert any(level == 'ERROR' and 'boom' in msg for at, level, msg in hass.logs)
+
+
+# Without move_on, a program timing out is reported, and the next one waits until it returns
+def test_timeout_waits():
+  hass = ThreadedHass()
+  finished, log = [], []
+  pool = executor(hass, finished, timeout=10)
+  release = threading.Event()
+  pool.run(Machine('m1'), 'owner', [Program('a1', log, wait=release), Program('a2', log)])
+  hass.advance(11)
+  assert pool.timed_out == 1
+  assert any(level == 'WARNING' and 'still running' in msg for at, level, msg in hass.logs)
+  assert ('start', 'a2') not in log and finished == []
+
+  release.set()
+  drain(hass, lambda: pool.backlog() == 0)
+  pool.shutdown()
+  assert log.index(('end', 'a1')) < log.index(('start', 'a2'))
+  assert [(kwargs['program'].__name__, kwargs['timed_out']) for kwargs in finished] == [('a1', True), ('a2', False)]
+  assert pool.completed == 2
+
+
+# With move_on, the next program starts when a program times out, and the late program is only reported once
+def test_timeout_move_on():
+  hass = ThreadedHass()
+  finished, log = [], []
+  pool = executor(hass, finished, timeout=10, move_on=True)
+  release = threading.Event()
+  pool.run(Machine('m1'), 'owner', [Program('a1', log, wait=release), Program('a2', log)])
+  hass.advance(11)
+  drain(hass, lambda: len(finished) == 2)
+  assert ('end', 'a1') not in log and ('end', 'a2') in log
+  assert [(kwargs['program'].__name__, kwargs['timed_out']) for kwargs in finished] == [('a1', True), ('a2', False)]
+
+  release.set()
+  pool.shutdown()
+  hass.advance(0)
+  assert ('end', 'a1') in log
+  assert len(finished) == 2
+  assert pool.timed_out == 1 and pool.backlog() == 0
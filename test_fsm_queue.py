@@ -0,0 +1,120 @@
+# Tests of EventQueue. Run with: python -m pytest
+#
+# Callbacks are run in stage order TRANSITION, STATE, DEFERRED, never nested in each other, and only once per event
+# when posted again while pending. A machine posting callbacks forever is stopped by the limit.
+
+import fsm_mock
+import fsm_queue
+from fsm_queue import DEFERRED, STATE, TRANSITION
+
+
+# Helper function to create a callback recording its name and kwargs in log, then running then(kwargs) if set
+def recorder(log, name, then=None):
+  def callback(kwargs):
+    log.append((name, kwargs))
+    if then is not None:
+      then(kwargs)
+  return callback
+
+
+# All objects using the same hass share one queue
+def test_shared_per_hass():
+  hass = fsm_mock.MockHass()
+  assert fsm_queue.get_event_queue(hass) is fsm_queue.get_event_queue(hass)
+  assert fsm_queue.get_event_queue(hass) is not fsm_queue.get_event_queue(fsm_mock.MockHass())
+
+
+# Callbacks held by a with block run when it ends, stage by stage and in posting order within a stage
+def test_stage_order():
+  queue = fsm_queue.EventQueue(fsm_mock.MockHass())
+  log = []
+  with queue:
+    queue.post(recorder(log, 'deferred'), DEFERRED)
+    queue.post(recorder(log, 'state'), STATE)
+    queue.post(recorder(log, 'transition 1'), TRANSITION)
+    queue.post(recorder(log, 'transition 2'), TRANSITION)
+    assert log == []
+  assert [name for name, kwargs in log] == ['transition 1', 'transition 2', 'state', 'deferred']
+
+
+# A callback posted to an earlier stage runs before the later stages still pending
+def test_earlier_stage_first():
+  queue = fsm_queue.EventQueue(fsm_mock.MockHass())
+  log = []
+  transition = recorder(log, 'transition')
+  with queue:
+    queue.post(recorder(log, 'state', lambda kwargs: queue.post(transition, TRANSITION)), STATE)
+    queue.post(recorder(log, 'deferred'), DEFERRED)
+  assert [name for name, kwargs in log] == ['state', 'transition', 'deferred']
+
+
+# A callback pending in a stage is not added again, and keeps the kwargs it was first posted with
+def test_pending_not_added_again():
+  queue = fsm_queue.EventQueue(fsm_mock.MockHass())
+  log = []
+  callback = recorder(log, 'check')
+  with queue:
+    queue.post(callback, TRANSITION, {'n': 1})
+    queue.post(callback, TRANSITION, {'n': 2})
+    queue.post(callback, STATE, {'n': 3})
+  assert log == [('check', {'n': 1}), ('check', {'n': 3})]
+
+
+# A callback posted by a running callback is queued, not run nested in it
+def test_not_reentrant():
+  queue = fsm_queue.EventQueue(fsm_mock.MockHass())
+  log = []
+  inner = recorder(log, 'inner')
+  def outer(kwargs):
+    log.append(('outer start', None))
+    queue.post(inner)
+    log.append(('outer end', None))
+  queue.post(outer)
+  assert [name for name, kwargs in log] == ['outer start', 'outer end', 'inner']
+  assert queue.depth == 0
+
+
+# Nested with blocks run the queue when the outermost one ends
+def test_nested_hold():
+  queue = fsm_queue.EventQueue(fsm_mock.MockHass())
+  log = []
+  with queue:
+    with queue:
+      queue.post(recorder(log, 'check'))
+    assert log == []
+  assert len(log) == 1
+
+
+# A failing callback is logged, and the queue goes on with the next one
+def test_failing_callback():
+  hass = fsm_mock.MockHass()
+  queue = fsm_queue.EventQueue(hass)
+  log = []
+  def fail(kwargs):
+    raise RuntimeError('boom')
+  with queue:
+    queue.post(fail)
+    queue.post(recorder(log, 'next'))
+  assert len(log) == 1
+  assert any(level == 'ERROR' and 'boom' in msg for time, level, msg in hass.logs)
+
+
+# A callback posting itself forever is stopped after limit callbacks, and the queue is dropped
+def test_limit():
+  hass = fsm_mock.MockHass()
+  queue = fsm_queue.EventQueue(hass)
+  assert queue.limit == 100000
+  count = [0]
+  def loop(kwargs):
+    count[0] += 1
+    queue.post(loop)
+    queue.post(loop, DEFERRED)
+  queue.post(loop)
+  assert count[0] == 100000
+  assert all(not order for order in queue.order) and all(not pending for pending in queue.pending)
+  assert any(level == 'ERROR' and 'looping' in msg for time, level, msg in hass.logs)
+
+  # The queue is usable again for the next event
+  log = []
+  queue.post(recorder(log, 'next'))
+  assert len(log) == 1
@@ -0,0 +1,148 @@
+# Tests of Fsm.reload on MockHass. Run with: python -m pytest
+#
+# A condition with the same arguments, in a state with the same id and a transition to the same next state, is kept
+# with its listeners, timers and status. Other conditions are started or stopped, and an entity still used keeps its
+# listener in AppDaemon.
+
+from datetime import datetime
+
+import pytest
+
+import fsm_mock
+from fsm_condition import GT, Condition
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+
+
+# Helper function to create a machine on a new MockHass, with the sensor cold and the switches off
+def machine(states, lazy=False):
+  hass = fsm_mock.MockHass(now=datetime(2024, 1, 1), states={'sensor.t': '15', 'input_boolean.a': 'off', 'input_boolean.b': 'off'})
+  fsm = Fsm(hass, id='f', states=states, lazy=lazy, watchdog=False)
+  hass.advance(0)
+  return hass, fsm
+
+
+# Helper function to get the number of AppDaemon listeners of entity
+def listeners(hass, entity):
+  return len(hass.entity_listeners.get(entity, ()))
+
+
+class Enter:
+  # Program recording the state entered
+  def __init__(self, name, entered):
+    self.__name__ = name
+    self.entered = entered
+
+  def program(self, owner):
+    self.entered.append(self.__name__)
+
+
+# Conditions are matched by state, next state and arguments
+def test_kept_added_removed():
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.a', operand='on'), Condition(timeout_time=60)])]),
+    State(id='on', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.a', operand='off')])]),
+  ])
+  kept = fsm.states[0].transitions[0].conditions[0]
+  counts = fsm.reload([
+    # Same condition kept, timeout removed, condition on input_boolean.b added
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.a', operand='on'), Condition(entity='input_boolean.b', operand='on')])]),
+    # Same condition to another next state: removed and added
+    State(id='on', transitions=[Transition(next='off', conditions=[Condition(entity='input_boolean.a', operand='off')])]),
+    State(id='off'),
+  ])
+  assert counts == (1, 2, 2)
+  assert fsm.states[0].transitions[0].conditions[0] is kept
+  assert any('1 conditions kept, 2 added, 2 removed' in msg for at, level, msg in hass.logs)
+
+
+# A kept condition keeps its stability timer running
+@pytest.mark.parametrize('lazy', [False, True])
+def test_kept_timer(lazy):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, stability_time=60)])]),
+    State(id='hot'),
+  ], lazy=lazy)
+  hass.set_state('sensor.t', '25')
+  hass.advance(30)
+  fsm.reload([
+    State(id='idle', transitions=[
+      Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=GT, operand=20, stability_time=60)]),
+      Transition(next='cold', conditions=[Condition(entity='sensor.t', operator=GT, operand=40)]),
+    ]),
+    State(id='hot'),
+    State(id='cold'),
+  ])
+  hass.advance(29)
+  assert fsm.state.name == 'idle'
+  hass.advance(1)
+  assert fsm.state.name == 'hot'
+
+
+# An entity still used by a new condition keeps its listener; an entity no longer used loses it
+@pytest.mark.parametrize('lazy', [False, True])
+def test_listeners(lazy):
+  hass, fsm = machine([
+    State(id='idle', transitions=[
+      Transition(next='on', conditions=[Condition(entity='input_boolean.a', operand='on')]),
+      Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=GT, operand=20)]),
+    ]),
+    State(id='on'),
+    State(id='hot'),
+  ], lazy=lazy)
+  assert listeners(hass, 'input_boolean.a') == 1 and listeners(hass, 'sensor.t') == 1
+  calls = dict(hass.calls)
+  fsm.reload([
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.a', operand='on', only_posedge=True)])]),
+    State(id='on'),
+  ])
+  assert listeners(hass, 'input_boolean.a') == 1 and listeners(hass, 'sensor.t') == 0
+  assert hass.calls['listen_state'] == calls['listen_state']
+  assert hass.calls['cancel_listen_state'] == calls['cancel_listen_state'] + 1
+  # The new condition sees the changes through the listener kept
+  hass.set_state('input_boolean.a', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'on'
+
+
+# When the current state is removed, the machine goes to the first state of the new definition, without running programs
+def test_current_state_removed():
+  entered = []
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.a', operand='on')])]),
+    State(id='on'),
+  ])
+  hass.set_state('input_boolean.a', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'on'
+  fsm.reload([
+    State(id='a', enter_programs=[Enter('a', entered)], transitions=[Transition(next='b', conditions=[Condition(entity='input_boolean.b', operand='on')])]),
+    State(id='b', enter_programs=[Enter('b', entered)]),
+  ])
+  assert fsm.state.name == 'a'
+  assert entered == []
+  assert any(level == 'WARNING' and 'State on removed by reload, using a' in msg for at, level, msg in hass.logs)
+  hass.set_state('input_boolean.b', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'b' and entered == ['b']
+
+
+# When the current state is kept, the machine stays in it without running programs
+def test_current_state_kept():
+  entered = []
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.a', operand='on')])]),
+    State(id='on'),
+  ])
+  fsm.reload([
+    State(id='idle', enter_programs=[Enter('idle', entered)], transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.b', operand='on')])]),
+    State(id='on', enter_programs=[Enter('on', entered)]),
+  ])
+  assert fsm.state.name == 'idle' and entered == []
+  hass.set_state('input_boolean.a', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'idle'
+  hass.set_state('input_boolean.b', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'on' and entered == ['on']
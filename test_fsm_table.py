@@ -0,0 +1,64 @@
+# Tests of FsmTable, through machines on MockHass. Run with: python -m pytest
+#
+# When several transitions of a state are true at once, the first one in guard order is run, whether they became true
+# from the same entity change or from timeouts expiring in the same second.
+
+from datetime import datetime
+
+import pytest
+
+import fsm_mock
+from fsm_condition import Condition
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+
+
+# Helper function to create a machine on a new MockHass, with the switch off
+def machine(states):
+  hass = fsm_mock.MockHass(now=datetime(2024, 1, 1), states={'input_boolean.s': 'off'})
+  fsm = Fsm(hass, id='f', states=states, watchdog=False)
+  hass.advance(0)
+  return hass, fsm
+
+
+# Two transitions made true by the same entity change
+@pytest.mark.parametrize('order', [('a', 'b'), ('b', 'a')])
+def test_same_entity_change(order):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next=next, conditions=[Condition(entity='input_boolean.s', operand='on')]) for next in order]),
+    State(id='a'),
+    State(id='b'),
+  ])
+  hass.set_state('input_boolean.s', 'on')
+  hass.advance(0)
+  assert fsm.state.name == order[0]
+
+
+# Two transitions with the same timeout
+@pytest.mark.parametrize('order', [('a', 'b'), ('b', 'a')])
+def test_same_timeout(order):
+  hass, fsm = machine([
+    State(id='idle', transitions=[Transition(next=next, conditions=[Condition(timeout_time=10)]) for next in order]),
+    State(id='a'),
+    State(id='b'),
+  ])
+  hass.advance(9)
+  assert fsm.state.name == 'idle'
+  hass.advance(1)
+  assert fsm.state.name == order[0]
+
+
+# A true transition later in guard order is run once the ones before it are false
+def test_later_transition():
+  hass, fsm = machine([
+    State(id='idle', transitions=[
+      Transition(next='a', conditions=[Condition(entity='input_boolean.s', operand='on'), Condition(timeout_time=60)]),
+      Transition(next='b', conditions=[Condition(entity='input_boolean.s', operand='on')]),
+    ]),
+    State(id='a'),
+    State(id='b'),
+  ])
+  hass.set_state('input_boolean.s', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'b'
@@ -0,0 +1,38 @@
+# Tests of Trace, kept by machines on MockHass. Run with: python -m pytest
+#
+# A machine stamps its trace records with the time of its hass, so on MockHass they follow the virtual clock.
+
+from datetime import datetime
+
+import fsm_mock
+import fsm_trace
+from fsm_condition import Condition
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+
+
+# Records are stamped with the virtual time, not the time of the test run
+def test_stamped_by_hass():
+  hass = fsm_mock.MockHass(now=datetime(2024, 1, 1, 8, 0), states={'input_boolean.s': 'off'})
+  fsm = Fsm(hass, id='f', watchdog=False, states=[
+    State(id='idle', transitions=[Transition(next='on', conditions=[Condition(entity='input_boolean.s', operand='on', stability_time=30)])]),
+    State(id='on'),
+  ])
+  hass.advance(3600)
+  hass.set_state('input_boolean.s', 'on')
+  hass.advance(30)
+  records = list(fsm.trace.records)
+  assert records[-1][1:] == (fsm_trace.STATE, 'on', 'idle')
+  assert records[-1][0] == datetime(2024, 1, 1, 9, 0, 30).timestamp()
+  assert [stamp for stamp, kind, id, value in records if kind == fsm_trace.CONDITION][-1] == datetime(2024, 1, 1, 9, 0, 30).timestamp()
+  assert fsm.trace.dump(1) == ['09:00:30.000 state on from idle']
+
+
+# The oldest records are dropped when the trace is full
+def test_size():
+  trace = fsm_trace.Trace(3, clock=lambda: 0)
+  for number in range(5):
+    trace.add(fsm_trace.TIMEOUT, 'c{}'.format(number))
+  assert [id for stamp, kind, id, value in trace.records] == ['c2', 'c3', 'c4']
+  assert len(trace.dump(2)) == 2 and trace.dump(0) == []
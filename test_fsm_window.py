@@ -0,0 +1,176 @@
+# Tests of the sliding window operators on MockHass. Run with: python -m pytest
+#
+# The aggregates are checked against a plain computation from the list of changes, while the ring of buckets wraps
+# around many times and after the entity is quiet for longer than the window.
+
+import random
+from datetime import datetime
+
+import pytest
+
+import fsm_cache
+import fsm_mock
+import fsm_timer
+import fsm_window
+from fsm_condition import GT, LT, Condition
+from fsm_fsm import Fsm
+from fsm_state import State
+from fsm_transition import Transition
+from fsm_window import Max, Mean, Min, SlidingWindow, TrueFor
+
+START = datetime(2024, 1, 1)
+
+
+# Helper function to get the time-weighted mean and the values of changes (a list of (time, value), in order) from
+# start to end
+def reference(changes, start, end):
+  area = 0.0
+  values = []
+  for index, (time, value) in enumerate(changes):
+    until = changes[index + 1][0] if index + 1 < len(changes) else end
+    begin, until = max(time, start), min(until, end)
+    # A value replaced at start did not hold in the window
+    if until > begin or time == end:
+      area += value * (until - begin)
+      values.append(value)
+  return area / (end - start), values
+
+
+# Helper function to create a machine on a new MockHass, going to hot when the mean of sensor.t is above 20 for 300 s,
+# and back to idle when input_boolean.reset is on
+def machine(lazy):
+  hass = fsm_mock.MockHass(now=START, states={'sensor.t': '25', 'input_boolean.reset': 'off'})
+  fsm = Fsm(hass, id='f', lazy=lazy, watchdog=False, states=[
+    State(id='idle', transitions=[Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=Mean(300, GT), operand=20)])]),
+    State(id='hot', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.reset', operand='on')])]),
+  ])
+  hass.advance(0)
+  return hass, fsm
+
+
+# Mean is false until the window has run for its whole length. It is evaluated again at each step of the window,
+# 5 s here
+@pytest.mark.parametrize('lazy', [False, True])
+def test_full_window(lazy):
+  hass, fsm = machine(lazy)
+  hass.advance(299)
+  assert fsm.state.name == 'idle'
+  hass.advance(5)
+  assert fsm.state.name == 'hot'
+
+
+# Max(GT) is true at once on a value seen in part of the window, while Max(LT) waits for the whole window
+def test_partial_window():
+  hass = fsm_mock.MockHass(now=START, states={'sensor.t': '25'})
+  fsm = Fsm(hass, id='f', watchdog=False, states=[
+    State(id='idle', transitions=[
+      Transition(next='peak', conditions=[Condition(entity='sensor.t', operator=Max(300, GT), operand=90)]),
+      Transition(next='low', conditions=[Condition(entity='sensor.t', operator=Max(300, LT), operand=30)]),
+    ]),
+    State(id='peak'),
+    State(id='low'),
+  ])
+  hass.advance(10)
+  assert fsm.state.name == 'idle'
+  hass.set_state('sensor.t', '95')
+  hass.advance(0)
+  assert fsm.state.name == 'peak'
+
+
+# In a lazy machine the window starts again when the state is entered, and is not judged on the first seconds
+def test_lazy_entry():
+  hass, fsm = machine(True)
+  hass.advance(305)
+  assert fsm.state.name == 'hot'
+  assert fsm_window.get_windows(hass).windows == {}
+  hass.set_state('input_boolean.reset', 'on')
+  hass.advance(0)
+  assert fsm.state.name == 'idle'
+  hass.set_state('input_boolean.reset', 'off')
+  hass.advance(10)
+  assert fsm.state.name == 'idle'
+  hass.advance(289)
+  assert fsm.state.name == 'idle'
+  hass.advance(5)
+  assert fsm.state.name == 'hot'
+
+
+# The aggregates match the changes over the last buckets, while the ring wraps around many times
+def test_wrap_around():
+  hass = fsm_mock.MockHass(now=START, states={'sensor.t': '0'})
+  # 4 buckets of 10 s
+  window = SlidingWindow(hass, 'sensor.t', None, 40, fsm_cache.to_float, 4)
+  generator = random.Random(1)
+  changes = [(0, 0.0)]
+  for second in range(1, 400):
+    hass.advance(1)
+    if generator.random() < 0.3:
+      value = float(generator.randint(-50, 50))
+      hass.set_state('sensor.t', str(value))
+      changes.append((second, value))
+    if second % 7 == 0:
+      # The window holds the buckets from 30 s before the current one
+      start = max(0, (second // 10 - 3) * 10)
+      mean, values = reference(changes, start, second)
+      assert window.mean() == pytest.approx(mean)
+      assert window.minimum() == min(values)
+      assert window.maximum() == max(values)
+  window.stop()
+
+
+# After the entity was quiet for longer than the window, the window only holds its last value, as if it had moved
+# one bucket at a time. The gaps end in each bucket of the ring
+@pytest.mark.parametrize('gap', [1000, 1010, 1020, 1030, 1047])
+def test_gap_longer_than_window(gap):
+  hass = fsm_mock.MockHass(now=START, states={'sensor.t': '10'})
+  timers = fsm_timer.get_timing_wheel(hass)
+  ticked = SlidingWindow(hass, 'sensor.t', None, 40, fsm_cache.to_float, 4)
+  quiet = SlidingWindow(hass, 'sensor.t', None, 40, fsm_cache.to_float, 4)
+  # Only moved when read or changed
+  timers.cancel_timer(quiet.handle)
+  hass.advance(15)
+  hass.set_state('sensor.t', '30')
+  hass.advance(gap)
+  for window in (ticked, quiet):
+    assert window.mean() == pytest.approx(30.0)
+    assert window.minimum() == window.maximum() == 30.0
+    # 3 buckets and the part of the current one
+    assert window.total_covered == pytest.approx(30.0 + (15 + gap) % 10)
+  hass.set_state('sensor.t', '50')
+  hass.advance(25)
+  assert quiet.mean() == pytest.approx(ticked.mean())
+  assert quiet.minimum() == ticked.minimum() == 30.0
+  assert quiet.maximum() == ticked.maximum() == 50.0
+  assert quiet.area == pytest.approx(ticked.area)
+  ticked.stop()
+
+
+# Conditions on the same entity and window length share one window, kept while one of them is attached
+def test_shared():
+  hass = fsm_mock.MockHass(now=START, states={'sensor.t': '25', 'input_boolean.reset': 'off'})
+  fsm = Fsm(hass, id='f', lazy=True, watchdog=False, states=[
+    State(id='idle', transitions=[
+      Transition(next='hot', conditions=[Condition(entity='sensor.t', operator=Mean(300, GT), operand=20)]),
+      Transition(next='steady', conditions=[Condition(entity='sensor.t', operator=Max(300, LT), operand=30)]),
+      Transition(next='cold', conditions=[Condition(entity='sensor.t', operator=Min(600, LT), operand=0)]),
+      Transition(next='on', conditions=[Condition(entity='sensor.t', operator=TrueFor(300, 60, GT), operand=20)]),
+    ]),
+    State(id='hot'),
+    State(id='steady'),
+    State(id='cold'),
+    State(id='on', transitions=[Transition(next='idle', conditions=[Condition(entity='input_boolean.reset', operand='on')])]),
+  ])
+  hass.advance(0)
+  windows = fsm_window.get_windows(hass).windows
+  assert len(windows) == 3
+  shared = windows[('sensor.t', None, 300, 60, 'number')]
+  assert len(shared.users) == 2
+  # One listener for the entity, whatever the number of windows and conditions
+  assert len(hass.entity_listeners['sensor.t']) == 1
+
+  # TrueFor only needs its 60 s; leaving the state stops all the windows
+  hass.advance(59)
+  assert fsm.state.name == 'idle'
+  hass.advance(5)
+  assert fsm.state.name == 'on'
+  assert windows == {}